@@ -0,0 +1,132 @@
+import random
+from datetime import datetime, timedelta
+from xml.sax.saxutils import escape
+
+
+datatypes = ["Core", "Cuttings", "Thin section", "Geochemistry", "Well log", "Map", "Photograph"]
+words = ["basin", "granite", "sandstone", "shale", "drill", "core", "survey", "mineral", "fault", "aquifer",
+         "quadrangle", "sediment", "outcrop", "volcanic", "glacial", "stratigraphy", "sample", "county"]
+
+
+def sentence(rng, length):
+    return " ".join(rng.choice(words) for _ in range(length)).capitalize()
+
+
+def synthetic_record(rng, i):
+    lon = round(rng.uniform(-124.0, -67.0), 5)
+    lat = round(rng.uniform(25.0, 49.0), 5)
+    date = datetime(1900, 1, 1) + timedelta(days=rng.randint(0, 43000))
+
+    return {
+        "title": f"{sentence(rng, 4)} {i}",
+        "abstract": sentence(rng, 30),
+        "datatype": ",".join(rng.sample(datatypes, rng.randint(1, 3))),
+        "supplementalinformation": sentence(rng, 12),
+        "coordinates": f"{lon},{lat}",
+        "date": date.strftime(rng.choice(["%Y-%m-%d", "%m/%d/%Y", "%Y-%m-00"])),
+        "onlink": f"https://example.org/samples/{i}",
+        "browsegraphic": f"https://example.org/samples/{i}.jpg"
+    }
+
+
+def records(count, seed=0):
+    rng = random.Random(seed)
+    return [synthetic_record(rng, i) for i in range(count)]
+
+
+def nggdpp_xml(count, seed=0):
+    # One wrapper element holding a header and a repeated record element, the layout introspect_nggdpp_xml expects
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        "<NGGDPP_Collection>",
+        "<Collection_Info><name>Synthetic collection</name></Collection_Info>"
+    ]
+    for record in records(count, seed=seed):
+        lines.append("<Record>")
+        for k, v in record.items():
+            lines.append(f"<{k}>{escape(v)}</{k}>")
+        lines.append("</Record>")
+    lines.append("</NGGDPP_Collection>")
+
+    return "\n".join(lines)
+
+
+def nggdpp_csv(count, seed=0, delimiter="|"):
+    columns = ["title", "abstract", "datatype", "supplementalinformation", "latitude", "longitude", "date", "onlink"]
+    lines = [delimiter.join(columns)]
+    for record in records(count, seed=seed):
+        lon, lat = record["coordinates"].split(",")
+        record["latitude"] = lat
+        record["longitude"] = lon
+        lines.append(delimiter.join(record[c].replace(delimiter, " ") for c in columns))
+
+    return "\n".join(lines) + "\n"
+
+
+def fgdc_metadata(i, seed=0):
+    rng = random.Random(seed * 100000 + i)
+    west = round(rng.uniform(-124.0, -70.0), 4)
+    south = round(rng.uniform(25.0, 45.0), 4)
+
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<metadata>
+  <idinfo>
+    <citation><citeinfo>
+      <origin>Synthetic Survey</origin>
+      <pubdate>{rng.randint(1950, 2018)}</pubdate>
+      <title>{escape(sentence(rng, 6))} {i}</title>
+      <onlink>https://example.org/metadata/{i}</onlink>
+    </citeinfo></citation>
+    <descript>
+      <abstract>{escape(sentence(rng, 40))}</abstract>
+      <purpose>{escape(sentence(rng, 10))}</purpose>
+      <supplinf>{escape(sentence(rng, 10))}</supplinf>
+    </descript>
+    <spdom><bounding>
+      <westbc>{west}</westbc>
+      <eastbc>{round(west + rng.uniform(0.01, 2.0), 4)}</eastbc>
+      <northbc>{round(south + rng.uniform(0.01, 2.0), 4)}</northbc>
+      <southbc>{south}</southbc>
+    </bounding></spdom>
+    <keywords><theme><themekt>None</themekt>
+      <themekey>{rng.choice(words)}</themekey><themekey>{rng.choice(words)}</themekey>
+    </theme></keywords>
+  </idinfo>
+</metadata>
+"""
+
+
+def iso_metadata(i, seed=0):
+    rng = random.Random(seed * 100000 + i)
+    west = round(rng.uniform(-124.0, -70.0), 4)
+    south = round(rng.uniform(25.0, 45.0), 4)
+
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<gmd:MD_Metadata xmlns:gmd="http://www.isotc211.org/2005/gmd" xmlns:gco="http://www.isotc211.org/2005/gco">
+  <gmd:identificationInfo><gmd:MD_DataIdentification>
+    <gmd:citation><gmd:CI_Citation>
+      <gmd:title><gco:CharacterString>{escape(sentence(rng, 6))} {i}</gco:CharacterString></gmd:title>
+    </gmd:CI_Citation></gmd:citation>
+    <gmd:abstract><gco:CharacterString>{escape(sentence(rng, 40))}</gco:CharacterString></gmd:abstract>
+    <gmd:extent><gmd:EX_Extent><gmd:geographicElement><gmd:EX_GeographicBoundingBox>
+      <gmd:westBoundLongitude><gco:Decimal>{west}</gco:Decimal></gmd:westBoundLongitude>
+      <gmd:eastBoundLongitude><gco:Decimal>{round(west + rng.uniform(0.01, 2.0), 4)}</gco:Decimal></gmd:eastBoundLongitude>
+      <gmd:southBoundLatitude><gco:Decimal>{south}</gco:Decimal></gmd:southBoundLatitude>
+      <gmd:northBoundLatitude><gco:Decimal>{round(south + rng.uniform(0.01, 2.0), 4)}</gco:Decimal></gmd:northBoundLatitude>
+    </gmd:EX_GeographicBoundingBox></gmd:geographicElement></gmd:EX_Extent></gmd:extent>
+  </gmd:MD_DataIdentification></gmd:identificationInfo>
+</gmd:MD_Metadata>
+"""
+
+
+def waf_listing(file_names, seed=0):
+    # Apache style <pre> listing: an anchor per file followed by a "date time size" text node
+    rng = random.Random(seed)
+    lines = ['<html><head><title>Index of /waf</title></head><body><h1>Index of /waf</h1>',
+             '<pre><a href="?C=N;O=D">Name</a> <a href="?C=M;O=A">Last modified</a>\r\n']
+    for file_name in file_names:
+        modified = datetime(2018, 1, 1) + timedelta(minutes=rng.randint(0, 500000))
+        lines.append(f'<a href="{file_name}">{file_name}</a> {modified.strftime("%Y-%m-%d %H:%M")} {rng.randint(2, 90)}K\r\n')
+    lines.append("</pre></body></html>")
+
+    return "".join(lines)
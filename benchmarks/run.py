@@ -0,0 +1,226 @@
+"""Offline ingest benchmarks
+
+Times each ingest stage against synthetic data, with S3, SQS, Elasticsearch and MongoDB replaced by in-process
+stand-ins and source files served from a local HTTP server, so results reflect our code rather than the network.
+
+    python -m benchmarks.run --records 5000 --output results.json
+    python -m benchmarks.run --baseline baseline.json --tolerance 0.2
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from pynggdpp import aws
+from pynggdpp import item_process
+
+from . import fixtures
+from .standins import LocalHTTPServer, StandInConnect, StandInMongo, write_fixture
+
+
+@contextmanager
+def stand_ins():
+    # Objects are built through their real constructors, so benchmarks see every attribute production code sets
+    connect = StandInConnect()
+    mongo = StandInMongo()
+    patched = [(aws, "Connect"), (item_process, "Connect"), (item_process, "Infrastructure")]
+    originals = [getattr(module, name) for module, name in patched]
+
+    aws.Connect = item_process.Connect = lambda: connect
+    item_process.Infrastructure = lambda: mongo
+    try:
+        yield connect
+    finally:
+        for (module, name), original in zip(patched, originals):
+            setattr(module, name, original)
+
+
+class Benchmarks:
+    def __init__(self, record_number=1000, file_number=50, repeat=3, seed=0):
+        self.record_number = record_number
+        self.file_number = file_number
+        self.repeat = repeat
+        self.seed = seed
+
+    def stages(self, base_url):
+        files = item_process.Files()
+        spatial = item_process.Spatial()
+        temporal = item_process.Temporal()
+        with stand_ins():
+            storage = aws.Storage()
+            messaging = aws.Messaging()
+            search = aws.Search()
+            log = item_process.Log()
+
+        metadata_docs = [fixtures.fgdc_metadata(i, seed=self.seed) for i in range(self.file_number // 2)] + \
+            [fixtures.iso_metadata(i, seed=self.seed) for i in range(self.file_number - self.file_number // 2)]
+        source_records = fixtures.records(self.record_number, seed=self.seed)
+        xml_file = {"ndc_file_url": f"{base_url}collection.xml", "ndc_file_name": "collection.xml"}
+        csv_file = {"ndc_file_url": f"{base_url}collection.txt", "ndc_file_name": "collection.txt"}
+
+        # Each stage takes a fresh copy of its input so repeats don't see records already processed in place
+        return [
+            ("parse_waf", lambda: None, lambda _: item_process.Links().parse_waf(f"{base_url}waf/"), self.file_number),
+            ("clean_dict_from_nggdpp_xml", lambda: None, lambda _: files.clean_dict_from_nggdpp_xml(xml_file),
+             self.record_number),
+            ("clean_dict_from_csv", lambda: None, lambda _: files.clean_dict_from_csv(csv_file), self.record_number),
+            ("feature_from_metadata", lambda: None,
+             lambda _: [spatial.feature_from_metadata(d) for d in metadata_docs], len(metadata_docs)),
+            ("spatial", lambda: copy.deepcopy(source_records),
+             lambda items: [spatial.introspect_coordinates(i) for i in items], self.record_number),
+            ("temporal", lambda: copy.deepcopy(source_records),
+             lambda items: [temporal.introspect_date(i) for i in items], self.record_number),
+            ("bulk_build_es_index", lambda: copy.deepcopy(source_records),
+             lambda items: search.bulk_build_es_index("benchmark", "ndc_collection_item", items), self.record_number),
+            ("put_json_to_s3", lambda: None,
+             lambda _: storage.put_json_to_s3(source_records, "benchmark/records.json", "ndc-benchmark"),
+             self.record_number),
+            ("post_message", lambda: None,
+             lambda _: [messaging.post_message("benchmark", str(i), r) for i, r in enumerate(source_records)],
+             self.record_number),
+            ("log_process_step", lambda: None,
+             lambda _: [log.log_process_step(str(i), "benchmark", r, context="serverful")
+                        for i, r in enumerate(source_records[:self.file_number])],
+             self.file_number)
+        ]
+
+    def write_sources(self, directory):
+        write_fixture(directory, "collection.xml", fixtures.nggdpp_xml(self.record_number, seed=self.seed))
+        write_fixture(directory, "collection.txt", fixtures.nggdpp_csv(self.record_number, seed=self.seed))
+
+        waf_directory = os.path.join(directory, "waf")
+        os.makedirs(waf_directory)
+        file_names = [f"metadata_{i}.xml" for i in range(self.file_number)]
+        write_fixture(waf_directory, "index.html", fixtures.waf_listing(file_names, seed=self.seed))
+        for i, file_name in enumerate(file_names):
+            write_fixture(waf_directory, file_name, fixtures.fgdc_metadata(i, seed=self.seed))
+
+    def time_stage(self, setup, function, units):
+        timings = list()
+        for _ in range(self.repeat):
+            payload = setup()
+            started = time.perf_counter()
+            function(payload)
+            timings.append(time.perf_counter() - started)
+
+        median = statistics.median(timings)
+        return {
+            "status": "ok",
+            "units": units,
+            "median_seconds": round(median, 6),
+            "min_seconds": round(min(timings), 6),
+            "max_seconds": round(max(timings), 6),
+            "units_per_second": round(units / median, 3) if median > 0 else None
+        }
+
+    def run(self):
+        results = {
+            "created": datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "parameters": {
+                "records": self.record_number,
+                "files": self.file_number,
+                "repeat": self.repeat,
+                "seed": self.seed
+            },
+            "stages": dict()
+        }
+
+        with tempfile.TemporaryDirectory() as directory:
+            self.write_sources(directory)
+            with LocalHTTPServer(directory) as server:
+                for name, setup, function, units in self.stages(server.base_url):
+                    stdout = sys.stdout
+                    try:
+                        results["stages"][name] = self.time_stage(setup, function, units)
+                    except Exception as e:
+                        # One broken stage shouldn't hide the numbers for the rest
+                        results["stages"][name] = {"status": "error", "error": f"{type(e).__name__}: {e}"}
+                    finally:
+                        # clean_dict_from_csv captures stdout and doesn't always hand it back
+                        sys.stdout = stdout
+
+        return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    comparison = dict()
+
+    for name, stage in results["stages"].items():
+        baseline_stage = baseline["stages"].get(name)
+        if baseline_stage is None or baseline_stage.get("status") != "ok":
+            comparison[name] = {"status": "no_baseline"}
+            continue
+        if stage["status"] != "ok":
+            comparison[name] = {"status": "regression", "error": stage["error"]}
+            continue
+
+        # Compare throughput so runs with different record counts stay comparable
+        change = stage["units_per_second"] / baseline_stage["units_per_second"] - 1
+        if change < -tolerance:
+            status = "regression"
+        elif change > tolerance:
+            status = "improvement"
+        else:
+            status = "unchanged"
+
+        comparison[name] = {
+            "status": status,
+            "baseline_units_per_second": baseline_stage["units_per_second"],
+            "units_per_second": stage["units_per_second"],
+            "change": round(change, 3)
+        }
+
+    return comparison
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the pynggdpp ingest stages")
+    parser.add_argument("--records", type=int, default=1000, help="records per synthetic collection file")
+    parser.add_argument("--files", type=int, default=50, help="metadata documents and WAF entries")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage; the median is reported")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results JSON here instead of stdout")
+    parser.add_argument("--baseline", help="results JSON from an earlier run to compare against")
+    parser.add_argument("--save-baseline", help="also write these results as a new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="fractional throughput drop allowed before a stage counts as a regression")
+    args = parser.parse_args(argv)
+
+    results = Benchmarks(
+        record_number=args.records,
+        file_number=args.files,
+        repeat=args.repeat,
+        seed=args.seed
+    ).run()
+
+    regressed = False
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            results["comparison"] = compare(results, json.load(f), tolerance=args.tolerance)
+        regressed = any(c["status"] == "regression" for c in results["comparison"].values())
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,302 @@
+import json
+import os
+import threading
+import uuid
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from types import SimpleNamespace
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalHTTPServer:
+    # Serves fixture files the way a WAF or ScienceBase file host would, Last-Modified headers included
+    def __init__(self, directory):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), partial(QuietHandler, directory=directory))
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+        return False
+
+
+class StandInStreamingBody:
+    def __init__(self, data):
+        self.stream = BytesIO(data)
+
+    def read(self, amt=None):
+        return self.stream.read(amt)
+
+
+class StandInS3:
+    def __init__(self):
+        self.buckets = dict()
+        self.uploads = dict()
+
+    def create_bucket(self, Bucket, **kwargs):
+        self.buckets.setdefault(Bucket, dict())
+        return {"Location": f"/{Bucket}"}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        if isinstance(Body, str):
+            Body = Body.encode("utf-8")
+        self.buckets.setdefault(Bucket, dict())[Key] = (bytes(Body), kwargs)
+        return {"ETag": uuid.uuid4().hex}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        data, attributes = self.buckets[Bucket][Key]
+        bucket_object = {
+            "Body": StandInStreamingBody(data),
+            "ContentLength": len(data),
+            "Metadata": attributes.get("Metadata", dict())
+        }
+        if "ContentEncoding" in attributes:
+            bucket_object["ContentEncoding"] = attributes["ContentEncoding"]
+        return bucket_object
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.buckets.get(Bucket, dict()).pop(Key, None)
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = uuid.uuid4().hex
+        self.uploads[upload_id] = (Bucket, Key, dict(), kwargs)
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, PartNumber, UploadId, Body, **kwargs):
+        self.uploads[UploadId][2][PartNumber] = bytes(Body)
+        return {"ETag": f"{UploadId}-{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        bucket_name, key_name, parts, attributes = self.uploads.pop(UploadId)
+        self.put_object(bucket_name, key_name, b"".join(parts[n] for n in sorted(parts)), **attributes)
+        return {"Key": key_name}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self.uploads.pop(UploadId, None)
+        return {}
+
+    def get_paginator(self, operation_name):
+        return StandInPaginator(self)
+
+
+class StandInPaginator:
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def paginate(self, Bucket, Prefix="", **kwargs):
+        keys = sorted(k for k in self.s3.buckets.get(Bucket, dict()) if k.startswith(Prefix))
+        for start in range(0, max(len(keys), 1), 1000):
+            page = [{"Key": k, "Size": len(self.s3.buckets[Bucket][k][0])} for k in keys[start:start + 1000]]
+            if len(page) == 0:
+                yield {}
+            else:
+                yield {"Contents": page}
+
+
+class StandInS3Object:
+    def __init__(self, s3, bucket_name, key):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+
+    def put(self, Body, **kwargs):
+        return self.s3.put_object(Bucket=self.bucket_name, Key=self.key, Body=Body, **kwargs)
+
+    def delete(self):
+        return self.s3.delete_object(Bucket=self.bucket_name, Key=self.key)
+
+
+class StandInS3Resource:
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def Object(self, bucket_name, key):
+        return StandInS3Object(self.s3, bucket_name, key)
+
+
+class StandInSQS:
+    def __init__(self):
+        self.queues = dict()
+
+    def create_queue(self, QueueName, **kwargs):
+        self.queues.setdefault(QueueName, list())
+        return {"QueueUrl": f"https://sqs.local/{QueueName}"}
+
+    def list_queues(self, **kwargs):
+        return {"QueueUrls": [f"https://sqs.local/{q}" for q in self.queues]}
+
+    def send_message(self, QueueUrl, MessageBody, MessageAttributes=None, **kwargs):
+        message_id = uuid.uuid4().hex
+        self.queues[QueueUrl.split("/")[-1]].append(
+            {
+                "MessageId": message_id,
+                "ReceiptHandle": message_id,
+                "Body": MessageBody,
+                "MessageAttributes": MessageAttributes or dict()
+            }
+        )
+        return {"MessageId": message_id}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, **kwargs):
+        messages = self.queues[QueueUrl.split("/")[-1]][:MaxNumberOfMessages]
+        if len(messages) == 0:
+            return {}
+        return {"Messages": messages}
+
+    def delete_message(self, QueueUrl, ReceiptHandle, **kwargs):
+        queue_name = QueueUrl.split("/")[-1]
+        self.queues[queue_name] = [m for m in self.queues[queue_name] if m["ReceiptHandle"] != ReceiptHandle]
+        return {}
+
+
+class StandInSerializer:
+    mimetype = "application/json"
+
+    def dumps(self, data):
+        if isinstance(data, str):
+            return data
+        return json.dumps(data, default=str)
+
+    def loads(self, s):
+        return json.loads(s)
+
+
+class StandInElasticsearch:
+    # Accepts bulk requests and encodes them exactly as the client would before they go on the wire
+    def __init__(self):
+        serializer = StandInSerializer()
+        self.transport = SimpleNamespace(
+            serializer=serializer,
+            serializers=SimpleNamespace(get_serializer=lambda mimetype: serializer)
+        )
+        self.indices = SimpleNamespace(
+            exists=lambda *args, **kwargs: True,
+            create=lambda *args, **kwargs: {"acknowledged": True},
+            delete=lambda *args, **kwargs: {"acknowledged": True}
+        )
+        self.bytes_received = 0
+        self.documents = 0
+
+    def options(self, **kwargs):
+        return self
+
+    def info(self, *args, **kwargs):
+        return {"version": {"number": "7.10.2"}}
+
+    def bulk(self, body=None, operations=None, *args, **kwargs):
+        actions = body if body is not None else operations
+        if not isinstance(actions, (str, bytes)):
+            actions = "\n".join(self.transport.serializer.dumps(a) for a in actions) + "\n"
+        if isinstance(actions, str):
+            actions = actions.encode("utf-8")
+
+        self.bytes_received += len(actions)
+        lines = actions.count(b"\n")
+        self.documents += lines // 2
+
+        return {
+            "took": 0,
+            "errors": False,
+            "items": [{"index": {"status": 201}} for _ in range(lines // 2)]
+        }
+
+    def index(self, *args, **kwargs):
+        self.documents += 1
+        return {"result": "created"}
+
+
+class StandInInsertResult:
+    def __init__(self, ids):
+        self.inserted_ids = ids
+        self.inserted_id = ids[0] if len(ids) > 0 else None
+
+
+class StandInMongoCollection:
+    def __init__(self):
+        self.documents = list()
+
+    def insert_one(self, document):
+        document.setdefault("_id", uuid.uuid4().hex)
+        self.documents.append(document)
+        return StandInInsertResult([document["_id"]])
+
+    def insert_many(self, documents):
+        ids = list()
+        for document in documents:
+            ids.extend(self.insert_one(document).inserted_ids)
+        return StandInInsertResult(ids)
+
+    def find(self, query=None, projection=None):
+        return iter(list(self.documents))
+
+    def find_one(self, query=None, projection=None):
+        for document in self.documents:
+            if all(document.get(k) == v for k, v in (query or dict()).items()):
+                return document
+        return None
+
+    def find_one_and_update(self, query, update, upsert=False, **kwargs):
+        # Just enough of the update language for the cache version stamp
+        document = self.find_one(query)
+        if document is None:
+            if not upsert:
+                return None
+            document = dict(query)
+            self.documents.append(document)
+        for k, v in update.get("$inc", dict()).items():
+            document[k] = document.get(k, 0) + v
+        document.update(update.get("$set", dict()))
+        return document
+
+
+class StandInMongo:
+    def __init__(self):
+        self.collections = dict()
+
+    def connect_mongodb(self, collection=None):
+        if collection is None:
+            return self
+        return self.collections.setdefault(collection, StandInMongoCollection())
+
+    def __getitem__(self, collection):
+        return self.connect_mongodb(collection)
+
+
+class StandInConnect:
+    # Hands out the stand-ins wherever the package would build a boto3 or Elasticsearch client
+    def __init__(self):
+        self.s3 = StandInS3()
+        self.s3_resource = StandInS3Resource(self.s3)
+        self.sqs = StandInSQS()
+        self.es = StandInElasticsearch()
+
+    def aws_client(self, service, type="client"):
+        if service == "S3":
+            return self.s3_resource if type == "resource" else self.s3
+        elif service == "SQS":
+            return self.sqs
+        raise ValueError(f"No stand-in for {service}")
+
+    def elastic_client(self):
+        return self.es
+
+
+def write_fixture(directory, name, content):
+    path = os.path.join(directory, name)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+    return path
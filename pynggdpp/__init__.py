@@ -8,6 +8,15 @@ from . import aws
 from . import sciencebase
 from . import item_process
 from . import rest_api
+from . import cache
+from . import views
+from . import snapshots
+from . import pipeline
+from . import metrics
+from . import profiling
+from . import serialization
+from . import throttle
+from . import async_api
 
 # provide version, PEP - three components ("major.minor.micro")
 __version__ = pkg_resources.require("pynggdpp")[0].version
@@ -0,0 +1,504 @@
+import asyncio
+import copy
+import os
+
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:
+    AsyncIOMotorClient = None
+
+try:
+    from elasticsearch import AsyncElasticsearch
+except ImportError:
+    AsyncElasticsearch = None
+
+from elasticsearch.exceptions import TransportError
+from pymongo import ASCENDING
+
+from .cache import cached_response
+from .metrics import MongoCommandListener, instrumented
+from .rest_api import Mongo, Search
+from .serverful import Indexes, Infrastructure, mongo_uri
+from . import serialization
+
+
+class AsyncInfrastructure:
+    def __init__(self):
+        if AsyncIOMotorClient is None:
+            raise ImportError("The async query backend requires motor (pip install pynggdpp[async])")
+
+        self.mongo_uri = mongo_uri()
+        self.mongo_client = AsyncIOMotorClient(self.mongo_uri, event_listeners=[MongoCommandListener()])
+
+    def connect_mongodb(self, collection=None):
+        db = self.mongo_client.get_database(os.environ["MONGODB_DATABASE"])
+
+        if collection is not None:
+            return db[collection]
+        else:
+            return db
+
+    def close(self):
+        self.mongo_client.close()
+
+
+def async_elastic_client():
+    if AsyncElasticsearch is None:
+        raise ImportError("The async query backend requires elasticsearch[async] (pip install pynggdpp[async])")
+
+    return AsyncElasticsearch(
+        hosts=[os.environ["AWS_HOST_Elasticsearch"]],
+        serializer=serialization.ElasticsearchSerializer()
+    )
+
+
+async def stream_records_async(records, output_format="ndjson", container="items"):
+    # rest_api.stream_records for async iterables like motor cursors and AsyncSearch.scan_index
+    if output_format == "ndjson":
+        async for record in records:
+            yield serialization.dumps(record) + "\n"
+    elif output_format == "json":
+        yield f'{{"{container}": ['
+        separator = ""
+        async for record in records:
+            yield separator + serialization.dumps(record)
+            separator = ","
+        yield "]}\n"
+    else:
+        raise ValueError(f"Unsupported export format: {output_format}")
+
+
+async def hit_sources(hits):
+    async for hit in hits:
+        yield hit["_source"]
+
+
+class AsyncMongo(Mongo):
+    # Query builders and result packages come from rest_api.Mongo; only the round trips are awaited here
+    def __init__(self, response_cache=None, serverful_infrastructure=None, count_ttl=60.0, count_limit=10000,
+                 view_max_age=3600):
+        if serverful_infrastructure is None:
+            serverful_infrastructure = AsyncInfrastructure()
+        super().__init__(
+            response_cache=response_cache,
+            serverful_infrastructure=serverful_infrastructure,
+            count_ttl=count_ttl,
+            count_limit=count_limit,
+            view_max_age=view_max_age
+        )
+
+    @instrumented("rest_api.mongo.query_collections", "mongo")
+    @cached_response
+    async def query_collections(self, q=None, ndc_collection_id=None, base_url=None):
+        ndc_collections_db = self.serverful_infrastructure.connect_mongodb(collection="ndc_collections")
+
+        query = self.collections_query(q=q, ndc_collection_id=ndc_collection_id)
+
+        return self.package_collections(
+            await ndc_collections_db.find(query).to_list(length=None),
+            ndc_collection_id=ndc_collection_id,
+            base_url=base_url
+        )
+
+    async def view_status(self, view_collection):
+        status_db = self.serverful_infrastructure.connect_mongodb(collection="ndc_view_status")
+        return await status_db.find_one({"_id": view_collection})
+
+    @instrumented("rest_api.mongo.query_files", "mongo")
+    @cached_response
+    async def query_files(self, ndc_collection_id=None, base_url=None):
+        if self.views.is_current(await self.view_status("ndc_file_summaries")):
+            ndc_file_summaries_db = self.serverful_infrastructure.connect_mongodb(collection="ndc_file_summaries")
+            query = self.file_summaries_query(ndc_collection_id=ndc_collection_id)
+            records = await ndc_file_summaries_db.find(query).sort("_id", ASCENDING).to_list(length=None)
+        else:
+            ndc_files_db = self.serverful_infrastructure.connect_mongodb(collection="ndc_files")
+            pipeline = self.views.file_summaries_pipeline(
+                ndc_collection_ids=self.collection_ids(ndc_collection_id),
+                merge=False
+            )
+            records = await ndc_files_db.aggregate(pipeline).to_list(length=None)
+
+        return self.package_file_summaries(records, ndc_collection_id=ndc_collection_id, base_url=base_url)
+
+    @instrumented("rest_api.mongo.query_organizations", "mongo")
+    @cached_response
+    async def query_organizations(self, base_url=None):
+        if self.views.is_current(await self.view_status("ndc_organizations")):
+            ndc_organizations_db = self.serverful_infrastructure.connect_mongodb(collection="ndc_organizations")
+            records = await ndc_organizations_db.find({}).sort("_id", ASCENDING).to_list(length=None)
+        else:
+            ndc_collections_db = self.serverful_infrastructure.connect_mongodb(collection="ndc_collections")
+            pipeline = self.views.organizations_pipeline(merge=False)
+            records = await ndc_collections_db.aggregate(pipeline).to_list(length=None)
+
+        return self.package_organizations(records, base_url=base_url)
+
+    async def count_items(self, collection, query):
+        key = self.count_key(collection, query)
+        hit, total = self.count_cache.get(key)
+        if hit:
+            return total
+
+        if len(query) == 0:
+            total = (await collection.estimated_document_count(), "eq")
+        else:
+            total = self.bounded_total(await collection.count_documents(query, **self.count_options()))
+
+        self.count_cache.set(key, total)
+        return total
+
+    @instrumented("rest_api.mongo.query_items", "mongo")
+    async def query_items(self, q=None, first_id=None, last_id=None, limit=10, ndc_collection_id=None, base_url=None,
+                          after=None, before=None, bbox=None, distance=None, polygon=None):
+        ndc_items = self.serverful_infrastructure.connect_mongodb(collection="ndc_items")
+
+        query, direction, anchor, limit = self.items_page_query(
+            q=q,
+            first_id=first_id,
+            last_id=last_id,
+            limit=limit,
+            ndc_collection_id=ndc_collection_id,
+            after=after,
+            before=before,
+            bbox=bbox,
+            distance=distance,
+            polygon=polygon
+        )
+
+        # The page and the total over every page don't depend on each other, so fetch them together
+        data, (total, total_relation) = await asyncio.gather(
+            ndc_items.find(query).sort("_id", direction).limit(limit + 1).to_list(length=None),
+            self.count_items(
+                ndc_items,
+                self.combine_clauses(
+                    self.items_query(
+                        q=q,
+                        ndc_collection_id=ndc_collection_id,
+                        bbox=bbox,
+                        distance=distance,
+                        polygon=polygon
+                    )
+                )
+            )
+        )
+
+        return self.package_items(
+            data,
+            limit,
+            direction,
+            anchor,
+            base_url=base_url,
+            total=total,
+            total_relation=total_relation
+        )
+
+    def export_items(self, q=None, ndc_collection_id=None, output_format="ndjson", batch_size=1000,
+                     bbox=None, distance=None, polygon=None):
+        ndc_items = self.serverful_infrastructure.connect_mongodb(collection="ndc_items")
+
+        query = self.combine_clauses(
+            self.items_query(
+                q=q,
+                ndc_collection_id=ndc_collection_id,
+                bbox=bbox,
+                distance=distance,
+                polygon=polygon
+            )
+        )
+        cursor = ndc_items.find(query, {"_id": 0}).batch_size(batch_size)
+
+        return stream_records_async(cursor, output_format=output_format, container="items")
+
+    def export_collections(self, q=None, output_format="ndjson", batch_size=1000):
+        ndc_collections_db = self.serverful_infrastructure.connect_mongodb(collection="ndc_collections")
+
+        query = self.collections_query(q=q)
+        cursor = ndc_collections_db.find(query, {"_id": 0}).batch_size(batch_size)
+
+        return stream_records_async(cursor, output_format=output_format, container="collections")
+
+    async def check_query_plans(self):
+        # Plans don't depend on the driver, so serverful.Indexes explains through pymongo on the same mongo_uri()
+        def check():
+            serverful_infrastructure = Infrastructure()
+            try:
+                return Indexes(serverful_infrastructure=serverful_infrastructure).check_query_plans(self.query_shapes())
+            finally:
+                serverful_infrastructure.mongo_client.close()
+
+        return await asyncio.get_running_loop().run_in_executor(None, check)
+
+    def close(self):
+        self.serverful_infrastructure.close()
+
+
+class AsyncSearch(Search):
+    # Query builders and result packages come from rest_api.Search; only the round trips are awaited here
+    def __init__(self, response_cache=None, query_cache_ttl=5.0, es=None, track_total_hits=None, major_version=None):
+        if es is None:
+            es = async_elastic_client()
+        super().__init__(
+            response_cache=response_cache,
+            query_cache_ttl=query_cache_ttl,
+            es=es,
+            track_total_hits=track_total_hits,
+            major_version=major_version
+        )
+
+    async def detect_major_version(self):
+        # The query builders are synchronous, so the version is looked up before any of them needs it
+        if self.major_version is None:
+            self.major_version = int((await self.es.info())["version"]["number"].split(".")[0])
+        return self.major_version
+
+    def cluster_major_version(self):
+        if self.major_version is None:
+            raise RuntimeError("AsyncSearch needs detect_major_version() awaited before building item queries")
+        return self.major_version
+
+    @instrumented("rest_api.search.index_search", "elasticsearch")
+    async def index_search(self, index_name, q, filter_path=None):
+        return await self.execute_query(index=index_name, query=self.query_string_query(q), filter_path=filter_path)
+
+    async def cached_query(self, name, params, compute):
+        if self.query_cache is None:
+            return await compute()
+
+        key = self.query_cache.make_key(name, params, {})
+        return copy.deepcopy(await self.query_cache.get_or_compute_async(key, compute))
+
+    async def fetch_index_stats(self, index_name):
+        # Both calls go out together; stats on a missing index fails, but then exists already said so
+        exists, index_stats = await asyncio.gather(
+            self.es.indices.exists(index=index_name),
+            self.es.indices.stats(index=index_name),
+            return_exceptions=True
+        )
+
+        if isinstance(exists, Exception):
+            raise exists
+        if not exists:
+            return {
+                "index_exists": False
+            }
+        if isinstance(index_stats, Exception):
+            raise index_stats
+
+        return self.package_index_stats(index_name, index_stats)
+
+    @instrumented("rest_api.search.index_stats", "elasticsearch")
+    async def index_stats(self, index_name):
+        return await self.cached_query("Search.index_stats", [index_name], lambda: self.fetch_index_stats(index_name))
+
+    @instrumented("rest_api.search.query_items", "elasticsearch")
+    async def query_items(self, q=None, collection_id=None, size=20, cursor=None, use_pit=True,
+                          bbox=None, distance=None, polygon=None):
+        await self.detect_major_version()
+        index_name = self.items_index(collection_id=collection_id)
+        query = self.items_query(q=q, bbox=bbox, distance=distance, polygon=polygon)
+
+        return await self.paged_search(
+            index=index_name,
+            query=query,
+            size=size,
+            cursor=cursor,
+            filter_path=['hits'],
+            use_pit=use_pit
+        )
+
+    async def open_point_in_time(self, index, keep_alive=None):
+        if keep_alive is None:
+            keep_alive = self.pit_keep_alive
+
+        try:
+            return (await self.es.open_point_in_time(index=index, keep_alive=keep_alive))["id"]
+        except (AttributeError, TransportError):
+            return None
+
+    async def close_point_in_time(self, pit_id):
+        if pit_id is None:
+            return
+
+        try:
+            await self.es.close_point_in_time(body={"id": pit_id})
+        except (AttributeError, TransportError):
+            pass
+
+    async def paged_search(self, index, query, size=20, cursor=None, filter_path=None, use_pit=True,
+                           keep_alive=None):
+        if keep_alive is None:
+            keep_alive = self.pit_keep_alive
+
+        search_after, pit_id, known_total = self.cursor_position(cursor)
+        if cursor is None and use_pit:
+            pit_id = await self.open_point_in_time(index, keep_alive=keep_alive)
+
+        res = await self.es.search(
+            **self.paged_search_request(
+                index,
+                query,
+                size=size,
+                search_after=search_after,
+                pit_id=pit_id,
+                filter_path=filter_path,
+                keep_alive=keep_alive,
+                known_total=known_total
+            )
+        )
+
+        res, finished_pit = self.package_page(res, size, pit_id, known_total=known_total)
+        await self.close_point_in_time(finished_pit)
+
+        return res
+
+    async def scan_index(self, index, query=None, batch_size=1000, keep_alive="1m"):
+        query = self.scan_query(query)
+
+        cursor = None
+        while True:
+            res = await self.paged_search(
+                index=index,
+                query=query,
+                size=batch_size,
+                cursor=cursor,
+                keep_alive=keep_alive
+            )
+
+            for hit in res.get("hits", {}).get("hits", []):
+                yield hit
+
+            cursor = res["next_cursor"]
+            if cursor is None:
+                break
+
+    @instrumented("rest_api.search.query_facets", "elasticsearch")
+    async def query_facets(self, q=None, collection_id=None, facets=None, size=10, date_field=None,
+                           bbox=None, distance=None, polygon=None):
+        if facets is None:
+            facets = self.default_facets()
+
+        await self.detect_major_version()
+        res = await self.es.search(
+            **self.facets_request(
+                q=q,
+                collection_id=collection_id,
+                facets=facets,
+                size=size,
+                date_field=date_field,
+                bbox=bbox,
+                distance=distance,
+                polygon=polygon
+            )
+        )
+
+        return self.package_facets(res, facets)
+
+    @instrumented("rest_api.search.query_geo_clusters", "elasticsearch")
+    async def query_geo_clusters(self, q=None, collection_id=None, zoom=4, grid="geotile_grid", size=10000,
+                                 bbox=None, distance=None, polygon=None):
+        await self.detect_major_version()
+        res = await self.es.search(
+            **self.geo_clusters_request(
+                q=q,
+                collection_id=collection_id,
+                zoom=zoom,
+                grid=grid,
+                size=size,
+                bbox=bbox,
+                distance=distance,
+                polygon=polygon
+            )
+        )
+
+        return self.package_geo_clusters(res, zoom, grid)
+
+    @instrumented("rest_api.search.query_collections", "elasticsearch")
+    @cached_response
+    async def query_collections(self, q=None, collection_id=None, size=20, base_url=None):
+        result = await self.es.search(
+            index="processed_collections",
+            size=size,
+            filter_path=['hits'],
+            body=self.with_total_hits(self.collections_query(q=q, collection_id=collection_id))
+        )
+
+        return self.package_collection_hits(result, base_url=base_url)
+
+    @instrumented("rest_api.search.query_collections_all", "elasticsearch")
+    async def query_collections_all(self):
+        async def scan_collections():
+            return [hit async for hit in self.scan_index(index="processed_collections")]
+
+        hits = await self.cached_query("Search.query_collections_all", ["processed_collections"], scan_collections)
+
+        return self.package_all_hits(hits)
+
+    @instrumented("rest_api.search.query_collection_file_reports", "elasticsearch")
+    async def query_collection_file_reports(self, ndc_collection_id, filter_path=None):
+        return await self.execute_query(
+            index="file_reports",
+            query=self.file_reports_query(ndc_collection_id),
+            filter_path=filter_path
+        )
+
+    @instrumented("rest_api.search.query_file_metadata", "elasticsearch")
+    async def query_file_metadata(self, aws_s3_key, filter_path=None):
+        return await self.execute_query(
+            index="processing_log",
+            query=self.file_metadata_query(aws_s3_key),
+            filter_path=filter_path
+        )
+
+    def export_items(self, q=None, collection_id=None, output_format="ndjson", batch_size=1000,
+                     bbox=None, distance=None, polygon=None):
+        async def item_hits():
+            await self.detect_major_version()
+            async for hit in self.scan_index(
+                index=self.items_index(collection_id=collection_id),
+                query=self.items_query(q=q, bbox=bbox, distance=distance, polygon=polygon),
+                batch_size=batch_size
+            ):
+                yield hit
+
+        return stream_records_async(hit_sources(item_hits()), output_format=output_format, container="items")
+
+    def export_collections(self, q=None, output_format="ndjson", batch_size=1000):
+        hits = self.scan_index(
+            index="processed_collections",
+            query=self.collections_query(q=q),
+            batch_size=batch_size
+        )
+
+        return stream_records_async(hit_sources(hits), output_format=output_format, container="collections")
+
+    @instrumented("rest_api.search.execute_query", "elasticsearch")
+    async def execute_query(self, query, index, size=20, filter_path=None, cursor=None, paginate=False,
+                          use_pit=True):
+        if cursor is not None or paginate:
+            return await self.paged_search(
+                index=index,
+                query=query,
+                size=size,
+                cursor=cursor,
+                filter_path=filter_path,
+                use_pit=use_pit
+            )
+
+        if filter_path is None:
+            filter_path = self.default_filter_path
+
+        query = self.with_total_hits(query)
+        return await self.cached_query(
+            "Search.execute_query",
+            [query, index, size, filter_path],
+            lambda: self.es.search(
+                index=index,
+                size=size,
+                filter_path=filter_path,
+                body=query
+            )
+        )
+
+    async def close(self):
+        await self.es.close()
@@ -1,14 +1,61 @@
 import os
-import json
+import gzip
+import uuid
+import zlib
+from collections import OrderedDict
 from io import BytesIO
 from urllib.parse import urlsplit
 from botocore.exceptions import ClientError
 
 import boto3
 
-import requests
 from elasticsearch import Elasticsearch
 from elasticsearch import helpers
+from elasticsearch.exceptions import RequestError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .metrics import metrics
+from .throttle import http_get
+from . import serialization
+
+
+def check_compression(compression):
+    if compression not in [None, "gzip", "zstd"]:
+        raise ValueError(f"Unsupported compression: {compression}")
+    if compression == "zstd" and zstandard is None:
+        raise ImportError("zstd compression requires zstandard (pip install pynggdpp[zstd])")
+    return compression
+
+
+def compress_bytes(data, compression):
+    if compression == "gzip":
+        return gzip.compress(data)
+    elif compression == "zstd":
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def compressor_for(compression):
+    # Incremental compressors for bodies written a part at a time
+    if compression == "gzip":
+        return zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    elif compression == "zstd":
+        return zstandard.ZstdCompressor().compressobj()
+    return None
+
+
+def decompressing_stream(body, content_encoding):
+    if content_encoding == "gzip":
+        return gzip.GzipFile(fileobj=body, mode="rb")
+    elif content_encoding == "zstd":
+        if zstandard is None:
+            raise ImportError("Reading zstd objects requires zstandard (pip install pynggdpp[zstd])")
+        return zstandard.ZstdDecompressor().stream_reader(body)
+    return body
 
 
 class Connect:
@@ -28,52 +75,90 @@ class Connect:
                 return boto3.resource(service.lower())
 
     def elastic_client(self):
-        return Elasticsearch(hosts=[os.environ["AWS_HOST_Elasticsearch"]])
+        return Elasticsearch(
+            hosts=[os.environ["AWS_HOST_Elasticsearch"]],
+            serializer=serialization.ElasticsearchSerializer()
+        )
 
 
 class Search:
     def __init__(self):
         self.aws = Connect()
         self.es = self.aws.elastic_client()
+        self.major_version = None
+
+    def cluster_major_version(self):
+        if self.major_version is None:
+            self.major_version = int(self.es.info()["version"]["number"].split(".")[0])
+        return self.major_version
+
+    def uses_mapping_types(self):
+        # Mapping types are gone from 7.0 on; a custom doc_type there is rejected outright
+        return self.cluster_major_version() < 7
+
+    def type_args(self, doc_type):
+        if self.uses_mapping_types():
+            return {"doc_type": doc_type}
+        return {}
 
     def create_es_index(self, index_name, doc_type="ndc_collection_mapping"):
         responses = list()
-        body = self.ndc_index_mapping(doc_type=doc_type)
-        if self.es.indices.exists(index_name):
-            responses.append(self.es.indices.delete(index=index_name))
-        responses.append(self.es.indices.create(index=index_name, body=body))
+        body = self.ndc_index_mapping(doc_type=doc_type, typed=self.uses_mapping_types())
+        with metrics.timed("es.create_index", index_name):
+            if self.es.indices.exists(index_name):
+                responses.append(self.es.indices.delete(index=index_name))
+            responses.append(self.es.indices.create(index=index_name, body=body))
         return responses
 
+    def ensure_es_index(self, index_name, doc_type="ndc_collection_mapping"):
+        # Unlike create_es_index this never deletes, so concurrent writers can all call it safely
+        body = self.ndc_index_mapping(doc_type=doc_type, typed=self.uses_mapping_types())
+        with metrics.timed("es.create_index", index_name):
+            try:
+                return self.es.indices.create(index=index_name, body=body)
+            except RequestError as e:
+                if e.error == "resource_already_exists_exception":
+                    return None
+                raise
+
     def bulk_data_generator(self, index_name, doc_type, bulk_data):
+        typed = self.uses_mapping_types()
         for ndc_record in bulk_data:
-            yield {
+            if doc_type == "ndc_collection_item" and "ndc_item_id" not in ndc_record:
+                ndc_record = dict(ndc_record, ndc_item_id=str(uuid.uuid4()))
+            action = {
                 "_index": index_name,
-                "_type": doc_type,
                 "_source": ndc_record
             }
+            if typed:
+                action["_type"] = doc_type
+            yield action
 
     def bulk_build_es_index(self, index_name, doc_type, bulk_data):
         if not self.es.indices.exists(index_name):
-            self.create_es_index(index_name)
-        r = helpers.bulk(
-            self.es,
-            self.bulk_data_generator(
-                index_name=index_name,
-                doc_type=doc_type,
-                bulk_data=bulk_data
+            self.ensure_es_index(index_name, doc_type=doc_type)
+        with metrics.timed("es.bulk", index_name):
+            r = helpers.bulk(
+                self.es,
+                self.bulk_data_generator(
+                    index_name=index_name,
+                    doc_type=doc_type,
+                    bulk_data=bulk_data
+                )
             )
-        )
         return r
 
     def index_record(self, index_name, doc_type, doc):
-        r = self.es.index(index=index_name, doc_type=doc_type, body=doc)
+        with metrics.timed("es.index", index_name):
+            r = self.es.index(index=index_name, body=doc, **self.type_args(doc_type))
         return r
 
     def update_record(self, index_name, doc_type, doc_id, doc):
-        r = self.es.update(index=index_name, doc_type=doc_type, id=doc_id, body=doc)
+        with metrics.timed("es.update", index_name):
+            r = self.es.update(index=index_name, id=doc_id, body=doc, **self.type_args(doc_type))
         return r
 
-    def ndc_index_mapping(self, doc_type):
+    def ndc_index_mapping(self, doc_type, typed=True):
         # Turn this into something that pulls mappings from a dynamic online registry eventually
         create_index_request = {
             "settings": {
@@ -82,6 +167,24 @@ class Search:
                 "index.mapping.ignore_malformed": True
             }
         }
+        if doc_type == "ndc_collection_item":
+            # Spatial queries need ndc_geopoint mapped as a geo_point before the first document lands
+            mapping = {
+                "properties": {
+                    "ndc_geopoint": {
+                        "type": "geo_point"
+                    },
+                    # Paging tiebreaker where point in time isn't available; keywords sort from doc values
+                    "ndc_item_id": {
+                        "type": "keyword"
+                    }
+                }
+            }
+            # 6.x wants the mapping under its type name; 7.x only accepts it typeless
+            if typed:
+                mapping = {doc_type: mapping}
+            create_index_request["mappings"] = mapping
+
         if doc_type == "ndc_collection_item" and 0 == 1:
             create_index_request["mappings"] = {
                     doc_type: {
@@ -133,8 +236,8 @@ class Search:
         return create_index_request
 
     def map_index(self, index_name, doc_type="ndc_collection_item"):
-        mapping = self.ndc_index_mapping(doc_type=doc_type)
-        r = self.es.indices.put_mapping(index=index_name, body=mapping, doc_type=doc_type)
+        mapping = self.ndc_index_mapping(doc_type=doc_type, typed=False).get("mappings", {})
+        r = self.es.indices.put_mapping(index=index_name, body=mapping, **self.type_args(doc_type))
         return r
 
     def enable_field_data(self, index_name, field_name, doc_type):
@@ -146,10 +249,11 @@ class Search:
                 }
             }
         }
-        return self.es.indices.put_mapping(index=index_name, body=mapping, doc_type=doc_type)
+        return self.es.indices.put_mapping(index=index_name, body=mapping, **self.type_args(doc_type))
 
     def query_index(self, index_name, query, clean_results=True):
-        result = self.es.search(index=index_name, body=query)
+        with metrics.timed("es.search", index_name):
+            result = self.es.search(index=index_name, body=query)
 
         if not clean_results:
             return result
@@ -160,12 +264,99 @@ class Search:
                 return [r["_source"] for r in result["hits"]["hits"]]
 
 
+class MultipartUpload:
+    def __init__(self, s3, bucket_name, key_name, part_size=8 * 1024 * 1024, content_type=None, compression=None):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key_name = key_name
+        # S3 wants every part but the last to be at least 5 MB
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+        self.buffer = bytearray()
+        self.parts = list()
+        self.compressor = compressor_for(check_compression(compression))
+
+        upload_args = {"Bucket": bucket_name, "Key": key_name}
+        if content_type is not None:
+            upload_args["ContentType"] = content_type
+        if compression is not None:
+            upload_args["ContentEncoding"] = compression
+        self.upload_id = self.s3.create_multipart_upload(**upload_args)["UploadId"]
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        if self.compressor is None:
+            self.buffer.extend(data)
+        else:
+            self.buffer.extend(self.compressor.compress(data))
+        if len(self.buffer) >= self.part_size:
+            self.upload_part()
+
+        return len(data)
+
+    def upload_part(self):
+        part_number = len(self.parts) + 1
+        with metrics.timed("s3.upload_part", self.bucket_name) as measurement:
+            measurement.bytes_sent = len(self.buffer)
+            response = self.s3.upload_part(
+                Bucket=self.bucket_name,
+                Key=self.key_name,
+                PartNumber=part_number,
+                UploadId=self.upload_id,
+                Body=bytes(self.buffer)
+            )
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        self.buffer = bytearray()
+
+    def close(self):
+        if self.compressor is not None:
+            self.buffer.extend(self.compressor.flush())
+
+        if len(self.buffer) > 0 or len(self.parts) == 0:
+            self.upload_part()
+
+        return self.s3.complete_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=self.key_name,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts}
+        )
+
+    def abort(self):
+        return self.s3.abort_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=self.key_name,
+            UploadId=self.upload_id
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
 class Storage:
-    def __init__(self):
+    def __init__(self, compression=None):
         self.aws = Connect()
         self.s3 = self.aws.aws_client("S3")
         self.s3_resource = self.aws.aws_client("S3", type="resource")
 
+        # Default encoding for JSON and cached source files; NDC_S3_COMPRESSION sets it for every Storage
+        if compression is None:
+            compression = os.environ.get("NDC_S3_COMPRESSION") or None
+        self.compression = check_compression(compression)
+
+    def write_compression(self, compression):
+        if compression == "default":
+            return self.compression
+        return check_compression(compression)
+
     def url_to_s3_key(self, url):
         parsed_url = urlsplit(url)
         return f"{parsed_url.netloc}{parsed_url.path}"
@@ -173,41 +364,60 @@ class Storage:
     def get_s3_file(self, key, bucket_name='ndc-collection-files', return_type='bytes'):
         self.s3.create_bucket(Bucket=bucket_name)
 
-        try:
-            bucket_object = self.s3.get_object(Bucket=bucket_name, Key=key)
-        except ClientError as e:
-            if e.response["Error"]["Code"] == "NoSuchKey":
-                return None
-            else:
-                return str(e)
-
-        if return_type == "raw":
-            return bucket_object
-        elif return_type == "bytes":
-            return BytesIO(bucket_object['Body'].read())
+        with metrics.timed("s3.get_object", bucket_name) as measurement:
+            try:
+                bucket_object = self.s3.get_object(Bucket=bucket_name, Key=key)
+            except ClientError as e:
+                if e.response["Error"]["Code"] == "NoSuchKey":
+                    return None
+                else:
+                    measurement.error = True
+                    return str(e)
+
+            measurement.bytes_received = bucket_object.get("ContentLength", 0)
+
+            # Compressed objects are decoded on the way out, so callers see the same bytes they wrote
+            content_encoding = bucket_object.get("ContentEncoding")
+            if content_encoding in ["gzip", "zstd"]:
+                bucket_object["Body"] = decompressing_stream(bucket_object["Body"], content_encoding)
+                del bucket_object["ContentEncoding"]
+                bucket_object.pop("ContentLength", None)
+
+            # Raw callers stream the body themselves; everything else is read here so the timing covers the transfer
+            if return_type == "raw":
+                return bucket_object
+            body = bucket_object['Body'].read()
+
+        if return_type == "bytes":
+            return BytesIO(body)
         elif return_type == "dict":
-            return json.loads(BytesIO(bucket_object['Body'].read()).read())
+            return serialization.loads(body)
         elif return_type == "lines":
             try:
-                return bucket_object['Body'].read().decode('utf-8').splitlines(True)
+                return body.decode('utf-8').splitlines(True)
             except UnicodeDecodeError:
                 return "File encoding problem encountered"
 
     def remove_s3_object(self, key, bucket_name='ndc-file-cache'):
-        response = self.s3_resource.Object(bucket_name, key).delete()
+        with metrics.timed("s3.delete_object", bucket_name):
+            response = self.s3_resource.Object(bucket_name, key).delete()
 
         return response
 
-    def transfer_file_to_s3(self, source_url, bucket_name="ndc-file-cache", key_name=None):
+    def transfer_file_to_s3(self, source_url, bucket_name="ndc-file-cache", key_name=None, compression="default"):
         if key_name is None:
-            key_name = url_to_s3_key(source_url)
+            key_name = self.url_to_s3_key(source_url)
 
         self.s3.create_bucket(Bucket=bucket_name)
         bucket_object = self.s3_resource.Object(bucket_name, key_name)
 
-        file_object = requests.get(source_url).content
+        file_object = http_get(source_url).content
+
+        put_args = self.encoded_body(file_object, self.write_compression(compression))
 
-        bucket_response = bucket_object.put(Body=file_object)
+        with metrics.timed("s3.put_object", bucket_name) as measurement:
+            measurement.bytes_sent = len(put_args["Body"])
+            bucket_response = bucket_object.put(**put_args)
 
         return {
             "key_name": key_name,
@@ -215,12 +425,52 @@ class Storage:
             "bucket_response": bucket_response
         }
 
-    def put_json_to_s3(self, source_data, key_name, bucket_name):
+    def encoded_body(self, body, compression):
+        if compression is None:
+            return {"Body": body}
+
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        return {
+            "Body": compress_bytes(body, compression),
+            "ContentEncoding": compression
+        }
+
+    def put_json_to_s3(self, source_data, key_name, bucket_name, compression="default"):
         self.s3.create_bucket(Bucket=bucket_name)
         bucket_object = self.s3_resource.Object(bucket_name, key_name)
-        bucket_response = bucket_object.put(Body=json.dumps(source_data))
+
+        put_args = self.encoded_body(serialization.dumpb(source_data), self.write_compression(compression))
+        put_args["ContentType"] = "application/json"
+
+        with metrics.timed("s3.put_object", bucket_name) as measurement:
+            measurement.bytes_sent = len(put_args["Body"])
+            bucket_response = bucket_object.put(**put_args)
         return bucket_response
 
+    def put_bytes_to_s3(self, source_bytes, key_name, bucket_name, content_type=None, compression=None):
+        self.s3.create_bucket(Bucket=bucket_name)
+        bucket_object = self.s3_resource.Object(bucket_name, key_name)
+
+        # Off unless asked for, since most binary payloads (Parquet, images) are compressed already
+        put_args = self.encoded_body(source_bytes, self.write_compression(compression))
+        if content_type is not None:
+            put_args["ContentType"] = content_type
+
+        with metrics.timed("s3.put_object", bucket_name) as measurement:
+            measurement.bytes_sent = len(put_args["Body"])
+            return bucket_object.put(**put_args)
+
+    def open_multipart_upload(self, key_name, bucket_name, content_type=None, compression=None):
+        self.s3.create_bucket(Bucket=bucket_name)
+        return MultipartUpload(
+            self.s3,
+            bucket_name,
+            key_name,
+            content_type=content_type,
+            compression=self.write_compression(compression)
+        )
+
     def check_s3_file(self, key_name, bucket_name):
         try:
             self.s3.Object(bucket_name, key_name)
@@ -230,75 +480,181 @@ class Storage:
         else:
             return True
 
-    def list_s3_keys(self, bucket_name):
-        bucket_list = self.s3.list_objects(Bucket=bucket_name)
-        if "Contents" in bucket_list.keys():
-            return bucket_list['Contents']
-        else:
-            return list()
+    def list_s3_keys(self, bucket_name, prefix=None):
+        list_args = {"Bucket": bucket_name}
+        if prefix is not None:
+            list_args["Prefix"] = prefix
+
+        keys = list()
+        with metrics.timed("s3.list_objects", bucket_name):
+            for bucket_list in self.s3.get_paginator("list_objects").paginate(**list_args):
+                if "Contents" in bucket_list.keys():
+                    keys.extend(bucket_list['Contents'])
+
+        return keys
 
 
 class Messaging:
-    def __init__(self):
+    def __init__(self, claim_check_bytes=None, claim_check_bucket="ndc-message-payloads"):
         aws = Connect()
         self.sqs = aws.aws_client("SQS")
         self.storage = Storage()
 
+        # SQS caps a message at 256 KB including attributes, so anything near that goes to S3 instead
+        if claim_check_bytes is None:
+            claim_check_bytes = int(os.environ.get("NDC_CLAIM_CHECK_BYTES", 200 * 1024))
+        self.claim_check_bytes = claim_check_bytes
+        self.claim_check_bucket = claim_check_bucket
+
+        # Pointers for received messages, so delete_message can clean up without being handed one
+        self.claim_checks = OrderedDict()
+
     def list_queues(self):
         queues = self.sqs.list_queues()
         return [q.split("/")[-1] for q in queues["QueueUrls"]]
 
-    def get_message(self, QueueName):
-        QueueUrl = self.sqs.create_queue(QueueName=QueueName)["QueueUrl"]
-
-        response = self.sqs.receive_message(
-            QueueUrl=QueueUrl,
-            AttributeNames=[
-                'SentTimestamp'
-            ],
-            MaxNumberOfMessages=1,
-            MessageAttributeNames=[
-                'All'
-            ],
-            VisibilityTimeout=0,
-            WaitTimeSeconds=0
-        )
-
-        if "Messages" not in response.keys() or len(response['Messages']) == 0:
+    def claim_check(self, raw_message):
+        attributes = raw_message.get("MessageAttributes") or dict()
+        if "ndc_claim_check" not in attributes:
             return None
 
+        bucket_name, key_name = attributes["ndc_claim_check"]["StringValue"].split("/", 1)
+        return {
+            "bucket_name": bucket_name,
+            "key_name": key_name
+        }
+
+    def resolve_message(self, raw_message):
         message = {
-            "ReceiptHandle": response['Messages'][0]['ReceiptHandle'],
-            "Body": json.loads(response['Messages'][0]['Body'])
+            "ReceiptHandle": raw_message['ReceiptHandle']
         }
 
+        claim_check = self.claim_check(raw_message)
+        if claim_check is None:
+            message["Body"] = serialization.loads(raw_message['Body'])
+        else:
+            body = self.storage.get_s3_file(
+                claim_check["key_name"],
+                bucket_name=claim_check["bucket_name"],
+                return_type="dict"
+            )
+            # A missing or unreadable payload must not reach consumers as if it were the record; the message
+            # stays on the queue and comes back after its visibility timeout
+            claim_check_path = f"s3://{claim_check['bucket_name']}/{claim_check['key_name']}"
+            if body is None:
+                raise FileNotFoundError(f"No claim-checked message body at {claim_check_path}")
+            elif isinstance(body, str):
+                raise OSError(f"Could not read claim-checked message body {claim_check_path}: {body}")
+
+            message["Body"] = body
+            message["ClaimCheck"] = claim_check
+
+            self.claim_checks[message["ReceiptHandle"]] = claim_check
+            while len(self.claim_checks) > 1000:
+                self.claim_checks.popitem(last=False)
+
         return message
 
+    def receive_messages(self, QueueName, max_messages=1, visibility_timeout=0, wait_seconds=0):
+        QueueUrl = self.sqs.create_queue(QueueName=QueueName)["QueueUrl"]
+
+        with metrics.timed("sqs.receive_message", QueueName) as measurement:
+            response = self.sqs.receive_message(
+                QueueUrl=QueueUrl,
+                AttributeNames=[
+                    'SentTimestamp'
+                ],
+                MaxNumberOfMessages=max_messages,
+                MessageAttributeNames=[
+                    'All'
+                ],
+                VisibilityTimeout=visibility_timeout,
+                WaitTimeSeconds=wait_seconds
+            )
+            measurement.bytes_received = sum(len(m['Body']) for m in response.get('Messages', []))
+
+        if "Messages" not in response.keys():
+            return list()
+
+        return [self.resolve_message(m) for m in response['Messages']]
+
+    def get_message(self, QueueName):
+        messages = self.receive_messages(QueueName, max_messages=1)
+
+        if len(messages) == 0:
+            return None
+
+        return messages[0]
+
+    def get_messages(self, QueueName, max_messages=10, visibility_timeout=0, wait_seconds=0):
+        # SQS hands back at most 10 messages per receive
+        return self.receive_messages(
+            QueueName,
+            max_messages=min(max_messages, 10),
+            visibility_timeout=visibility_timeout,
+            wait_seconds=wait_seconds
+        )
+
     def post_message(self, QueueName, identifier, body):
         QueueUrl = self.sqs.create_queue(QueueName=QueueName)["QueueUrl"]
 
-        response = self.sqs.send_message(
-            QueueUrl=QueueUrl,
-            MessageAttributes={
-                'identifier': {
-                    'DataType': 'String',
-                    'StringValue': identifier
+        message_body = serialization.dumps(body)
+        message_attributes = {
+            'identifier': {
+                'DataType': 'String',
+                'StringValue': identifier
+            }
+        }
+
+        if len(message_body.encode("utf-8")) > self.claim_check_bytes:
+            key_name = f"{QueueName}/{uuid.uuid4()}.json"
+            self.storage.put_bytes_to_s3(
+                message_body.encode("utf-8"),
+                key_name=key_name,
+                bucket_name=self.claim_check_bucket,
+                content_type="application/json",
+                compression=self.storage.compression
+            )
+            message_attributes['ndc_claim_check'] = {
+                'DataType': 'String',
+                'StringValue': f"{self.claim_check_bucket}/{key_name}"
+            }
+            message_body = serialization.dumps(
+                {
+                    "ndc_claim_check": {
+                        "bucket_name": self.claim_check_bucket,
+                        "key_name": key_name
+                    }
                 }
-            },
-            MessageBody=(
-                json.dumps(body)
             )
-        )
+
+        with metrics.timed("sqs.send_message", QueueName) as measurement:
+            measurement.bytes_sent = len(message_body)
+            response = self.sqs.send_message(
+                QueueUrl=QueueUrl,
+                MessageAttributes=message_attributes,
+                MessageBody=(
+                    message_body
+                )
+            )
 
         return response['MessageId']
 
-    def delete_message(self, QueueName, ReceiptHandle):
+    def delete_message(self, QueueName, ReceiptHandle, ClaimCheck=None):
         QueueUrl = self.sqs.create_queue(QueueName=QueueName)["QueueUrl"]
 
-        self.sqs.delete_message(
-            QueueUrl=QueueUrl,
-            ReceiptHandle=ReceiptHandle
-        )
+        with metrics.timed("sqs.delete_message", QueueName):
+            self.sqs.delete_message(
+                QueueUrl=QueueUrl,
+                ReceiptHandle=ReceiptHandle
+            )
 
-        return ReceiptHandle
+        # The payload goes only once the message itself is gone
+        if ClaimCheck is None:
+            ClaimCheck = self.claim_checks.pop(ReceiptHandle, None)
+        else:
+            self.claim_checks.pop(ReceiptHandle, None)
+        if ClaimCheck is not None:
+            self.storage.remove_s3_object(ClaimCheck["key_name"], bucket_name=ClaimCheck["bucket_name"])
 
+        return ReceiptHandle
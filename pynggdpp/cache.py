@@ -0,0 +1,462 @@
+import asyncio
+import copy
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+
+import requests
+from pymongo import ReturnDocument
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from .serverful import Infrastructure
+from .throttle import http_get
+
+
+class LRUCache:
+    def __init__(self, max_entries=1024, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return False, None
+
+            value, expires = self.entries[key]
+            if expires is not None and expires < time.monotonic():
+                del self.entries[key]
+                return False, None
+
+            self.entries.move_to_end(key)
+            return True, value
+
+    def set(self, key, value):
+        if self.ttl is None:
+            expires = None
+        else:
+            expires = time.monotonic() + self.ttl
+
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class MongoCache:
+    def __init__(self, collection="ndc_response_cache", ttl=3600, serverful_infrastructure=None):
+        if serverful_infrastructure is None:
+            serverful_infrastructure = Infrastructure()
+        self.ttl = ttl
+        self.cache_db = serverful_infrastructure.connect_mongodb(collection=collection)
+
+    def get(self, key):
+        cached_response = self.cache_db.find_one(
+            {
+                "_id": key,
+                "cached": {"$gte": datetime.utcnow() - timedelta(seconds=self.ttl)}
+            }
+        )
+
+        if cached_response is None:
+            return False, None
+        else:
+            return True, cached_response["value"]
+
+    def set(self, key, value):
+        self.cache_db.replace_one(
+            {"_id": key},
+            {
+                "_id": key,
+                "value": value,
+                "cached": datetime.utcnow()
+            },
+            upsert=True
+        )
+
+    def clear(self):
+        self.cache_db.delete_many({})
+
+
+class DiskCache:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def make_key(self, content, *parts):
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+
+        key_hash = hashlib.sha256(content)
+        for part in parts:
+            key_hash.update(json.dumps(part, sort_keys=True, default=str).encode("utf-8"))
+
+        return key_hash.hexdigest()
+
+    def path(self, key):
+        # Fan out on the first two characters so no single directory ends up with every entry
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key):
+        try:
+            with open(self.path(key), "r", encoding="utf-8") as f:
+                return True, json.load(f)
+        except (OSError, ValueError):
+            return False, None
+
+    def set(self, key, value):
+        entry_path = self.path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+
+        # Write then rename, so worker processes sharing the directory never read a partial entry
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(entry_path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(value, f, default=str)
+            os.replace(temp_path, entry_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+
+
+class DownloadCache:
+    def __init__(self, directory, max_bytes=2 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        # The index lives in SQLite so worker processes sharing the directory see each other's entries
+        self.lock = threading.Lock()
+        self.index = sqlite3.connect(os.path.join(directory, "index.sqlite"), timeout=30, check_same_thread=False)
+        with self.index:
+            self.index.execute(
+                "CREATE TABLE IF NOT EXISTS downloads ("
+                "url TEXT PRIMARY KEY, final_url TEXT, file_name TEXT, etag TEXT, last_modified TEXT, "
+                "headers TEXT, size INTEGER, last_used REAL)"
+            )
+            self.index.execute("CREATE INDEX IF NOT EXISTS downloads_last_used ON downloads (last_used)")
+
+    @classmethod
+    def from_environment(cls):
+        # NDC_DOWNLOAD_CACHE turns the cache on for every Links and Files instance that isn't handed one
+        directory = os.environ.get("NDC_DOWNLOAD_CACHE")
+        if directory is None:
+            return None
+
+        return cls(directory, max_bytes=int(os.environ.get("NDC_DOWNLOAD_CACHE_BYTES", 2 * 1024 ** 3)))
+
+    def file_path(self, url):
+        return os.path.join(self.directory, hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+    def lookup(self, url):
+        with self.lock:
+            row = self.index.execute(
+                "SELECT final_url, file_name, etag, last_modified, headers FROM downloads WHERE url = ?",
+                (url,)
+            ).fetchone()
+
+        if row is None or not os.path.exists(os.path.join(self.directory, row[1])):
+            return None
+
+        return {
+            "final_url": row[0],
+            "file_name": row[1],
+            "etag": row[2],
+            "last_modified": row[3],
+            "headers": json.loads(row[4])
+        }
+
+    def cached_response(self, url, entry):
+        with open(os.path.join(self.directory, entry["file_name"]), "rb") as f:
+            content = f.read()
+
+        with self.lock, self.index:
+            self.index.execute("UPDATE downloads SET last_used = ? WHERE url = ?", (time.time(), url))
+
+        # Callers get the same kind of object either way
+        response = requests.Response()
+        response._content = content
+        response.status_code = 200
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response.url = entry["final_url"]
+        response.encoding = get_encoding_from_headers(response.headers)
+
+        return response
+
+    def store(self, url, response):
+        file_path = self.file_path(url)
+
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(response.content)
+            os.replace(temp_path, file_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+        with self.lock, self.index:
+            self.index.execute(
+                "INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    response.url,
+                    os.path.basename(file_path),
+                    response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"),
+                    json.dumps(dict(response.headers)),
+                    len(response.content),
+                    time.time()
+                )
+            )
+
+        self.evict()
+
+    def evict(self):
+        with self.lock, self.index:
+            total_bytes = self.index.execute("SELECT COALESCE(SUM(size), 0) FROM downloads").fetchone()[0]
+            if total_bytes <= self.max_bytes:
+                return
+
+            # Least recently used first, until we're back under the cap
+            evicted = list()
+            for url, file_name, size in self.index.execute(
+                    "SELECT url, file_name, size FROM downloads ORDER BY last_used"
+            ).fetchall():
+                if total_bytes <= self.max_bytes:
+                    break
+                evicted.append((url, file_name))
+                total_bytes -= size
+
+            self.index.executemany("DELETE FROM downloads WHERE url = ?", [(url,) for url, _ in evicted])
+
+        for _, file_name in evicted:
+            try:
+                os.remove(os.path.join(self.directory, file_name))
+            except OSError:
+                pass
+
+    def get(self, url, **kwargs):
+        entry = self.lookup(url)
+
+        headers = dict(kwargs.pop("headers", None) or dict())
+        if entry is not None:
+            if entry["etag"] is not None:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"] is not None:
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = http_get(url, headers=headers, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            return self.cached_response(url, entry)
+
+        # Without a validator there's no cheap way to know the copy is still good, so don't keep it
+        if response.status_code == 200 and ("ETag" in response.headers or "Last-Modified" in response.headers):
+            self.store(url, response)
+
+        return response
+
+    def clear(self):
+        with self.lock, self.index:
+            file_names = [r[0] for r in self.index.execute("SELECT file_name FROM downloads").fetchall()]
+            self.index.execute("DELETE FROM downloads")
+
+        for file_name in file_names:
+            try:
+                os.remove(os.path.join(self.directory, file_name))
+            except OSError:
+                pass
+
+
+class CacheVersion:
+    def __init__(self, name="ndc_catalog", check_interval=1.0, serverful_infrastructure=None):
+        if serverful_infrastructure is None:
+            serverful_infrastructure = Infrastructure()
+        self.name = name
+        self.check_interval = check_interval
+        self.version_db = serverful_infrastructure.connect_mongodb(collection="ndc_cache_version")
+        self.version = None
+        self.checked = 0
+
+    def current(self):
+        # Only look the stamp up once per check_interval so cache hits stay in memory
+        if self.version is None or time.monotonic() - self.checked > self.check_interval:
+            version_record = self.version_db.find_one({"_id": self.name})
+            if version_record is None:
+                self.version = 0
+            else:
+                self.version = version_record["version"]
+            self.checked = time.monotonic()
+
+        return self.version
+
+    def bump(self):
+        version_record = self.version_db.find_one_and_update(
+            {"_id": self.name},
+            {
+                "$inc": {"version": 1},
+                "$set": {"bumped": datetime.utcnow()}
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        self.version = version_record["version"]
+        self.checked = time.monotonic()
+
+        return self.version
+
+
+class ResponseCache:
+    def __init__(self, local=None, shared=None, version=None, ttl=300):
+        if local is None:
+            local = LRUCache(ttl=ttl)
+        # Without an expiry or a version stamp to retire them, entries would be served forever
+        if local.ttl is None and version is None:
+            raise ValueError("ResponseCache needs a local cache with a ttl or a CacheVersion")
+        self.local = local
+        self.shared = shared
+        self.version = version
+        self.in_flight = dict()
+        self.async_in_flight = dict()
+        self.lock = threading.Lock()
+
+    def make_key(self, name, args, kwargs):
+        if self.version is None:
+            version = 0
+        else:
+            version = self.version.current()
+
+        params = json.dumps([args, kwargs], sort_keys=True, default=str)
+
+        return f"{name}:{version}:{params}"
+
+    def get_or_compute(self, key, compute):
+        hit, value = self.local.get(key)
+        if hit:
+            return value
+
+        # Single flight: the first caller for a key computes it and everyone else waits on its result
+        with self.lock:
+            flight = self.in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = {"done": threading.Event()}
+                self.in_flight[key] = flight
+
+        if not leader:
+            flight["done"].wait()
+            if "error" in flight:
+                raise flight["error"]
+            return flight["value"]
+
+        try:
+            hit = False
+            if self.shared is not None:
+                hit, value = self.shared.get(key)
+
+            if not hit:
+                value = compute()
+                if self.shared is not None:
+                    self.shared.set(key, value)
+
+            self.local.set(key, value)
+            flight["value"] = value
+            return value
+        except Exception as e:
+            flight["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            flight["done"].set()
+
+    async def get_or_compute_async(self, key, compute):
+        # The same single flight for coroutines: waiters share the leader's future instead of a thread event
+        hit, value = self.local.get(key)
+        if hit:
+            return value
+
+        flight = self.async_in_flight.get(key)
+        if flight is not None:
+            return await asyncio.shield(flight)
+
+        loop = asyncio.get_running_loop()
+        flight = loop.create_future()
+        self.async_in_flight[key] = flight
+
+        try:
+            hit = False
+            if self.shared is not None:
+                # The shared cache talks to Mongo synchronously, so keep it off the event loop
+                hit, value = await loop.run_in_executor(None, self.shared.get, key)
+
+            if not hit:
+                value = await compute()
+                if self.shared is not None:
+                    await loop.run_in_executor(None, self.shared.set, key, value)
+
+            self.local.set(key, value)
+            flight.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            # The leader was cancelled, not the work; followers get the cancellation rather than waiting forever
+            flight.cancel()
+            raise
+        except BaseException as e:
+            flight.set_exception(e)
+            # Nobody may be waiting, and an unretrieved exception would be logged at garbage collection
+            flight.exception()
+            raise
+        finally:
+            self.async_in_flight.pop(key, None)
+
+    def clear(self):
+        self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+
+def cached_response(method):
+    if asyncio.iscoroutinefunction(method):
+        @wraps(method)
+        async def async_wrapper(self, *args, **kwargs):
+            response_cache = getattr(self, "response_cache", None)
+            if response_cache is None:
+                return await method(self, *args, **kwargs)
+
+            key = response_cache.make_key(f"{type(self).__name__}.{method.__name__}", args, kwargs)
+            return copy.deepcopy(await response_cache.get_or_compute_async(key, lambda: method(self, *args, **kwargs)))
+
+        return async_wrapper
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        response_cache = getattr(self, "response_cache", None)
+        if response_cache is None:
+            return method(self, *args, **kwargs)
+
+        key = response_cache.make_key(f"{type(self).__name__}.{method.__name__}", args, kwargs)
+        # Every caller gets its own copy, so one that edits its response can't change what the others are served
+        return copy.deepcopy(response_cache.get_or_compute(key, lambda: method(self, *args, **kwargs)))
+
+    return wrapper
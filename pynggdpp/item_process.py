@@ -1,6 +1,13 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 import dateutil.parser as dt_parser
+from io import BytesIO
+import importlib.metadata as importlib_metadata
 import json
+import os
+import re
 import sys
 import numpy as np
 import uuid
@@ -10,7 +17,6 @@ import requests
 from bs4 import BeautifulSoup
 import xmltodict
 from geojson import Feature, Point, FeatureCollection
-from geojson import dumps as geojson_dumps
 from gis_metadata.metadata_parser import get_metadata_parser
 from gis_metadata.utils import get_supported_props
 import reverse_geocoder as rg
@@ -20,15 +26,48 @@ from .aws import Storage
 from .aws import Messaging
 from .rest_api import Search
 from .serverful import Infrastructure
+from .snapshots import Snapshots
+from .cache import CacheVersion, DiskCache, DownloadCache
+from .metrics import StageTimer, record_retry, url_host
+from .throttle import http_get
+from .profiling import Profiler, profiled
+from . import serialization
+
+
+def download_cache_for(download_cache):
+    # Accepts a DownloadCache, a directory for one, or None to fall back on NDC_DOWNLOAD_CACHE
+    if download_cache is None:
+        return DownloadCache.from_environment()
+    elif isinstance(download_cache, DownloadCache):
+        return download_cache
+    else:
+        return DownloadCache(download_cache)
+
+
+def fetch_url(url, download_cache=None, **kwargs):
+    if download_cache is None:
+        return http_get(url, **kwargs)
+    else:
+        return download_cache.get(url, **kwargs)
+
+
+def response_from_bytes(url, content):
+    # Wraps bytes read from somewhere other than the source so parsers get the object they expect
+    response = requests.Response()
+    response._content = content
+    response.status_code = 200
+    response.url = url
+    return response
 
 
 class Links:
-    def __init__(self):
+    def __init__(self, download_cache=None):
         self.data={}
+        self.download_cache = download_cache_for(download_cache)
 
     def parse_waf(self, url):
         try:
-            r = requests.get(url)
+            r = fetch_url(url, self.download_cache)
         except Exception as e:
             return None
 
@@ -83,12 +122,64 @@ class Links:
 
 
 class Files:
-    def __init__(self):
+    def __init__(self, snapshot=False, profile=None, metadata_properties=None, metadata_cache=None,
+                 download_cache=None):
         #self.aws_storage = Storage()
-        self.spatial_processor = Spatial()
+        self.storage = None
+        self.download_cache = download_cache_for(download_cache)
+        self.spatial_processor = Spatial(metadata_properties=metadata_properties, metadata_cache=metadata_cache)
         #self.rest_search = Search()
         self.temporal_processor = Temporal()
 
+        if snapshot:
+            self.snapshots = Snapshots()
+        else:
+            self.snapshots = None
+
+        # profile can be a Profiler, True for every file, or a sample rate; otherwise NDC_PROFILE decides
+        if isinstance(profile, Profiler):
+            self.profiler = profile
+        elif profile is None:
+            self.profiler = Profiler.from_environment()
+        elif profile is True:
+            self.profiler = Profiler(sample_rate=1.0)
+        else:
+            self.profiler = Profiler(sample_rate=float(profile))
+
+    def fetch_source(self, file_object):
+        # A copy already transferred to S3 (the harvest fetch stage) is read back instead of downloading again
+        if "ndc_s3_file_bucket" in file_object:
+            if self.storage is None:
+                self.storage = Storage()
+
+            body = self.storage.get_s3_file(
+                file_object["ndc_s3_file_key"],
+                bucket_name=file_object["ndc_s3_file_bucket"]
+            )
+            if isinstance(body, BytesIO):
+                return response_from_bytes(file_object["ndc_file_url"], body.getvalue())
+
+        return fetch_url(file_object["ndc_file_url"], self.download_cache)
+
+    def package_result(self, file_object, meta, recordset, timer=None):
+        # Keep a Parquet copy of what was parsed so indexes can be rebuilt without refetching sources
+        if self.snapshots is not None and len(recordset) > 0:
+            # The snapshot is a convenience copy; failing to write it shouldn't cost us the parsed records
+            try:
+                meta["snapshot_key"] = self.snapshots.write_snapshot(file_object, recordset)
+            except Exception as e:
+                meta["errors"].append(f"Snapshot not written: {type(e).__name__}: {e}")
+            if timer is not None:
+                timer.lap("snapshot")
+
+        if timer is not None:
+            meta["stage_timings"] = timer.as_dict()
+
+        return {
+            "processing_metadata": meta,
+            "recordset": recordset
+        }
+
     def introspect_nggdpp_xml(self, dict_data):
         introspection_meta = dict()
         top_keys = list(dict_data.keys())
@@ -117,14 +208,18 @@ class Files:
 
         return extra_properties
 
+    @profiled
     def clean_dict_from_nggdpp_xml(self, file_object, extra_properties=None):
+        timer = StageTimer()
         meta = {
             "file_url": file_object["ndc_file_url"],
             "file_downloaded": datetime.utcnow().isoformat(),
             "errors": list()
         }
 
-        response = requests.get(file_object["ndc_file_url"])
+        response = self.fetch_source(file_object)
+        timer.lap("download")
+
         source_data = xmltodict.parse(response.text, dict_constructor=dict)
 
         introspection_meta = self.introspect_nggdpp_xml(source_data)
@@ -137,6 +232,8 @@ class Files:
         meta["property_names"] = list(recordset[0].keys())
 
         recordset = [{k.lower(): v for k, v in i.items()} for i in recordset]
+        timer.lap("parse")
+
         for item in recordset:
             # Evaluate coordinates information if present
             item.update(self.spatial_processor.introspect_coordinates(item))
@@ -155,12 +252,11 @@ class Files:
             # Split datatype values into a list
             if "datatype" in item.keys() and isinstance(item["datatype"], str):
                 item["datatype"] = item["datatype"].split(",")
+        timer.lap("records")
 
-        return {
-            "processing_metadata": meta,
-            "recordset": recordset
-        }
+        return self.package_result(file_object, meta, recordset, timer=timer)
 
+    @profiled
     def clean_dict_from_csv(self, file_object, extra_properties=None):
         comma_allowed = [
             "title",
@@ -172,6 +268,7 @@ class Files:
             "alternategeometry"
         ]
 
+        timer = StageTimer()
         meta = {
             "file_url": file_object["ndc_file_url"],
             "file_delimiter": "|",
@@ -180,10 +277,18 @@ class Files:
             "errors": list()
         }
 
+        # Download once; the encoding and delimiter retries below reread the same bytes
+        try:
+            source_bytes = self.fetch_source(file_object).content
+        except Exception as e:
+            meta["errors"].append(str(e))
+            return meta
+        timer.lap("download")
+
         sys.stdout = x = ListStream()
         try:
             df = pd.read_csv(
-                meta["file_url"],
+                BytesIO(source_bytes),
                 delimiter=meta["file_delimiter"],
                 encoding=meta["file_encoding"],
                 error_bad_lines=False,
@@ -192,26 +297,28 @@ class Files:
         except UnicodeDecodeError:
             meta["file_encoding"] = "latin1"
             df = pd.read_csv(
-                meta["file_url"],
+                BytesIO(source_bytes),
                 delimiter=meta["file_delimiter"],
                 encoding=meta["file_encoding"],
                 error_bad_lines=False,
                 warn_bad_lines=True
             )
         except Exception as e:
+            sys.stdout = sys.__stdout__
             meta["errors"].append(str(e))
             return meta
 
         if len(df.columns) == 1:
             meta["file_delimiter"] = ","
             df = pd.read_csv(
-                meta["file_url"],
+                BytesIO(source_bytes),
                 delimiter=meta["file_delimiter"],
                 encoding=meta["file_encoding"],
                 error_bad_lines=False,
                 warn_bad_lines=True
             )
         sys.stdout = sys.__stdout__
+        timer.lap("read")
 
         # Record any error line problems that came up in reading the CSV file to dataframe
         if len(x.data) > 0:
@@ -259,6 +366,7 @@ class Files:
         # Add summary metadata
         meta["property_names"] = list(df.columns)
         meta["accepted_record_number"] = len(df)
+        timer.lap("clean")
 
         # Add in spatial processing
         recordset = list()
@@ -272,22 +380,56 @@ class Files:
 
             # Add the date we indexed this data
             item["ndc_date_file_indexed"] = datetime.utcnow().isoformat()
+        timer.lap("records")
+
+        return self.package_result(file_object, meta, recordset, timer=timer)
+
+    def parser_for(self, file_object, parser=None):
+        if parser is None:
+            content_type = file_object.get("ndc_file_content_type", file_object.get("ndc_content_type", ""))
+            if file_object.get("ndc_harvest_source") == "waf":
+                parser = "metadata"
+            elif "xml" in content_type or file_object["ndc_file_name"].lower().endswith(".xml"):
+                parser = "nggdpp_xml"
+            else:
+                parser = "csv"
+
+        if parser == "metadata":
+            return self.ndc_item_from_metadata
+        elif parser == "nggdpp_xml":
+            return self.clean_dict_from_nggdpp_xml
+        elif parser == "csv":
+            return self.clean_dict_from_csv
+        else:
+            raise ValueError(f"Unknown parser: {parser}")
 
-        return {
-            "processing_metadata": meta,
-            "recordset": recordset
-        }
+    def process_file(self, file_object, extra_properties=None, parser=None):
+        # The parsers profile themselves, so callers that skip process_file are sampled too
+        result = self.parser_for(file_object, parser=parser)(file_object, extra_properties=extra_properties)
+
+        # clean_dict_from_csv hands back bare metadata when the file can't be read at all
+        if "recordset" not in result:
+            result = {
+                "processing_metadata": result,
+                "recordset": list()
+            }
+
+        return result
 
-    def ndc_item_from_metadata(self, file_object):
+    @profiled
+    def ndc_item_from_metadata(self, file_object, extra_properties=None):
+        timer = StageTimer()
         meta = {
             "file_url": file_object["ndc_file_url"],
             "file_downloaded": datetime.utcnow().isoformat(),
             "errors": list()
         }
 
-        response = requests.get(file_object["ndc_file_url"])
+        response = self.fetch_source(file_object)
+        timer.lap("download")
 
         feature_data = self.spatial_processor.feature_from_metadata(response.text)
+        timer.lap("parse")
 
         item_record = feature_data["properties"]
         if feature_data["geometry"]["type"] == "Point":
@@ -301,19 +443,222 @@ class Files:
         for k, v in file_object.items():
             item_record.update({k: v})
 
+        # Add in the extra properties if available
+        if extra_properties is not None and isinstance(extra_properties, dict):
+            for k, v in extra_properties.items():
+                item_record.update({k: v})
+
         item_record["ndc_date_file_indexed"] = datetime.utcnow().isoformat()
 
         meta["accepted_record_number"] = 1
+        timer.lap("records")
+
+        return self.package_result(file_object, meta, [item_record], timer=timer)
+
+worker_files = dict()
+
+
+def failed_file_result(file_object, error):
+    return {
+        "processing_metadata": {
+            "file_url": file_object.get("ndc_file_url"),
+            "accepted_record_number": 0,
+            "errors": [f"{type(error).__name__}: {error}"]
+        },
+        "recordset": list()
+    }
+
+
+def process_file_worker(file_object, extra_properties=None, parser=None, files_options=None):
+    if files_options is None:
+        files_options = dict()
+
+    # One Files instance per worker process and configuration, reused across the files it handles
+    options_key = json.dumps(files_options, sort_keys=True)
+    if options_key not in worker_files:
+        worker_files[options_key] = Files(**files_options)
+
+    try:
+        return worker_files[options_key].process_file(file_object, extra_properties=extra_properties, parser=parser)
+    except Exception as e:
+        return failed_file_result(file_object, e)
+
+
+size_multipliers = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+class Batch:
+    def __init__(self, max_workers=None, max_in_flight=None, max_in_flight_bytes=None, max_attempts=2,
+                 files_options=None):
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        if max_in_flight is None:
+            max_in_flight = max_workers * 2
+
+        self.max_workers = max_workers
+        self.max_in_flight = max_in_flight
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.max_attempts = max_attempts
+        self.files_options = files_options
+
+    def file_size(self, file_object):
+        size = file_object.get("ndc_file_size", 0)
+        if not isinstance(size, str):
+            try:
+                return int(size)
+            except (TypeError, ValueError):
+                return 0
+
+        # WAF listings give sizes like "532", "12K" or "3.4M" (powers of 1024), and "-" when unknown
+        size_match = re.match(r"^([\d.]+)\s*([KMGT]?)B?$", size.strip(), re.IGNORECASE)
+        if size_match is None:
+            return 0
+
+        try:
+            return int(float(size_match.group(1)) * size_multipliers[size_match.group(2).upper()])
+        except ValueError:
+            return 0
+
+    def process_files(self, file_objects, extra_properties=None, parser=None):
+        file_objects = iter(file_objects)
+        waiting = deque()
+        in_flight = dict()
+        in_flight_bytes = 0
+
+        executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        try:
+            while True:
+                # Top up the pool without going over the file count or byte budget
+                while len(in_flight) < self.max_in_flight:
+                    if len(waiting) == 0:
+                        next_file = next(file_objects, None)
+                        if next_file is None:
+                            break
+                        waiting.append((next_file, 1))
+
+                    file_object, attempt = waiting[0]
+                    size = self.file_size(file_object)
+                    if self.max_in_flight_bytes is not None and len(in_flight) > 0 \
+                            and in_flight_bytes + size > self.max_in_flight_bytes:
+                        break
+
+                    waiting.popleft()
+                    future = executor.submit(
+                        process_file_worker,
+                        file_object,
+                        extra_properties,
+                        parser,
+                        self.files_options
+                    )
+                    in_flight[future] = (file_object, size, attempt)
+                    in_flight_bytes += size
+
+                if len(in_flight) == 0:
+                    break
+
+                done, not_done = wait(in_flight, return_when=FIRST_COMPLETED)
+
+                pool_broken = False
+                for future in done:
+                    file_object, size, attempt = in_flight.pop(future)
+                    in_flight_bytes -= size
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool as e:
+                        # A worker died (often out of memory); retry its files in a fresh pool
+                        pool_broken = True
+                        if attempt < self.max_attempts:
+                            record_retry("batch.process_file", url_host(file_object.get("ndc_file_url", "")))
+                            waiting.append((file_object, attempt + 1))
+                            continue
+                        result = failed_file_result(file_object, e)
+                    except Exception as e:
+                        result = failed_file_result(file_object, e)
+                    yield result
+
+                if pool_broken:
+                    for future, (file_object, size, attempt) in in_flight.items():
+                        if attempt < self.max_attempts:
+                            record_retry("batch.process_file", url_host(file_object.get("ndc_file_url", "")))
+                            waiting.append((file_object, attempt + 1))
+                        else:
+                            yield failed_file_result(file_object, BrokenProcessPool("worker process died"))
+                    in_flight.clear()
+                    in_flight_bytes = 0
+                    executor.shutdown(wait=False)
+                    executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def ndc_items_from_metadata(self, file_objects):
+        # Metadata documents are small and numerous, so they run through the pool like any other file;
+        # pass metadata_properties and metadata_cache in files_options to trim and reuse the parsing
+        for result in self.process_files(file_objects, parser="metadata"):
+            yield result
+
+    def process_waf(self, url, extra_properties=None):
+        waf_package = Links().parse_waf(url)
+        if waf_package is None:
+            return
+
+        file_objects = list()
+        for waf_file in waf_package["url_list"]:
+            waf_file["ndc_harvest_source"] = "waf"
+            file_objects.append(waf_file)
+
+        for result in self.process_files(file_objects, extra_properties=extra_properties, parser="metadata"):
+            yield result
+
+
+# The gis_metadata properties the NDC index actually uses; pass as metadata_properties to skip the rest
+ndc_metadata_properties = [
+    "title",
+    "abstract",
+    "purpose",
+    "supplementary_info",
+    "originators",
+    "publish_date",
+    "online_linkages",
+    "thematic_keywords",
+    "place_keywords",
+    "dates",
+    "bounding_box"
+]
+
+
+# Bump whenever feature_from_metadata changes what it builds, so features cached by older code are not reused
+metadata_feature_version = 2
+
+
+def metadata_parser_version():
+    try:
+        return importlib_metadata.version("gis-metadata-parser")
+    except importlib_metadata.PackageNotFoundError:
+        return None
 
-        return {
-            "processing_metadata": meta,
-            "recordset": [item_record]
-        }
 
 class Spatial:
-    def __init__(self):
+    def __init__(self, metadata_properties=None, metadata_cache=None):
         self.data={}
 
+        supported_props = get_supported_props()
+        if metadata_properties is None:
+            self.metadata_properties = list(supported_props)
+        else:
+            unknown_props = [prop for prop in metadata_properties if prop not in supported_props]
+            if len(unknown_props) > 0:
+                raise ValueError(f"Unsupported metadata properties: {', '.join(unknown_props)}")
+            self.metadata_properties = list(metadata_properties)
+
+        # metadata_cache is a directory, so extracted properties survive across runs and worker processes
+        if metadata_cache is None or isinstance(metadata_cache, DiskCache):
+            self.metadata_cache = metadata_cache
+        else:
+            self.metadata_cache = DiskCache(metadata_cache)
+
+        # Part of every cache key, along with the document and the requested properties
+        self.metadata_cache_version = [metadata_feature_version, metadata_parser_version()]
+
     def introspect_coordinates(self, item):
         if "ndc_processing_notices" not in item.keys():
             item["ndc_processing_notices"] = list()
@@ -326,14 +671,26 @@ class Spatial:
             try:
                 if "," in item["coordinates"]:
                     try:
-                        item["ndc_location"] = \
-                            Point((float(item["coordinates"].split(',')[0]), float(item["coordinates"].split(',')[1])))
-                        item["ndc_geopoint"] = {
-                            "lon": float(item["coordinates"].split(',')[0]),
-                            "lat": float(item["coordinates"].split(',')[1])
-                        }
+                        lon = float(item["coordinates"].split(',')[0])
+                        lat = float(item["coordinates"].split(',')[1])
                     except:
                         pass
+                    else:
+                        # An out of range point would be rejected by the 2dsphere index and ES geo_point alike
+                        if -180 <= lon <= 180 and -90 <= lat <= 90:
+                            item["ndc_location"] = Point((lon, lat))
+                            item["ndc_geopoint"] = {
+                                "lon": lon,
+                                "lat": lat
+                            }
+                        else:
+                            item["ndc_processing_notices"].append(
+                                {
+                                    "error": "Invalid Coordinates",
+                                    "info": f"{str(item['coordinates'])}; longitude or latitude out of range, "
+                                            f"kept empty geometry"
+                                }
+                            )
             except Exception as e:
                 item["ndc_processing_notices"].append(
                     {
@@ -351,48 +708,96 @@ class Spatial:
 
         return item
 
-    def nggdpp_recordset_to_feature_collection(self, recordset):
-        feature_list = []
+    def record_feature(self, record):
+        p = {k.lower(): v for k, v in record.items()}
+        p["ndc_processing_errors"] = list()
+        p["ndc_processing_errors_number"] = 0
 
-        for record in recordset:
-            p = {k.lower(): v for k, v in record.items()}
-            p["ndc_processing_errors"] = list()
-            p["ndc_processing_errors_number"] = 0
+        if "coordinates" not in p.keys():
+            if ("latitude" in p.keys() and "longitude" in p.keys()):
+                p["coordinates"] = f'{p["longitude"]},{p["latitude"]}'
 
-            if "coordinates" not in p.keys():
-                if ("latitude" in p.keys() and "longitude" in p.keys()):
-                    p["coordinates"] = f'{p["longitude"]},{p["latitude"]}'
+        g = {"type": "Point", "coordinates": []}
+        if "coordinates" in p.keys() and p["coordinates"] is not None:
+            try:
+                if "," in p["coordinates"]:
+                    try:
+                        g["coordinates"] = [
+                            float(p["coordinates"].split(',')[0]),
+                            float(p["coordinates"].split(',')[1])
+                        ]
+                    except:
+                        pass
+            except Exception as e:
+                p["ndc_processing_errors"].append(
+                    {
+                        "error": str(e),
+                        "info": f"{str(p['coordinates'])}; kept empty geometry"
+                    }
+                )
+                p["ndc_processing_errors_number"]+=1
 
-            g = Point(None)
-            if "coordinates" in p.keys() and p["coordinates"] is not None:
-                try:
-                    if "," in p["coordinates"]:
-                        try:
-                            g = Point((float(p["coordinates"].split(',')[0]), float(p["coordinates"].split(',')[1])))
-                        except:
-                            pass
-                except Exception as e:
-                    p["ndc_processing_errors"].append(
-                        {
-                            "error": e,
-                            "info": f"{str(p['coordinates'])}; kept empty geometry"
-                        }
-                    )
-                    p["ndc_processing_errors_number"]+=1
+        return {
+            "type": "Feature",
+            "geometry": g,
+            "properties": p
+        }
 
-            feature_list.append(Feature(geometry=g, properties=p))
+    def write_feature_collection(self, records, file_object, crs=None):
+        # Features are encoded and written one at a time, so nothing but the current record is held in memory
+        file_object.write(b'{"type": "FeatureCollection", ')
+        if crs is not None:
+            file_object.write(b'"crs": ' + serialization.dumpb(crs) + b', ')
+        file_object.write(b'"features": [')
+
+        feature_number = 0
+        for record in records:
+            if feature_number > 0:
+                file_object.write(b',')
+            file_object.write(serialization.dumpb(self.record_feature(record)))
+            feature_number += 1
+
+        file_object.write(b']}')
+
+        return feature_number
+
+    def feature_collection_to_s3(self, records, key_name, bucket_name="ndc-feature-collections", crs=None,
+                                 compression=None):
+        with Storage().open_multipart_upload(
+                key_name,
+                bucket_name,
+                content_type="application/geo+json",
+                compression=compression
+        ) as upload:
+            feature_number = self.write_feature_collection(records, upload, crs=crs)
+
+        return {
+            "key_name": key_name,
+            "bucket_name": bucket_name,
+            "feature_number": feature_number
+        }
+
+    def nggdpp_recordset_to_feature_collection(self, recordset):
+        feature_collection = BytesIO()
+        self.write_feature_collection(recordset, feature_collection, crs="EPSG:3857")
 
-        return geojson_dumps(FeatureCollection(feature_list, crs="EPSG:3857"))
+        return feature_collection.getvalue().decode("utf-8")
 
     def feature_from_metadata(self, meta_doc):
+        # Unchanged documents come straight back from the cache without being parsed again
+        if self.metadata_cache is not None:
+            cache_key = self.metadata_cache.make_key(meta_doc, self.metadata_properties, self.metadata_cache_version)
+            hit, f = self.metadata_cache.get(cache_key)
+            if hit:
+                return f
+
         p = dict()
 
         # Parse the metadata XML using the gis_metadata tools
         parsed_metadata = get_metadata_parser(meta_doc)
 
-        # Add any and all properties that aren't blank (ref. gis_metadata.utils.get_supported_props())
-        #for prop in get_supported_props():
-        for prop in get_supported_props():
+        # Add the requested properties that aren't blank (ref. gis_metadata.utils.get_supported_props())
+        for prop in self.metadata_properties:
             v = parsed_metadata.__getattribute__(prop)
             if len(v) > 0:
                 p[prop.lower()] = v
@@ -409,11 +814,14 @@ class Spatial:
 
             # Record a couple processable forms of the BBOX for later convenience
             p['coordinates_geojson'] = [[west, north], [east, north], [east, south], [west, south]]
-            p['coordinates_wkt'] = [[(west, north), (east, north), (east, south), (west, south), (west, north)]]
+            p['coordinates_wkt'] = [[[west, north], [east, north], [east, south], [west, south], [west, north]]]
 
             p['coordinates_point']['coordinates'] = f"{east},{south}"
             p['coordinates_point']['method'] = "bbox corner"
-            p['ndc_geopoint'] = f"{east},{south}"
+            p['ndc_geopoint'] = {
+                "lon": east,
+                "lat": south
+            }
         else:
             p['coordinates_point']['coordinates'] = None
             p['coordinates_point']['method'] = "no processable geometry"
@@ -421,16 +829,27 @@ class Spatial:
         # Generate the point geometry
         g = self.build_point_geometry(p["coordinates_point"]["coordinates"])
 
-        # Build the GeoJSON feature from the geometry with its properties
-        f = self.build_ndc_feature(g, p)
+        # Build the GeoJSON feature as a plain dict from the geometry with its properties
+        f = {
+            "type": "Feature",
+            "geometry": {
+                "type": g["type"],
+                "coordinates": list(g["coordinates"])
+            },
+            "properties": p
+        }
+
+        # gis_metadata hands back tuples, dates and its own objects; plain JSON types keep a fresh parse
+        # identical to what a cache hit returns
+        f = serialization.loads(serialization.dumpb(f))
 
-        # Convert the geojson object to a standard dict
-        f = json.loads(geojson_dumps(f))
+        if self.metadata_cache is not None:
+            self.metadata_cache.set(cache_key, f)
 
         return f
 
     def build_point_geometry(self, coordinates):
-        if coordinates == "0,0":
+        if coordinates is None or coordinates == "0,0":
             return Point(None)
 
         probable_lng, probable_lat = map(float, coordinates.split(","))
@@ -507,6 +926,7 @@ class Log:
         self.aws_messaging = Messaging()
         self.es = aws_connect.elastic_client()
         self.serverful_infrastructure = Infrastructure()
+        self.cache_version = None
 
     def log_process_step(self,
                          identifier,
@@ -517,7 +937,8 @@ class Log:
                          index="processing_log",
                          doc_type="log_entry",
                          source_file=None,
-                         source_function=None
+                         source_function=None,
+                         catalog_updated=False
                          ):
         log_entry = {
             "identifier": identifier,
@@ -547,8 +968,18 @@ class Log:
                 passon_db = self.serverful_infrastructure.connect_mongodb(collection=message_queue_packet["message_queue"])
                 passon_db.insert_one(log)
 
+            # Set on the step that finishes indexing a file or collection, so cached responses are retired
+            # once per unit of work rather than on every log line
+            if catalog_updated:
+                self.retire_cached_responses()
+
         return log_entry
 
+    def retire_cached_responses(self):
+        if self.cache_version is None:
+            self.cache_version = CacheVersion(serverful_infrastructure=self.serverful_infrastructure)
+        return self.cache_version.bump()
+
 
 class General:
     def __init__(self):
@@ -594,7 +1025,7 @@ class Enhancers:
         ms_gmu_api = "https://macrostrat.org/api/v2/geologic_units/gmus"
         api = f'{ms_gmu_api}?lat={coordinates[1]}&lng={coordinates[0]}'
 
-        ms_gmus = json.loads(requests.get(
+        ms_gmus = json.loads(http_get(
             api,
             headers={"Content-type": "application/json"}
         ).content.decode())
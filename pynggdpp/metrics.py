@@ -0,0 +1,232 @@
+import inspect
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from urllib.parse import urlsplit
+
+from pymongo import monitoring
+
+
+# Upper bounds in seconds, from a quick S3 read up to a slow ScienceBase or WAF download
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class OperationStats:
+    __slots__ = ("calls", "errors", "retries", "bytes_sent", "bytes_received", "seconds", "bucket_counts")
+
+    def __init__(self, bucket_number):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.seconds = 0.0
+        # One extra slot for anything past the last bound
+        self.bucket_counts = [0] * (bucket_number + 1)
+
+
+class Measurement:
+    __slots__ = ("bytes_sent", "bytes_received", "error")
+
+    def __init__(self):
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.error = False
+
+
+class Metrics:
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = buckets
+        self.operations = dict()
+        self.lock = threading.Lock()
+
+    def series(self, operation, target):
+        key = (operation, target or "")
+        stats = self.operations.get(key)
+        if stats is None:
+            with self.lock:
+                stats = self.operations.setdefault(key, OperationStats(len(self.buckets)))
+        return stats
+
+    def observe(self, operation, target, seconds, error=False, bytes_sent=0, bytes_received=0):
+        stats = self.series(operation, target)
+        bucket = bisect_left(self.buckets, seconds)
+
+        with self.lock:
+            stats.calls += 1
+            stats.seconds += seconds
+            stats.bucket_counts[bucket] += 1
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+            if error:
+                stats.errors += 1
+
+    def record_retry(self, operation, target=None, count=1):
+        stats = self.series(operation, target)
+        with self.lock:
+            stats.retries += count
+
+    @contextmanager
+    def timed(self, operation, target=None):
+        measurement = Measurement()
+        started = time.perf_counter()
+        try:
+            yield measurement
+        except BaseException:
+            measurement.error = True
+            raise
+        finally:
+            self.observe(
+                operation,
+                target,
+                time.perf_counter() - started,
+                error=measurement.error,
+                bytes_sent=measurement.bytes_sent,
+                bytes_received=measurement.bytes_received
+            )
+
+    def instrument(self, operation, target=None):
+        def decorator(function):
+            if inspect.iscoroutinefunction(function):
+                # Time the awaited call, not just the creation of the coroutine
+                @wraps(function)
+                async def async_wrapper(*args, **kwargs):
+                    with self.timed(operation, target):
+                        return await function(*args, **kwargs)
+                return async_wrapper
+
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timed(operation, target):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        with self.lock:
+            operations = list()
+            for (operation, target), stats in sorted(self.operations.items()):
+                operations.append({
+                    "operation": operation,
+                    "target": target,
+                    "calls": stats.calls,
+                    "errors": stats.errors,
+                    "retries": stats.retries,
+                    "bytes_sent": stats.bytes_sent,
+                    "bytes_received": stats.bytes_received,
+                    "seconds": round(stats.seconds, 6),
+                    "mean_seconds": round(stats.seconds / stats.calls, 6) if stats.calls > 0 else None,
+                    "buckets": OrderedDict(
+                        (str(bound), count) for bound, count in zip(self.buckets + ("+Inf",), stats.bucket_counts)
+                    )
+                })
+
+        return {
+            "created": time.time(),
+            "operations": operations
+        }
+
+    def prometheus_text(self, prefix="ndc"):
+        def labels(operation, target, **extra):
+            pairs = [("operation", operation), ("target", target)] + list(extra.items())
+            escaped = [
+                (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in pairs
+            ]
+            return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+        lines = [
+            f"# HELP {prefix}_operation_seconds Latency of calls to external services",
+            f"# TYPE {prefix}_operation_seconds histogram"
+        ]
+        counters = OrderedDict([
+            ("errors", "Calls that raised"),
+            ("retries", "Retried calls"),
+            ("bytes_sent", "Payload bytes sent"),
+            ("bytes_received", "Payload bytes received")
+        ])
+        counter_lines = {name: list() for name in counters}
+
+        with self.lock:
+            for (operation, target), stats in sorted(self.operations.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), stats.bucket_counts):
+                    cumulative += count
+                    lines.append(f"{prefix}_operation_seconds_bucket{labels(operation, target, le=bound)} {cumulative}")
+                lines.append(f"{prefix}_operation_seconds_sum{labels(operation, target)} {stats.seconds}")
+                lines.append(f"{prefix}_operation_seconds_count{labels(operation, target)} {stats.calls}")
+
+                for name in counters:
+                    counter_lines[name].append(
+                        f"{prefix}_operation_{name}_total{labels(operation, target)} {getattr(stats, name)}"
+                    )
+
+        for name, help_text in counters.items():
+            lines.append(f"# HELP {prefix}_operation_{name}_total {help_text}")
+            lines.append(f"# TYPE {prefix}_operation_{name}_total counter")
+            lines.extend(counter_lines[name])
+
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self.lock:
+            self.operations.clear()
+
+
+# Process wide registry that every module reports into
+metrics = Metrics()
+
+
+def instrumented(operation, target=None):
+    return metrics.instrument(operation, target)
+
+
+def record_retry(operation, target=None, count=1):
+    metrics.record_retry(operation, target, count=count)
+
+
+def url_host(url):
+    return urlsplit(url).netloc
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    # The driver reports durations itself, so all we keep between events is the collection each command targets
+    def __init__(self, registry=None):
+        self.registry = registry or metrics
+        self.targets = dict()
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = getattr(event, "database_name", "")
+        self.targets[(event.connection_id, event.request_id)] = collection
+
+    def finished(self, event, error):
+        target = self.targets.pop((event.connection_id, event.request_id), getattr(event, "database_name", ""))
+        self.registry.observe(f"mongo.{event.command_name}", target, event.duration_micros / 1e6, error=error)
+
+    def succeeded(self, event):
+        self.finished(event, False)
+
+    def failed(self, event):
+        self.finished(event, True)
+
+
+class StageTimer:
+    # Laps rather than nested blocks, so a parser only needs a line after each step it wants timed
+    def __init__(self):
+        self.timings = OrderedDict()
+        self.started = time.perf_counter()
+        self.last = self.started
+
+    def lap(self, name):
+        now = time.perf_counter()
+        self.timings[name] = self.timings.get(name, 0.0) + now - self.last
+        self.last = now
+
+    def as_dict(self):
+        timings = OrderedDict((k, round(v, 6)) for k, v in self.timings.items())
+        timings["total"] = round(self.last - self.started, 6)
+        return timings
@@ -0,0 +1,324 @@
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from .aws import Search as AwsSearch
+from .aws import Storage
+from .item_process import Links, process_file_worker
+
+
+end_of_stream = object()
+
+
+class Stage:
+    def __init__(self, name, function, concurrency=1, queue_size=100, fan_out=False, batch_size=None):
+        self.name = name
+        self.function = function
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.fan_out = fan_out
+        self.batch_size = batch_size
+
+        # A bounded inbox is what gives backpressure: a full queue blocks the stage upstream
+        self.inbox = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.active_workers = 0
+        self.processed = 0
+        self.emitted = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.recent_errors = deque(maxlen=10)
+        self.started = None
+        self.finished = None
+
+    def record(self, busy_seconds, emitted=0, error=None):
+        with self.lock:
+            self.processed += 1
+            self.emitted += emitted
+            self.busy_seconds += busy_seconds
+            if error is not None:
+                self.errors += 1
+                self.recent_errors.append(f"{type(error).__name__}: {error}")
+
+    def stats(self):
+        if self.started is None:
+            elapsed = 0
+        else:
+            elapsed = (self.finished or time.monotonic()) - self.started
+
+        with self.lock:
+            return {
+                "name": self.name,
+                "concurrency": self.concurrency,
+                "processed": self.processed,
+                "emitted": self.emitted,
+                "errors": self.errors,
+                "queue_depth": self.inbox.qsize(),
+                "queue_size": self.queue_size,
+                "busy_seconds": round(self.busy_seconds, 3),
+                "elapsed_seconds": round(elapsed, 3),
+                "throughput": round(self.processed / elapsed, 3) if elapsed > 0 else 0,
+                "utilization": round(self.busy_seconds / (elapsed * self.concurrency), 3) if elapsed > 0 else 0,
+                "recent_errors": list(self.recent_errors)
+            }
+
+
+class Pipeline:
+    def __init__(self, stages, output_queue_size=100):
+        self.stages = stages
+        self.outbox = queue.Queue(maxsize=output_queue_size)
+        self.source_errors = list()
+
+        # Set when the consumer of run() goes away, so no thread is left blocked on a full or empty queue
+        self.stopped = threading.Event()
+
+    def put(self, target, item):
+        while not self.stopped.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, source):
+        while not self.stopped.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return end_of_stream
+
+    def feed(self, source):
+        first_stage = self.stages[0]
+        try:
+            for item in source:
+                if not self.put(first_stage.inbox, item):
+                    break
+        except Exception as e:
+            self.source_errors.append(f"{type(e).__name__}: {e}")
+        finally:
+            for _ in range(first_stage.concurrency):
+                self.put(first_stage.inbox, end_of_stream)
+
+    def run_item(self, stage, payload, downstream):
+        started = time.monotonic()
+        emitted = 0
+        try:
+            result = stage.function(payload)
+            if stage.fan_out:
+                for output in result:
+                    if not self.put(downstream, output):
+                        break
+                    emitted += 1
+            elif result is not None:
+                if self.put(downstream, result):
+                    emitted = 1
+        except Exception as e:
+            stage.record(time.monotonic() - started, emitted=emitted, error=e)
+            return
+
+        stage.record(time.monotonic() - started, emitted=emitted)
+
+    def work(self, stage, downstream, downstream_workers):
+        batch = list()
+        while True:
+            item = self.get(stage.inbox)
+            if item is end_of_stream:
+                break
+
+            if stage.batch_size is None:
+                self.run_item(stage, item, downstream)
+            else:
+                batch.append(item)
+                if len(batch) >= stage.batch_size:
+                    self.run_item(stage, batch, downstream)
+                    batch = list()
+
+        if len(batch) > 0 and not self.stopped.is_set():
+            self.run_item(stage, batch, downstream)
+
+        # The last worker out tells every worker of the next stage that the stream is over
+        with stage.lock:
+            stage.active_workers -= 1
+            last_worker = stage.active_workers == 0
+        if last_worker:
+            stage.finished = time.monotonic()
+            for _ in range(downstream_workers):
+                self.put(downstream, end_of_stream)
+
+    def run(self, source):
+        for i, stage in enumerate(self.stages):
+            if i + 1 < len(self.stages):
+                downstream = self.stages[i + 1].inbox
+                downstream_workers = self.stages[i + 1].concurrency
+            else:
+                downstream = self.outbox
+                downstream_workers = 1
+
+            stage.started = time.monotonic()
+            stage.active_workers = stage.concurrency
+            for n in range(stage.concurrency):
+                threading.Thread(
+                    target=self.work,
+                    args=(stage, downstream, downstream_workers),
+                    name=f"{stage.name}-{n}",
+                    daemon=True
+                ).start()
+
+        threading.Thread(target=self.feed, args=(source,), name="source", daemon=True).start()
+
+        try:
+            while True:
+                output = self.outbox.get()
+                if output is end_of_stream:
+                    break
+                yield output
+        finally:
+            # Runs when the consumer stops iterating early too, and lets every stage thread wind down
+            self.stopped.set()
+
+    def drain(self, source):
+        output_number = 0
+        for _ in self.run(source):
+            output_number += 1
+
+        return {
+            "outputs": output_number,
+            "stages": self.stats()
+        }
+
+    def stats(self):
+        return {
+            "source_errors": list(self.source_errors),
+            "output_queue_depth": self.outbox.qsize(),
+            "stages": [stage.stats() for stage in self.stages]
+        }
+
+
+class Harvest:
+    def __init__(self, index_name, doc_type="ndc_collection_item", fetch_concurrency=8, parse_workers=None,
+                 index_concurrency=2, index_batch_size=500, queue_size=100, cache_to_s3=False, enhancers=None,
+                 files_options=None):
+        self.index_name = index_name
+        self.doc_type = doc_type
+        self.fetch_concurrency = fetch_concurrency
+        self.parse_workers = parse_workers
+        self.index_concurrency = index_concurrency
+        self.index_batch_size = index_batch_size
+        self.queue_size = queue_size
+        self.cache_to_s3 = cache_to_s3
+        self.enhancers = enhancers
+        self.files_options = files_options
+
+        self.file_reports = list()
+        self.file_reports_lock = threading.Lock()
+        self.thread_state = threading.local()
+        self.search = None
+        self.active_pipeline = None
+
+    def discover_waf(self, url):
+        waf_package = Links().parse_waf(url)
+        if waf_package is None:
+            return list()
+
+        for waf_file in waf_package["url_list"]:
+            waf_file["ndc_harvest_source"] = "waf"
+
+        return waf_package["url_list"]
+
+    def fetch(self, file_object):
+        # boto3 resources are not thread safe, so each fetch thread keeps its own
+        if not hasattr(self.thread_state, "storage"):
+            self.thread_state.storage = Storage()
+
+        transfer = self.thread_state.storage.transfer_file_to_s3(file_object["ndc_file_url"])
+        file_object["ndc_s3_file_key"] = transfer["key_name"]
+        # Tells the parse stage to read this copy back instead of downloading the source a second time
+        file_object["ndc_s3_file_bucket"] = "ndc-file-cache"
+        return file_object
+
+    def parse(self, executor, file_object):
+        # Parsing is CPU bound, so each parse thread just waits on its own slot in the process pool
+        result = executor.submit(process_file_worker, file_object, None, None, self.files_options).result()
+
+        with self.file_reports_lock:
+            self.file_reports.append(result["processing_metadata"])
+
+        return result["recordset"]
+
+    def enhance(self, record):
+        for enhancer in self.enhancers:
+            record = enhancer(record)
+        return record
+
+    def index(self, records):
+        self.search.bulk_build_es_index(self.index_name, self.doc_type, records)
+        return len(records)
+
+    def pipeline(self, executor, parse_workers, discover=None):
+        stages = list()
+
+        if discover is not None:
+            stages.append(Stage("discover", discover, concurrency=2, queue_size=self.queue_size, fan_out=True))
+
+        if self.cache_to_s3:
+            stages.append(Stage("fetch", self.fetch, concurrency=self.fetch_concurrency, queue_size=self.queue_size))
+
+        stages.append(
+            Stage(
+                "parse",
+                lambda file_object: self.parse(executor, file_object),
+                concurrency=parse_workers,
+                queue_size=self.queue_size,
+                fan_out=True
+            )
+        )
+
+        if self.enhancers is not None:
+            stages.append(Stage("enhance", self.enhance, concurrency=self.fetch_concurrency, queue_size=self.queue_size))
+
+        stages.append(
+            Stage(
+                "index",
+                self.index,
+                concurrency=self.index_concurrency,
+                queue_size=self.index_batch_size * self.index_concurrency * 2,
+                batch_size=self.index_batch_size
+            )
+        )
+
+        return Pipeline(stages, output_queue_size=self.queue_size)
+
+    def run(self, source, discover=None):
+        parse_workers = self.parse_workers or os.cpu_count() or 1
+        self.search = AwsSearch()
+        # Created up front, so index workers never race each other to create it
+        self.search.ensure_es_index(self.index_name, doc_type=self.doc_type)
+
+        executor = ProcessPoolExecutor(max_workers=parse_workers)
+        try:
+            # Kept on the instance so stats() can be polled from another thread while the harvest runs
+            self.active_pipeline = self.pipeline(executor, parse_workers, discover=discover)
+            summary = self.active_pipeline.drain(source)
+        finally:
+            executor.shutdown()
+
+        summary["files"] = len(self.file_reports)
+        summary["file_errors"] = len([r for r in self.file_reports if len(r.get("errors", [])) > 0])
+
+        return summary
+
+    def stats(self):
+        if self.active_pipeline is None:
+            return None
+        return self.active_pipeline.stats()
+
+    def run_waf(self, urls):
+        return self.run(urls, discover=self.discover_waf)
+
+    def run_files(self, file_objects):
+        return self.run(file_objects)
@@ -0,0 +1,153 @@
+import cProfile
+import functools
+import io
+import marshal
+import os
+import pstats
+import random
+import time
+import tracemalloc
+from datetime import datetime
+
+from .aws import Storage
+
+
+def profiled(method):
+    # Wraps a Files parser entry point so it is profiled however it is called, not just through process_file
+    @functools.wraps(method)
+    def wrapper(self, file_object, *args, **kwargs):
+        return self.profiler.run(file_object, method, self, file_object, *args, **kwargs)
+
+    return wrapper
+
+
+class Profiler:
+    def __init__(self, sample_rate=1.0, slow_threshold=30.0, bucket_name="ndc-profiles", prefix="profiles",
+                 top_number=25, memory_threshold=None):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.memory_threshold = memory_threshold
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.top_number = top_number
+        self.storage = None
+
+    @classmethod
+    def from_environment(cls):
+        # NDC_PROFILE is the fraction of files to profile ("1" or "true" for all of them)
+        sample_rate = os.environ.get("NDC_PROFILE", "0").strip().lower()
+        if sample_rate in ["true", "yes", "on"]:
+            sample_rate = 1.0
+
+        memory_threshold = os.environ.get("NDC_PROFILE_PEAK_BYTES")
+
+        return cls(
+            sample_rate=float(sample_rate),
+            slow_threshold=float(os.environ.get("NDC_PROFILE_SLOW_SECONDS", 30.0)),
+            bucket_name=os.environ.get("NDC_PROFILE_BUCKET", "ndc-profiles"),
+            memory_threshold=None if memory_threshold is None else int(memory_threshold)
+        )
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0
+
+    def sampled(self):
+        return self.enabled and random.random() < self.sample_rate
+
+    def profile_key(self, file_object):
+        if self.storage is None:
+            self.storage = Storage()
+        file_key = self.storage.url_to_s3_key(file_object.get("ndc_file_url", "unknown"))
+        return f"{self.prefix}/{file_key}/{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}"
+
+    def top_functions(self, profiler):
+        stats_text = io.StringIO()
+        pstats.Stats(profiler, stream=stats_text).sort_stats("cumulative").print_stats(self.top_number)
+        return stats_text.getvalue()
+
+    def top_allocations(self, memory_snapshot):
+        return [
+            {
+                "location": str(stat.traceback),
+                "size": stat.size,
+                "count": stat.count
+            }
+            for stat in memory_snapshot.statistics("lineno")[:self.top_number]
+        ]
+
+    def write_profile(self, file_object, profiler, summary):
+        key_name = self.profile_key(file_object)
+
+        # The .prof object is the same marshalled stats that pstats.Stats and snakeviz load from a file
+        profiler.create_stats()
+        self.storage.put_bytes_to_s3(
+            marshal.dumps(profiler.stats),
+            key_name=f"{key_name}.prof",
+            bucket_name=self.bucket_name,
+            content_type="application/octet-stream"
+        )
+
+        summary["profile_key"] = f"{key_name}.prof"
+        self.storage.put_json_to_s3(summary, key_name=f"{key_name}.json", bucket_name=self.bucket_name)
+
+        return summary["profile_key"]
+
+    def run(self, file_object, function, *args, **kwargs):
+        if not self.sampled():
+            return function(*args, **kwargs)
+
+        # Leave tracemalloc alone if something else already started it
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        else:
+            tracemalloc.reset_peak()
+
+        profiler = cProfile.Profile()
+        result = None
+        error = None
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            profiler.disable()
+            elapsed = time.perf_counter() - started
+            current_memory, peak_memory = tracemalloc.get_traced_memory()
+
+            # Only slow, memory hungry or failed files are worth keeping
+            keep_profile = (
+                elapsed >= self.slow_threshold
+                or (self.memory_threshold is not None and peak_memory >= self.memory_threshold)
+                or error is not None
+            )
+            if keep_profile:
+                memory_snapshot = tracemalloc.take_snapshot()
+            if started_tracing:
+                tracemalloc.stop()
+
+            if keep_profile:
+                summary = {
+                    "file_url": file_object.get("ndc_file_url"),
+                    "profiled": datetime.utcnow().isoformat(),
+                    "elapsed_seconds": round(elapsed, 6),
+                    "peak_memory_bytes": peak_memory,
+                    "retained_memory_bytes": current_memory,
+                    "error": None if error is None else f"{type(error).__name__}: {error}",
+                    "top_functions": self.top_functions(profiler),
+                    "top_allocations": self.top_allocations(memory_snapshot)
+                }
+                try:
+                    profile_key = self.write_profile(file_object, profiler, summary)
+                except Exception:
+                    # A failed upload shouldn't cost us the file itself
+                    profile_key = None
+
+                if profile_key is not None and isinstance(result, dict) and "processing_metadata" in result:
+                    result["processing_metadata"]["profile_key"] = profile_key
+
+        return result
@@ -1,18 +1,69 @@
-import os
-import json
-from elasticsearch import Elasticsearch
+import base64
+import copy
+import math
+from bson import ObjectId
+from bson import json_util
+from pymongo import ASCENDING, DESCENDING
+from elasticsearch.exceptions import TransportError
 from .aws import Connect
+from .aws import Messaging
 from .serverful import Infrastructure
+from .serverful import Indexes
+from .cache import cached_response, LRUCache, ResponseCache
+from .metrics import instrumented
+from .views import Views
+from . import serialization
 from collections import OrderedDict
 
 
+def encode_cursor(position):
+    return base64.urlsafe_b64encode(json_util.dumps(position).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(token, key="_id"):
+    try:
+        position = json_util.loads(base64.urlsafe_b64decode(token.encode("ascii")).decode("utf-8"))
+    except (ValueError, TypeError, AttributeError):
+        raise ValueError(f"Invalid cursor: {token}")
+
+    # A token that decodes but isn't one of ours should fail the same way, not as a KeyError further on
+    if not isinstance(position, dict) or key not in position:
+        raise ValueError(f"Invalid cursor: {token}")
+
+    return position
+
+
+def stream_records(records, output_format="ndjson", container="items"):
+    # Records are encoded one at a time as the cursor yields them so memory stays flat for any result size
+    if output_format == "ndjson":
+        for record in records:
+            yield serialization.dumps(record) + "\n"
+    elif output_format == "json":
+        yield f'{{"{container}": ['
+        separator = ""
+        for record in records:
+            yield separator + serialization.dumps(record)
+            separator = ","
+        yield "]}\n"
+    else:
+        raise ValueError(f"Unsupported export format: {output_format}")
+
+
 class Mongo:
-    def __init__(self):
-        self.serverful_infrastructure = Infrastructure()
+    def __init__(self, response_cache=None, serverful_infrastructure=None, count_ttl=60.0, count_limit=10000,
+                 view_max_age=3600):
+        if serverful_infrastructure is None:
+            serverful_infrastructure = Infrastructure()
+        self.serverful_infrastructure = serverful_infrastructure
+        self.response_cache = response_cache
+        self.views = Views(serverful_infrastructure=serverful_infrastructure, max_age=view_max_age)
 
-    def query_collections(self, q=None, ndc_collection_id=None, base_url=None):
-        ndc_collections_db = self.serverful_infrastructure.connect_mongodb(collection="ndc_collections")
+        # Totals only need to be as fresh as a client paging through results would notice
+        self.count_cache = LRUCache(max_entries=1024, ttl=count_ttl)
+        # Counting stops here and the total is reported as a lower bound; None counts everything
+        self.count_limit = count_limit
 
+    def collections_query(self, q=None, ndc_collection_id=None):
         if ndc_collection_id is not None:
             query = {
                 "ndc_collection_id": ndc_collection_id
@@ -28,13 +79,29 @@ class Mongo:
                         }
                     }
 
+        return query
+
+    @instrumented("rest_api.mongo.query_collections", "mongo")
+    @cached_response
+    def query_collections(self, q=None, ndc_collection_id=None, base_url=None):
+        ndc_collections_db = self.serverful_infrastructure.connect_mongodb(collection="ndc_collections")
+
+        query = self.collections_query(q=q, ndc_collection_id=ndc_collection_id)
+
+        return self.package_collections(
+            list(ndc_collections_db.find(query)),
+            ndc_collection_id=ndc_collection_id,
+            base_url=base_url
+        )
+
+    def package_collections(self, records, ndc_collection_id=None, base_url=None):
         if base_url is None:
             reference_domain = "/"
         else:
             reference_domain = base_url
 
         recordset = list()
-        for collection_record in list(ndc_collections_db.find(query)):
+        for collection_record in records:
             if ndc_collection_id is None:
                 collection_record["ndc_collection_link"] = f"{reference_domain}/{collection_record['ndc_collection_id']}"
             else:
@@ -44,6 +111,7 @@ class Mongo:
 
         result_package = OrderedDict()
         result_package["total"] = len(recordset)
+        result_package["total_relation"] = "eq"
         result_package["selfLink"] = {
             "rel": "self",
             "url": base_url
@@ -52,53 +120,47 @@ class Mongo:
 
         return result_package
 
-    def query_files(self, ndc_collection_id=None, base_url=None):
-        ndc_files_db = self.serverful_infrastructure.connect_mongodb(collection="ndc_files")
-
-        match_aggregation = {"$match":
-                                 {
-                                     "ndc_collection_id": ndc_collection_id
-                                 }
-                             }
-
-        group_aggregation = {"$group":
-                                {
-                                    "_id": "$ndc_collection_id",
-                                    "ndc_collection_title":
-                                    {
-                                        "$first": "$ndc_collection_title"
-                                    },
-                                    "ndc_collection_owner":
-                                    {
-                                        "$first": "$ndc_collection_owner"
-                                    },
-                                    "record_number":
-                                    {
-                                        "$sum": "$processing_metadata.accepted_record_number"
-                                    },
-                                    "files_processed":
-                                    {
-                                        "$addToSet": "$ndc_file_name"
-                                    },
-                                    "latest_file_date":
-                                    {
-                                        "$max": "$ndc_file_date"
-                                    },
-                                }
-                            }
-
+    def file_summaries_query(self, ndc_collection_id=None):
         if ndc_collection_id is not None:
-            pipeline = [match_aggregation, group_aggregation]
+            return {"_id": ndc_collection_id}
+        else:
+            return {}
+
+    def view_status(self, view_collection):
+        status_db = self.serverful_infrastructure.connect_mongodb(collection="ndc_view_status")
+        return status_db.find_one({"_id": view_collection})
+
+    def collection_ids(self, ndc_collection_id=None):
+        if ndc_collection_id is None:
+            return None
+        return [ndc_collection_id]
+
+    @instrumented("rest_api.mongo.query_files", "mongo")
+    @cached_response
+    def query_files(self, ndc_collection_id=None, base_url=None):
+        # Summaries come from the view views.Views maintains, or straight from ndc_files until it is current
+        if self.views.is_current(self.view_status("ndc_file_summaries")):
+            ndc_file_summaries_db = self.serverful_infrastructure.connect_mongodb(collection="ndc_file_summaries")
+            query = self.file_summaries_query(ndc_collection_id=ndc_collection_id)
+            records = list(ndc_file_summaries_db.find(query).sort("_id", ASCENDING))
         else:
-            pipeline = [group_aggregation]
+            ndc_files_db = self.serverful_infrastructure.connect_mongodb(collection="ndc_files")
+            pipeline = self.views.file_summaries_pipeline(
+                ndc_collection_ids=self.collection_ids(ndc_collection_id),
+                merge=False
+            )
+            records = list(ndc_files_db.aggregate(pipeline))
 
+        return self.package_file_summaries(records, ndc_collection_id=ndc_collection_id, base_url=base_url)
+
+    def package_file_summaries(self, records, ndc_collection_id=None, base_url=None):
         if base_url is None:
             reference_domain = "/"
         else:
             reference_domain = base_url
 
         recordset = list()
-        for collection_record in list(ndc_files_db.aggregate(pipeline)):
+        for collection_record in records:
             collection_record["ndc_collection_id"] = collection_record["_id"]
             if ndc_collection_id is None:
                 collection_record["ndc_collection_link"] = f"{reference_domain}/{collection_record['_id']}"
@@ -109,6 +171,7 @@ class Mongo:
 
         result_package = OrderedDict()
         result_package["total"] = len(recordset)
+        result_package["total_relation"] = "eq"
         result_package["selfLink"] = {
                 "rel": "self",
                 "url": base_url
@@ -117,39 +180,39 @@ class Mongo:
 
         return result_package
 
+    @instrumented("rest_api.mongo.query_organizations", "mongo")
+    @cached_response
     def query_organizations(self, base_url=None):
-        pipeline = [
-                        {"$group":
-                            {
-                                "_id": "$ndc_collection_owner",
-                                "ndc_collection_owner_link": {"$first": "$ndc_collection_owner_link"},
-                                "ndc_collection_owner_api": {"$first": "$ndc_collection_owner_api"},
-                                "ndc_collection_owner_location": {"$first": "$ndc_collection_owner_location"},
-                                "collections": {"$push": "$$ROOT"}
-                            }
-                        }
-                    ]
+        # Organizations come from the view views.Views maintains, or straight from ndc_collections until it is current
+        if self.views.is_current(self.view_status("ndc_organizations")):
+            ndc_organizations_db = self.serverful_infrastructure.connect_mongodb(collection="ndc_organizations")
+            records = list(ndc_organizations_db.find({}).sort("_id", ASCENDING))
+        else:
+            ndc_collections_db = self.serverful_infrastructure.connect_mongodb(collection="ndc_collections")
+            records = list(ndc_collections_db.aggregate(self.views.organizations_pipeline(merge=False)))
 
-        ndc_collections_db = self.serverful_infrastructure.connect_mongodb(collection="ndc_collections")
+        return self.package_organizations(records, base_url=base_url)
 
+    def package_organizations(self, records, base_url=None):
         recordset = list()
-        for organization_record in list(ndc_collections_db.aggregate(pipeline)):
+        for organization_record in records:
             org_collections = list()
             for collection_record in organization_record["collections"]:
-                del collection_record["_id"]
+                collection_record.pop("_id", None)
                 collection_record["ndc_collection_link"] = f"{base_url}/{collection_record['ndc_collection_id']}"
                 org_collections.append(collection_record)
             org_record = {
                 "ndc_collection_owner": organization_record["_id"],
-                "ndc_collection_owner_link": organization_record["ndc_collection_owner_link"],
-                "ndc_collection_owner_api": organization_record["ndc_collection_owner_api"],
-                "ndc_collection_owner_location": organization_record["ndc_collection_owner_location"],
+                "ndc_collection_owner_link": organization_record.get("ndc_collection_owner_link"),
+                "ndc_collection_owner_api": organization_record.get("ndc_collection_owner_api"),
+                "ndc_collection_owner_location": organization_record.get("ndc_collection_owner_location"),
                 "collections": org_collections
             }
             recordset.append(org_record)
 
         result_package = OrderedDict()
         result_package["total"] = len(recordset)
+        result_package["total_relation"] = "eq"
         result_package["selfLink"] = {
                 "rel": "self",
                 "url": base_url
@@ -158,54 +221,385 @@ class Mongo:
 
         return result_package
 
-    def query_items(self, q=None, first_id=None, last_id=None, limit=10, ndc_collection_id=None, base_url=None):
-        ndc_items = self.serverful_infrastructure.connect_mongodb(collection="ndc_items")
+    def parallel_edge(self, longitudes, lat):
+        # Every longitude is the same point at a pole, and repeated vertices make an invalid polygon
+        if abs(lat) >= 90:
+            return [[longitudes[0], lat]]
+        return [[lon, lat] for lon in longitudes]
 
-        if not isinstance(limit, int):
-            limit = 10
+    def bbox_polygon(self, west, south, east, north, step=1.0):
+        # 2dsphere edges are geodesics, so the north and south edges get a vertex every step degrees to stay on
+        # their parallels and select what geo_bounding_box selects in Search
+        segments = max(1, int(math.ceil((east - west) / step)))
+        longitudes = [west + (east - west) * i / segments for i in range(segments + 1)]
+
+        ring = self.parallel_edge(longitudes, south) + self.parallel_edge(list(reversed(longitudes)), north)
+        ring.append(ring[0])
+
+        return {
+            "type": "Polygon",
+            "coordinates": [ring],
+            # Strict winding lets a box cover more than a hemisphere; the ring runs counter-clockwise around it
+            "crs": {
+                "type": "name",
+                "properties": {
+                    "name": "urn:x-mongodb:crs:strictwinding:EPSG:4326"
+                }
+            }
+        }
+
+    def spatial_clauses(self, bbox=None, distance=None, polygon=None):
+        # Same argument forms as Search.spatial_filters: bbox (west, south, east, north),
+        # distance (lon, lat, meters) and polygon as a list of (lon, lat)
+        clauses = list()
+
+        if bbox is not None:
+            west, south, east, north = bbox
+            if west > east:
+                # A box across the antimeridian is one box on each side of it
+                boxes = [(west, south, 180.0, north), (-180.0, south, east, north)]
+            else:
+                boxes = [(west, south, east, north)]
+
+            box_clauses = [
+                {
+                    "ndc_location": {
+                        "$geoWithin": {
+                            "$geometry": self.bbox_polygon(*box)
+                        }
+                    }
+                }
+                for box in boxes
+            ]
+            if len(box_clauses) == 1:
+                clauses.append(box_clauses[0])
+            else:
+                clauses.append({"$or": box_clauses})
+
+        if distance is not None:
+            # $centerSphere rather than $near so results keep the _id order the cursors depend on
+            lon, lat, meters = distance
+            clauses.append({
+                "ndc_location": {
+                    "$geoWithin": {
+                        "$centerSphere": [[lon, lat], meters / 6378100.0]
+                    }
+                }
+            })
+
+        if polygon is not None:
+            ring = [[lon, lat] for lon, lat in polygon]
+            if ring[0] != ring[-1]:
+                ring.append(ring[0])
+            clauses.append({
+                "ndc_location": {
+                    "$geoWithin": {
+                        "$geometry": {
+                            "type": "Polygon",
+                            "coordinates": [ring]
+                        }
+                    }
+                }
+            })
+
+        return clauses
 
+    def items_query(self, q=None, ndc_collection_id=None, bbox=None, distance=None, polygon=None):
         if q == "*":
             q = None
 
-        query = {}
+        clauses = list()
 
-        if ndc_collection_id is not None and q is None:
-            query = {"ndc_collection_id": ndc_collection_id}
+        if ndc_collection_id is not None:
+            clauses.append({"ndc_collection_id": ndc_collection_id})
 
-        if ndc_collection_id is None and q is not None:
-            query = {"$text": {"$search": q}}
+        if q is not None:
+            clauses.append({"$text": {"$search": q}})
 
-        if ndc_collection_id is not None and q is not None:
-            query = {
-                "$and": [
-                    {"ndc_collection_id": ndc_collection_id},
-                    {"$text": {"$search": q}}
-                ]
-            }
+        clauses.extend(self.spatial_clauses(bbox=bbox, distance=distance, polygon=polygon))
 
+        return clauses
+
+    def combine_clauses(self, clauses):
+        if len(clauses) == 0:
+            return {}
+        elif len(clauses) == 1:
+            return clauses[0]
+        else:
+            return {"$and": clauses}
+
+    def cursor_id(self, value):
+        if isinstance(value, str) and ObjectId.is_valid(value):
+            return ObjectId(value)
+        return value
+
+    def keyset_range(self, first_id=None, last_id=None):
         if last_id is not None:
-            query = {"_id": {"$gt": last_id}}
-        if first_id is not None:
-            query = {"_id": {"$lt": last_id}}
+            anchor = self.cursor_id(last_id)
+            return {"_id": {"$gt": anchor}}, ASCENDING, anchor
+        elif first_id is not None:
+            anchor = self.cursor_id(first_id)
+            return {"_id": {"$lt": anchor}}, DESCENDING, anchor
+        else:
+            return None, ASCENDING, None
+
+    def items_page_query(self, q=None, first_id=None, last_id=None, limit=10, ndc_collection_id=None,
+                         after=None, before=None, bbox=None, distance=None, polygon=None):
+        if not isinstance(limit, int) or limit < 1:
+            limit = 10
+
+        # Opaque cursor tokens take precedence over raw _id values
+        if after is not None:
+            last_id = decode_cursor(after)["_id"]
+        if before is not None:
+            first_id = decode_cursor(before)["_id"]
+
+        clauses = self.items_query(
+            q=q,
+            ndc_collection_id=ndc_collection_id,
+            bbox=bbox,
+            distance=distance,
+            polygon=polygon
+        )
+
+        # Keyset range on _id keeps every page an index seek no matter how deep it is
+        range_clause, direction, anchor = self.keyset_range(first_id=first_id, last_id=last_id)
+        if range_clause is not None:
+            clauses.append(range_clause)
+
+        return self.combine_clauses(clauses), direction, anchor, limit
+
+    def count_key(self, collection, query):
+        return f"{collection.name}:{json_util.dumps(query, sort_keys=True)}"
+
+    def bounded_total(self, count):
+        if self.count_limit is not None and count >= self.count_limit:
+            return count, "gte"
+        return count, "eq"
+
+    def count_options(self):
+        if self.count_limit is None:
+            return {}
+        return {"limit": self.count_limit}
 
-        data = list(ndc_items.find(query, {"_id": 0}).limit(limit))
+    def count_items(self, collection, query):
+        key = self.count_key(collection, query)
+        hit, total = self.count_cache.get(key)
+        if hit:
+            return total
+
+        if len(query) == 0:
+            # Read from collection metadata rather than scanning anything
+            total = (collection.estimated_document_count(), "eq")
+        else:
+            total = self.bounded_total(collection.count_documents(query, **self.count_options()))
+
+        self.count_cache.set(key, total)
+        return total
+
+    @instrumented("rest_api.mongo.query_items", "mongo")
+    def query_items(self, q=None, first_id=None, last_id=None, limit=10, ndc_collection_id=None, base_url=None,
+                    after=None, before=None, bbox=None, distance=None, polygon=None):
+        ndc_items = self.serverful_infrastructure.connect_mongodb(collection="ndc_items")
+
+        query, direction, anchor, limit = self.items_page_query(
+            q=q,
+            first_id=first_id,
+            last_id=last_id,
+            limit=limit,
+            ndc_collection_id=ndc_collection_id,
+            after=after,
+            before=before,
+            bbox=bbox,
+            distance=distance,
+            polygon=polygon
+        )
+
+        # One extra document tells us whether there is another page without counting
+        data = list(ndc_items.find(query).sort("_id", direction).limit(limit + 1))
+
+        # The total covers every page, so it is counted without the keyset range
+        total, total_relation = self.count_items(
+            ndc_items,
+            self.combine_clauses(
+                self.items_query(
+                    q=q,
+                    ndc_collection_id=ndc_collection_id,
+                    bbox=bbox,
+                    distance=distance,
+                    polygon=polygon
+                )
+            )
+        )
+
+        return self.package_items(
+            data,
+            limit,
+            direction,
+            anchor,
+            base_url=base_url,
+            total=total,
+            total_relation=total_relation
+        )
+
+    def package_items(self, data, limit, direction, anchor, base_url=None, total=None, total_relation="eq"):
+        has_more = len(data) > limit
+        data = data[:limit]
+        if direction == DESCENDING:
+            data.reverse()
+
+        next_cursor = None
+        prev_cursor = None
+        if len(data) > 0:
+            if (direction == ASCENDING and has_more) or direction == DESCENDING:
+                next_cursor = encode_cursor({"_id": data[-1]["_id"]})
+            if (direction == DESCENDING and has_more) or (direction == ASCENDING and anchor is not None):
+                prev_cursor = encode_cursor({"_id": data[0]["_id"]})
+        elif anchor is not None:
+            if direction == ASCENDING:
+                prev_cursor = encode_cursor({"_id": anchor})
+            else:
+                next_cursor = encode_cursor({"_id": anchor})
+
+        for item in data:
+            del item["_id"]
+
+        if total is None:
+            total = len(data)
 
         result_package = OrderedDict()
-        result_package["total"] = len(data)
+        result_package["total"] = total
+        result_package["total_relation"] = total_relation
         result_package["selfLink"] = {
                 "rel": "self",
                 "url": base_url
             }
+        result_package["next_cursor"] = next_cursor
+        result_package["prev_cursor"] = prev_cursor
         result_package["items"] = data
 
         return result_package
 
+    def export_items(self, q=None, ndc_collection_id=None, output_format="ndjson", batch_size=1000,
+                     bbox=None, distance=None, polygon=None):
+        ndc_items = self.serverful_infrastructure.connect_mongodb(collection="ndc_items")
+
+        query = self.combine_clauses(
+            self.items_query(
+                q=q,
+                ndc_collection_id=ndc_collection_id,
+                bbox=bbox,
+                distance=distance,
+                polygon=polygon
+            )
+        )
+        cursor = ndc_items.find(query, {"_id": 0}).batch_size(batch_size)
+
+        return stream_records(cursor, output_format=output_format, container="items")
+
+    def export_collections(self, q=None, output_format="ndjson", batch_size=1000):
+        ndc_collections_db = self.serverful_infrastructure.connect_mongodb(collection="ndc_collections")
+
+        query = self.collections_query(q=q)
+        cursor = ndc_collections_db.find(query, {"_id": 0}).batch_size(batch_size)
+
+        return stream_records(cursor, output_format=output_format, container="collections")
+
+    def query_shapes(self, q="geology", ndc_collection_id="ndc_collection_id"):
+        # Representative forms of every query above, used to verify their plans against the declared indexes
+        range_clause, direction, anchor = self.keyset_range(last_id=ObjectId())
+
+        shapes = [
+            {
+                "name": "query_collections:ndc_collection_id",
+                "collection": "ndc_collections",
+                "filter": self.collections_query(ndc_collection_id=ndc_collection_id)
+            },
+            {
+                "name": "query_collections:q",
+                "collection": "ndc_collections",
+                "filter": self.collections_query(q=q)
+            },
+            {
+                "name": "query_files:ndc_collection_id",
+                "collection": "ndc_file_summaries",
+                "filter": self.file_summaries_query(ndc_collection_id=ndc_collection_id)
+            },
+            {
+                "name": "query_files",
+                "collection": "ndc_file_summaries",
+                "filter": self.file_summaries_query(),
+                "sort": [("_id", ASCENDING)]
+            },
+            {
+                "name": "query_organizations",
+                "collection": "ndc_organizations",
+                "filter": {},
+                "sort": [("_id", ASCENDING)]
+            }
+        ]
+
+        for name, item_filters in [
+            ("query_items:ndc_collection_id", {"ndc_collection_id": ndc_collection_id}),
+            ("query_items:q", {"q": q}),
+            ("query_items:q+ndc_collection_id", {"q": q, "ndc_collection_id": ndc_collection_id}),
+            ("query_items:bbox", {"bbox": (-125, 25, -65, 50)}),
+            ("query_items:distance+ndc_collection_id", {"distance": (-105, 40, 50000),
+                                                        "ndc_collection_id": ndc_collection_id})
+        ]:
+            for page, clauses in [
+                ("first", self.items_query(**item_filters)),
+                ("next", self.items_query(**item_filters) + [range_clause])
+            ]:
+                shapes.append(
+                    {
+                        "name": f"{name}:{page}",
+                        "collection": "ndc_items",
+                        "filter": self.combine_clauses(clauses),
+                        "sort": [("_id", direction)]
+                    }
+                )
+
+        return shapes
+
+    def check_query_plans(self):
+        return Indexes(serverful_infrastructure=self.serverful_infrastructure).check_query_plans(self.query_shapes())
+
 
 class Search:
-    def __init__(self):
-        self.es = Elasticsearch(hosts=[os.environ["AWS_HOST_Elasticsearch"]])
+    def __init__(self, response_cache=None, query_cache_ttl=5.0, es=None, track_total_hits=None, major_version=None):
+        if es is None:
+            es = Connect().elastic_client()
+        self.es = es
         self.default_filter_path = 'hits'
+        # Renewed by every page, so a point in time left behind by a client that stops paging expires quickly
+        self.pit_keep_alive = "1m"
+        # Tiebreaker for clusters without point in time; a keyword, so it sorts from doc values
+        self.tiebreaker_field = "ndc_item_id"
+
+        # Read from the cluster the first time a query depends on it; pass it in to skip the info() call
+        self.major_version = major_version
+
+        # Hits counted exactly before totals become a lower bound (True counts everything);
+        # None leaves it to the cluster, which is 10,000 on 7.x and exact on 6.x
+        self.track_total_hits = track_total_hits
+
+        # Facet names exposed to clients and the item fields they count over
+        self.facet_fields = OrderedDict([
+            ("collection", "ndc_collection_id"),
+            ("owner", "ndc_collection_owner"),
+            ("datatype", "datatype"),
+            ("state", "state")
+        ])
+        self.facet_date_field = "date"
         self.serverful_infrastructure = Infrastructure()
+        self.response_cache = response_cache
+
+        # A few seconds is enough to fold a burst of identical queries into one round trip
+        if query_cache_ttl:
+            self.query_cache = ResponseCache(local=LRUCache(max_entries=512, ttl=query_cache_ttl))
+        else:
+            self.query_cache = None
 
         self.query_all = {
             "query": {
@@ -213,8 +607,17 @@ class Search:
             }
         }
 
-    def index_search(self, index_name, q, filter_path=None):
-        query = {
+    def cluster_major_version(self):
+        if self.major_version is None:
+            self.major_version = int(self.es.info()["version"]["number"].split(".")[0])
+        return self.major_version
+
+    def uses_mapping_types(self):
+        # Documents indexed on 7.x are typeless (_doc), so a type clause there matches nothing
+        return self.cluster_major_version() < 7
+
+    def query_string_query(self, q):
+        return {
             "query": {
                 "query_string": {
                     "default_field": "*",
@@ -222,73 +625,518 @@ class Search:
                 }
             }
         }
-        return self.execute_query(index=index_name, query=query, filter_path=filter_path)
 
-    def index_stats(self, index_name):
+    @instrumented("rest_api.search.index_search", "elasticsearch")
+    def index_search(self, index_name, q, filter_path=None):
+        return self.execute_query(index=index_name, query=self.query_string_query(q), filter_path=filter_path)
+
+    def with_total_hits(self, query):
+        # A threshold the caller put in the query wins over ours
+        if self.track_total_hits is None or "track_total_hits" in query:
+            return query
+
+        body = dict(query)
+        body["track_total_hits"] = self.track_total_hits
+        return body
+
+    def hits_total(self, res):
+        # 7.x reports {"value": n, "relation": "eq" | "gte"}; 6.x always counts and reports a plain number.
+        # With track_total_hits false there is no total at all, which packages report as (None, None)
+        total = res.get("hits", {}).get("total")
+        if total is None:
+            return None
+        elif isinstance(total, dict):
+            return total["value"], total.get("relation", "eq")
+        else:
+            return total, "eq"
+
+    def cached_query(self, name, params, compute):
+        if self.query_cache is None:
+            return compute()
+
+        # Concurrent identical requests share one ES call; each caller gets its own copy to modify
+        key = self.query_cache.make_key(name, params, {})
+        return copy.deepcopy(self.query_cache.get_or_compute(key, compute))
+
+    def fetch_index_stats(self, index_name):
         simple_stats = {
             "index_exists": False
         }
 
-        if index_name not in self.es.indices.get_alias().keys():
+        if not self.es.indices.exists(index=index_name):
             return simple_stats
         else:
-            simple_stats["index_exists"] = True
-            stats = self.es.indices.stats(index_name)["indices"][index_name]["primaries"]
-            simple_stats["doc_count"] = stats["docs"]["count"]
-            simple_stats["size_in_bytes"] = stats["store"]["size_in_bytes"]
-            return simple_stats
+            return self.package_index_stats(index_name, self.es.indices.stats(index=index_name))
+
+    def package_index_stats(self, index_name, index_stats):
+        stats = index_stats["indices"][index_name]["primaries"]
+        return {
+            "index_exists": True,
+            "doc_count": stats["docs"]["count"],
+            "size_in_bytes": stats["store"]["size_in_bytes"]
+        }
 
-    def query_items(self, q=None, collection_id=None, size=20):
+    @instrumented("rest_api.search.index_stats", "elasticsearch")
+    def index_stats(self, index_name):
+        return self.cached_query("Search.index_stats", [index_name], lambda: self.fetch_index_stats(index_name))
+
+    def items_index(self, collection_id=None):
         if collection_id is None:
-            index_name = "_all"
+            return "_all"
         else:
-            index_name = collection_id
+            return collection_id
+
+    def spatial_filters(self, bbox=None, distance=None, polygon=None):
+        # bbox is (west, south, east, north), distance is (lon, lat, meters) and polygon a list of (lon, lat)
+        filters = list()
+
+        if bbox is not None:
+            west, south, east, north = bbox
+            filters.append({
+                "geo_bounding_box": {
+                    "ndc_geopoint": {
+                        "top_left": {"lat": north, "lon": west},
+                        "bottom_right": {"lat": south, "lon": east}
+                    }
+                }
+            })
+
+        if distance is not None:
+            lon, lat, meters = distance
+            filters.append({
+                "geo_distance": {
+                    "distance": f"{meters}m",
+                    "ndc_geopoint": {"lat": lat, "lon": lon}
+                }
+            })
+
+        if polygon is not None:
+            filters.append({
+                "geo_polygon": {
+                    "ndc_geopoint": {
+                        "points": [{"lat": lat, "lon": lon} for lon, lat in polygon]
+                    }
+                }
+            })
+
+        return filters
 
-        if q is None or q == "*":
+    def items_query(self, q=None, bbox=None, distance=None, polygon=None):
+        query = self.text_items_query(q=q)
+
+        filters = self.spatial_filters(bbox=bbox, distance=distance, polygon=polygon)
+        if len(filters) > 0:
             query = {
                 "query": {
+                    "bool": {
+                        "must": [query["query"]],
+                        "filter": filters
+                    }
+                }
+            }
+
+        return query
+
+    def item_type_clauses(self):
+        if self.uses_mapping_types():
+            return [
+                {
                     "type": {
                         "value": "ndc_collection_item"
                     }
                 }
+            ]
+        return []
+
+    def text_items_query(self, q=None):
+        clauses = self.item_type_clauses()
+        if q is not None and q != "*":
+            clauses.append(
+                {
+                    "multi_match": {
+                        "query": q,
+                        "fields": [
+                            "title^3",
+                            "abstract^2",
+                            "supplementalinformation",
+                            "supplementalinformation.info",
+                            "ndc_collection_abstract"
+                        ]
+                    }
+                }
+            )
+
+        if len(clauses) == 0:
+            query = {
+                "query": {
+                    "match_all": {}
+                }
+            }
+        elif len(clauses) == 1:
+            query = {
+                "query": clauses[0]
             }
         else:
             query = {
                 "query": {
                     "bool": {
-                        "must": [
-                            {
-                                "type": {
-                                    "value": "ndc_collection_item"
-                                }
-                            },
-                            {
-                                "multi_match": {
-                                    "query": q,
-                                    "fields": [
-                                        "title^3",
-                                        "abstract^2",
-                                        "supplementalinformation",
-                                        "supplementalinformation.info",
-                                        "ndc_collection_abstract"
-                                    ]
-                                }
-                            }
-                        ]
+                        "must": clauses
                     }
                 }
             }
 
-        res = self.es.search(
+        return query
+
+    @instrumented("rest_api.search.query_items", "elasticsearch")
+    def query_items(self, q=None, collection_id=None, size=20, cursor=None, use_pit=True,
+                    bbox=None, distance=None, polygon=None):
+        index_name = self.items_index(collection_id=collection_id)
+        query = self.items_query(q=q, bbox=bbox, distance=distance, polygon=polygon)
+
+        return self.paged_search(
             index=index_name,
+            query=query,
             size=size,
+            cursor=cursor,
             filter_path=['hits'],
-            body=query
+            use_pit=use_pit
+        )
+
+    def facet_aggregations(self, facets, size=10, date_field=None):
+        if date_field is None:
+            date_field = self.facet_date_field
+
+        aggregations = dict()
+        for facet in facets:
+            if facet == "decade":
+                # Yearly buckets rolled up into decades afterwards; there is no calendar decade interval
+                aggregations["decade"] = {
+                    "date_histogram": {
+                        "field": date_field,
+                        "interval": "year",
+                        "format": "yyyy",
+                        "min_doc_count": 1
+                    }
+                }
+            elif facet in self.facet_fields:
+                if isinstance(size, dict):
+                    bucket_limit = size.get(facet, 10)
+                else:
+                    bucket_limit = size
+
+                field = f"{self.facet_fields[facet]}.keyword"
+                aggregations[facet] = {
+                    "terms": {
+                        "field": field,
+                        "size": bucket_limit
+                    }
+                }
+                aggregations[f"{facet}_distinct"] = {
+                    "cardinality": {
+                        "field": field
+                    }
+                }
+            else:
+                raise ValueError(f"Unknown facet: {facet}")
+
+        return aggregations
+
+    @instrumented("rest_api.search.query_facets", "elasticsearch")
+    def query_facets(self, q=None, collection_id=None, facets=None, size=10, date_field=None,
+                     bbox=None, distance=None, polygon=None):
+        if facets is None:
+            facets = self.default_facets()
+
+        res = self.es.search(
+            **self.facets_request(
+                q=q,
+                collection_id=collection_id,
+                facets=facets,
+                size=size,
+                date_field=date_field,
+                bbox=bbox,
+                distance=distance,
+                polygon=polygon
+            )
+        )
+
+        return self.package_facets(res, facets)
+
+    def default_facets(self):
+        return list(self.facet_fields.keys()) + ["decade"]
+
+    def facets_request(self, q=None, collection_id=None, facets=None, size=10, date_field=None,
+                       bbox=None, distance=None, polygon=None):
+        query = dict(self.with_total_hits(self.items_query(q=q, bbox=bbox, distance=distance, polygon=polygon)))
+        query["aggs"] = self.facet_aggregations(facets, size=size, date_field=date_field)
+
+        return {
+            "index": self.items_index(collection_id=collection_id),
+            "size": 0,
+            "filter_path": ['hits.total', 'aggregations'],
+            "body": query
+        }
+
+    def package_facets(self, res, facets):
+        aggregations = res.get("aggregations", {})
+
+        facet_results = OrderedDict()
+        for facet in facets:
+            buckets = aggregations.get(facet, {}).get("buckets", [])
+
+            if facet == "decade":
+                decades = OrderedDict()
+                for bucket in buckets:
+                    decade = f"{bucket['key_as_string'][:3]}0s"
+                    decades[decade] = decades.get(decade, 0) + bucket["doc_count"]
+                facet_results[facet] = {
+                    "distinct": len(decades),
+                    "buckets": [{"key": k, "count": v} for k, v in decades.items()]
+                }
+            else:
+                facet_results[facet] = {
+                    "distinct": aggregations.get(f"{facet}_distinct", {}).get("value", 0),
+                    "other": aggregations.get(facet, {}).get("sum_other_doc_count", 0),
+                    "buckets": [{"key": b["key"], "count": b["doc_count"]} for b in buckets]
+                }
+
+        result_package = OrderedDict()
+        result_package["total"], result_package["total_relation"] = self.hits_total(res) or (None, None)
+        result_package["facets"] = facet_results
+
+        return result_package
+
+    def grid_precision(self, zoom, grid="geotile_grid"):
+        if grid == "geotile_grid":
+            return max(0, min(29, int(zoom)))
+        elif grid == "geohash_grid":
+            # Roughly the geohash length whose cells match a map tile at this zoom
+            return max(1, min(12, int((zoom + 2) / 2.5)))
+        else:
+            raise ValueError(f"Unsupported grid aggregation: {grid}")
+
+    @instrumented("rest_api.search.query_geo_clusters", "elasticsearch")
+    def query_geo_clusters(self, q=None, collection_id=None, zoom=4, grid="geotile_grid", size=10000,
+                           bbox=None, distance=None, polygon=None):
+        res = self.es.search(
+            **self.geo_clusters_request(
+                q=q,
+                collection_id=collection_id,
+                zoom=zoom,
+                grid=grid,
+                size=size,
+                bbox=bbox,
+                distance=distance,
+                polygon=polygon
+            )
         )
 
+        return self.package_geo_clusters(res, zoom, grid)
+
+    def geo_clusters_request(self, q=None, collection_id=None, zoom=4, grid="geotile_grid", size=10000,
+                             bbox=None, distance=None, polygon=None):
+        query = dict(self.with_total_hits(self.items_query(q=q, bbox=bbox, distance=distance, polygon=polygon)))
+        query["aggs"] = {
+            "clusters": {
+                grid: {
+                    "field": "ndc_geopoint",
+                    "precision": self.grid_precision(zoom, grid=grid),
+                    "size": size
+                },
+                "aggs": {
+                    "centroid": {
+                        "geo_centroid": {
+                            "field": "ndc_geopoint"
+                        }
+                    }
+                }
+            }
+        }
+
+        return {
+            "index": self.items_index(collection_id=collection_id),
+            "size": 0,
+            "filter_path": ['hits.total', 'aggregations'],
+            "body": query
+        }
+
+    def package_geo_clusters(self, res, zoom, grid):
+        clusters = list()
+        for bucket in res.get("aggregations", {}).get("clusters", {}).get("buckets", []):
+            clusters.append(
+                {
+                    "key": bucket["key"],
+                    "count": bucket["doc_count"],
+                    "centroid": bucket["centroid"].get("location")
+                }
+            )
+
+        result_package = OrderedDict()
+        result_package["total"], result_package["total_relation"] = self.hits_total(res) or (None, None)
+        result_package["zoom"] = zoom
+        result_package["grid"] = grid
+        result_package["clusters"] = clusters
+
+        return result_package
+
+    def open_point_in_time(self, index, keep_alive=None):
+        if keep_alive is None:
+            keep_alive = self.pit_keep_alive
+
+        try:
+            return self.es.open_point_in_time(index=index, keep_alive=keep_alive)["id"]
+        except (AttributeError, TransportError):
+            # Point in time needs Elasticsearch 7.10+; older clusters page on the tiebreaker field instead
+            return None
+
+    def close_point_in_time(self, pit_id):
+        if pit_id is None:
+            return
+
+        try:
+            self.es.close_point_in_time(body={"id": pit_id})
+        except (AttributeError, TransportError):
+            pass
+
+    def stable_sort(self, sort=None, pit=False):
+        if sort is None:
+            sort = [{"_score": "desc"}]
+        else:
+            sort = list(sort)
+
+        if pit:
+            sort.append({"_shard_doc": "asc"})
+        else:
+            # Not _id, which sorts from fielddata on the heap and is refused by 8.x. Indexes without the
+            # field still sort, with ties among their hits left unbroken.
+            sort.append({
+                self.tiebreaker_field: {
+                    "order": "asc",
+                    "missing": "_last",
+                    "unmapped_type": "keyword"
+                }
+            })
+
+        return sort
+
+    def paged_search(self, index, query, size=20, cursor=None, filter_path=None, use_pit=True, keep_alive=None):
+        if keep_alive is None:
+            keep_alive = self.pit_keep_alive
+
+        search_after, pit_id, known_total = self.cursor_position(cursor)
+        if cursor is None and use_pit:
+            pit_id = self.open_point_in_time(index, keep_alive=keep_alive)
+
+        res = self.es.search(
+            **self.paged_search_request(
+                index,
+                query,
+                size=size,
+                search_after=search_after,
+                pit_id=pit_id,
+                filter_path=filter_path,
+                keep_alive=keep_alive,
+                known_total=known_total
+            )
+        )
+
+        res, finished_pit = self.package_page(res, size, pit_id, known_total=known_total)
+        self.close_point_in_time(finished_pit)
+
         return res
 
-    def package_collection_result(self, result_list, base_url="/"):
+    def cursor_position(self, cursor):
+        if cursor is None:
+            return None, None, None
+
+        position = decode_cursor(cursor, key="search_after")
+        known_total = position.get("total")
+        if known_total is not None:
+            known_total = tuple(known_total)
+
+        return position["search_after"], position.get("pit"), known_total
+
+    def paged_search_request(self, index, query, size=20, search_after=None, pit_id=None, filter_path=None,
+                             keep_alive=None, known_total=None):
+        # The first page counts; later pages carry that total in the cursor and skip counting altogether
+        if known_total is None:
+            body = dict(self.with_total_hits(query))
+        else:
+            body = dict(query)
+            body["track_total_hits"] = False
+
+        if search_after is not None:
+            body["search_after"] = search_after
+
+        body["sort"] = self.stable_sort(query.get("sort"), pit=pit_id is not None)
+
+        # A point in time carries its own index, so the search itself must not name one
+        search_index = index
+        if pit_id is not None:
+            body["pit"] = {"id": pit_id, "keep_alive": keep_alive}
+            search_index = None
+
+        if filter_path is None:
+            filter_path = self.default_filter_path
+        if isinstance(filter_path, str):
+            filter_path = filter_path.split(",")
+        filter_path = list(filter_path) + ["hits.hits.sort", "pit_id"]
+
+        return {
+            "index": search_index,
+            "size": size,
+            "filter_path": filter_path,
+            "body": body
+        }
+
+    def package_page(self, res, size, pit_id=None, known_total=None):
+        # Returns the page along with the point in time to close once the last page has been read
+        pit_id = res.pop("pit_id", pit_id)
+        hits = res.get("hits", {}).get("hits", [])
+
+        total = known_total
+        if total is None:
+            total = self.hits_total(res)
+        if total is not None:
+            res["total"], res["total_relation"] = total
+
+        if len(hits) > 0 and len(hits) == size:
+            position = {"search_after": hits[-1]["sort"], "pit": pit_id}
+            if total is not None:
+                position["total"] = list(total)
+            res["next_cursor"] = encode_cursor(position)
+            return res, None
+        else:
+            res["next_cursor"] = None
+            return res, pit_id
+
+    def scan_query(self, query=None):
+        # Index order only, no scoring, so each batch is a cheap continuation of the last
+        if query is None:
+            query = self.query_all
+        return dict(query, sort=[])
+
+    def scan_index(self, index, query=None, batch_size=1000, keep_alive="1m"):
+        query = self.scan_query(query)
+
+        cursor = None
+        while True:
+            res = self.paged_search(
+                index=index,
+                query=query,
+                size=batch_size,
+                cursor=cursor,
+                keep_alive=keep_alive
+            )
+
+            for hit in res.get("hits", {}).get("hits", []):
+                yield hit
+
+            cursor = res["next_cursor"]
+            if cursor is None:
+                break
+
+    def package_collection_result(self, result_list, base_url="/", total=None, total_relation="eq"):
         recordset = list()
         for collection_record in result_list:
             del collection_record["_id"]
@@ -298,8 +1146,13 @@ class Search:
                 }
             recordset.append(collection_record)
 
+        # Counting the list is only right when nobody said the total was unknown
+        if total is None and total_relation == "eq":
+            total = len(result_list)
+
         result_package = {
-            "total": len(result_list),
+            "total": total,
+            "total_relation": total_relation,
             "selflink": {
                 "rel": "self",
                 "url": base_url
@@ -309,8 +1162,7 @@ class Search:
 
         return result_package
 
-    def query_collections(self, q=None, collection_id=None, size=20, base_url=None):
-        index_name = "processed_collections"
+    def collections_query(self, q=None, collection_id=None):
         if collection_id is not None:
             query = {
                 "query": {
@@ -335,6 +1187,15 @@ class Search:
                         }
                     }
                 }
+
+        return query
+
+    @instrumented("rest_api.search.query_collections", "elasticsearch")
+    @cached_response
+    def query_collections(self, q=None, collection_id=None, size=20, base_url=None):
+        index_name = "processed_collections"
+        query = self.with_total_hits(self.collections_query(q=q, collection_id=collection_id))
+
         result = self.es.search(
             index=index_name,
             size=size,
@@ -342,44 +1203,119 @@ class Search:
             body=query
         )
 
+        return self.package_collection_hits(result, base_url=base_url)
+
+    def package_collection_hits(self, result, base_url=None):
         recordset = list()
         for collection in result["hits"]["hits"]:
             recordset.append(collection["_source"])
 
-        return self.package_collection_result(result_list=recordset, base_url=base_url)
+        total, total_relation = self.hits_total(result) or (None, None)
+
+        return self.package_collection_result(
+            result_list=recordset,
+            base_url=base_url,
+            total=total,
+            total_relation=total_relation
+        )
 
+    @instrumented("rest_api.search.query_collections_all", "elasticsearch")
     def query_collections_all(self):
-        return self.execute_query(index="processed_collections", size=1000, query=self.query_all)
+        hits = self.cached_query(
+            "Search.query_collections_all",
+            ["processed_collections"],
+            lambda: list(self.scan_index(index="processed_collections"))
+        )
+
+        return self.package_all_hits(hits)
 
+    def package_all_hits(self, hits):
+        return {
+            "hits": {
+                "total": len(hits),
+                "hits": hits
+            }
+        }
+
+    @instrumented("rest_api.search.query_collection_file_reports", "elasticsearch")
     def query_collection_file_reports(self, ndc_collection_id, filter_path=None):
-        query = {
+        return self.execute_query(
+            index="file_reports",
+            query=self.file_reports_query(ndc_collection_id),
+            filter_path=filter_path
+        )
+
+    def file_reports_query(self, ndc_collection_id):
+        return {
             "query": {
                 "match": {
                     "ndc_collection_id": ndc_collection_id
                 }
             }
         }
-        return self.execute_query(index="file_reports", query=query, filter_path=filter_path)
 
+    @instrumented("rest_api.search.query_file_metadata", "elasticsearch")
     def query_file_metadata(self, aws_s3_key, filter_path=None):
-        query = {
+        return self.execute_query(
+            index="processing_log",
+            query=self.file_metadata_query(aws_s3_key),
+            filter_path=filter_path
+        )
+
+    def file_metadata_query(self, aws_s3_key):
+        return {
             "query": {
                 "term": {
                     "log_entry.aws_s3_key": aws_s3_key
                 }
             }
         }
-        return self.execute_query(index="processing_log", query=query, filter_path=filter_path)
 
-    def execute_query(self, query, index, size=20, filter_path=None):
+    def export_items(self, q=None, collection_id=None, output_format="ndjson", batch_size=1000,
+                     bbox=None, distance=None, polygon=None):
+        hits = self.scan_index(
+            index=self.items_index(collection_id=collection_id),
+            query=self.items_query(q=q, bbox=bbox, distance=distance, polygon=polygon),
+            batch_size=batch_size
+        )
+
+        return stream_records((hit["_source"] for hit in hits), output_format=output_format, container="items")
+
+    def export_collections(self, q=None, output_format="ndjson", batch_size=1000):
+        hits = self.scan_index(
+            index="processed_collections",
+            query=self.collections_query(q=q),
+            batch_size=batch_size
+        )
+
+        return stream_records((hit["_source"] for hit in hits), output_format=output_format, container="collections")
+
+    @instrumented("rest_api.search.execute_query", "elasticsearch")
+    def execute_query(self, query, index, size=20, filter_path=None, cursor=None, paginate=False,
+                      use_pit=True):
+        if cursor is not None or paginate:
+            return self.paged_search(
+                index=index,
+                query=query,
+                size=size,
+                cursor=cursor,
+                filter_path=filter_path,
+                use_pit=use_pit
+            )
+
         if filter_path is None:
             filter_path = self.default_filter_path
 
-        results = self.es.search(
-            index=index,
-            size=size,
-            filter_path=filter_path,
-            body=query
+        query = self.with_total_hits(query)
+        results = self.cached_query(
+            "Search.execute_query",
+            [query, index, size, filter_path],
+            lambda: self.es.search(
+                index=index,
+                size=size,
+                filter_path=filter_path,
+                body=query
+            )
         )
 
         return results
@@ -389,29 +1325,16 @@ class Maintenance:
     def __init__(self):
         aws_connect = Connect()
         self.sqs = aws_connect.aws_client("SQS")
+        self.messaging = Messaging()
 
     def list_queues(self):
         return self.sqs.list_queues()["QueueUrls"]
 
     def check_messages(self, QueueName):
-        QueueUrl = self.sqs.create_queue(QueueName=QueueName)["QueueUrl"]
-
-        response = self.sqs.receive_message(
-            QueueUrl=QueueUrl,
-            AttributeNames=[
-                'SentTimestamp'
-            ],
-            MaxNumberOfMessages=10,
-            MessageAttributeNames=[
-                'All'
-            ],
-            VisibilityTimeout=0,
-            WaitTimeSeconds=0
-        )
+        # Peeks without hiding messages from consumers; claim-checked bodies come back resolved from S3
+        messages = self.messaging.get_messages(QueueName, max_messages=10)
 
-        if "Messages" not in response.keys() or len(response['Messages']) == 0:
+        if len(messages) == 0:
             return None
 
-        return [json.loads(m["Body"]) for m in response["Messages"]]
-
-
+        return [m["Body"] for m in messages]
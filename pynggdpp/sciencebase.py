@@ -1,7 +1,9 @@
 from datetime import datetime
-import requests
 from sciencebasepy import SbSession
 
+from .metrics import metrics
+from .throttle import http_get, throttle
+
 
 class Organizations:
     def __init__(self):
@@ -25,7 +27,7 @@ class Organizations:
         elif type == 'id':
             sb_api = f"{sb_api}&fields=id"
 
-        sb_r = requests.get(sb_api).json()
+        sb_r = http_get(sb_api).json()
 
         if type == 'full':
             items = list()
@@ -53,7 +55,7 @@ class Collections:
         vocab_search_url = f'{self.sb_vocab_path}/' \
                            f'{self.ndc_vocab_id}/' \
                            f'terms?nodeType=term&format=json&name={tag_name}'
-        r_vocab_search = requests.get(vocab_search_url).json()
+        r_vocab_search = http_get(vocab_search_url).json()
         if len(r_vocab_search['list']) == 1:
             tag = {'name': r_vocab_search['list'][0]['name'], 'scheme': r_vocab_search['list'][0]['scheme']}
             if include_type:
@@ -74,15 +76,17 @@ class Collections:
             params["q"] = query
 
         sb_collections = list()
-        response = self.sb.find_items(params)
+        with throttle.slot("www.sciencebase.gov"), metrics.timed("sciencebase.find_items", "www.sciencebase.gov"):
+            response = self.sb.find_items(params)
         while response and "items" in response:
             sb_collections.extend(response["items"])
-            response = self.sb.next(response)
+            with throttle.slot("www.sciencebase.gov"), metrics.timed("sciencebase.find_items", "www.sciencebase.gov"):
+                response = self.sb.next(response)
 
         return sb_collections
 
     def ndc_collection_record(self, collection_id):
-        r = requests.get(f"{self.sb_catalog_path}?"
+        r = http_get(f"{self.sb_catalog_path}?"
                          f"id={collection_id}&"
                          f"format=json&"
                          f"fields={self.sb_default_props}"
@@ -127,7 +131,7 @@ class Collections:
                 collection_meta["ndc_collection_owner_api"] = \
                     f"{self.sb_party_root}{data_owner_contact['oldPartyId']}"
 
-                r_sb_party = requests.get(f'{collection_meta["ndc_collection_owner_api"]}?format=json')
+                r_sb_party = http_get(f'{collection_meta["ndc_collection_owner_api"]}?format=json')
                 if r_sb_party.status_code == 200:
                     sb_party = r_sb_party.json()
                     collection_meta["ndc_collection_owner_link"] = sb_party["url"]
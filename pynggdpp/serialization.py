@@ -0,0 +1,87 @@
+import json
+from datetime import date, datetime, time
+from decimal import Decimal
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from elasticsearch.serializer import JSONSerializer
+except ImportError:
+    JSONSerializer = object
+
+
+if orjson is not None:
+    orjson_options = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+
+def default(obj):
+    # Everything orjson handles natively gets the same treatment here, so both backends write the same JSON
+    if isinstance(obj, (datetime, date, time)):
+        return obj.isoformat()
+    elif isinstance(obj, np.integer):
+        return int(obj)
+    elif isinstance(obj, np.floating):
+        return None if np.isnan(obj) else float(obj)
+    elif isinstance(obj, np.bool_):
+        return bool(obj)
+    elif isinstance(obj, np.ndarray):
+        return obj.tolist()
+    elif isinstance(obj, Decimal):
+        return float(obj)
+    elif isinstance(obj, (set, frozenset)):
+        return list(obj)
+    elif isinstance(obj, bytes):
+        return obj.decode("utf-8", errors="replace")
+    elif hasattr(obj, "__geo_interface__"):
+        return obj.__geo_interface__
+
+    # ObjectIds, UUIDs, exceptions and the like
+    return str(obj)
+
+
+def dumpb(data):
+    if orjson is not None:
+        return orjson.dumps(data, default=default, option=orjson_options)
+    else:
+        return json.dumps(data, default=default, separators=(",", ":")).encode("utf-8")
+
+
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data, default=default, option=orjson_options).decode("utf-8")
+    else:
+        return json.dumps(data, default=default, separators=(",", ":"))
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    else:
+        return json.loads(data)
+
+
+def ndjson_lines(records):
+    for record in records:
+        yield dumpb(record) + b"\n"
+
+
+def dumpb_ndjson(records):
+    return b"".join(ndjson_lines(records))
+
+
+class ElasticsearchSerializer(JSONSerializer):
+    mimetype = "application/json"
+
+    def dumps(self, data):
+        # The bulk helper hands over action lines it has already encoded
+        if isinstance(data, str):
+            return data
+        return dumps(data)
+
+    def loads(self, s):
+        return loads(s)
@@ -1,17 +1,25 @@
 from pymongo import MongoClient
+from pymongo import ASCENDING, GEOSPHERE, TEXT
+from pymongo.errors import OperationFailure
 import os
 
+from .metrics import MongoCommandListener
+
+
+def mongo_uri():
+    return "mongodb://" + os.environ["MONGODB_USERNAME"] \
+        + ":" \
+        + os.environ["MONGODB_PASSWORD"] \
+        + "@" \
+        + os.environ["MONGODB_SERVER"] \
+        + "/" \
+        + os.environ["MONGODB_DATABASE"]
+
 
 class Infrastructure:
     def __init__(self):
-        self.mongo_uri = "mongodb://" + os.environ["MONGODB_USERNAME"] \
-                    + ":" \
-                    + os.environ["MONGODB_PASSWORD"] \
-                    + "@" \
-                    + os.environ["MONGODB_SERVER"] \
-                    + "/" \
-                    + os.environ["MONGODB_DATABASE"]
-        self.mongo_client = MongoClient(self.mongo_uri)
+        self.mongo_uri = mongo_uri()
+        self.mongo_client = MongoClient(self.mongo_uri, event_listeners=[MongoCommandListener()])
 
     def connect_mongodb(self, collection=None):
         db = self.mongo_client.get_database(os.environ["MONGODB_DATABASE"])
@@ -21,3 +29,180 @@ class Infrastructure:
         else:
             return db
 
+
+class Indexes:
+    def __init__(self, serverful_infrastructure=None):
+        if serverful_infrastructure is None:
+            serverful_infrastructure = Infrastructure()
+        self.serverful_infrastructure = serverful_infrastructure
+
+        # MongoDB allows a single text index per collection, so each one carries all of the searchable fields
+        self.required_indexes = {
+            "ndc_collections": [
+                {
+                    "name": "ndc_collections_text",
+                    "keys": [
+                        ("ndc_collection_title", TEXT),
+                        ("ndc_collection_abstract", TEXT),
+                        ("ndc_collection_owner", TEXT)
+                    ],
+                    "weights": {
+                        "ndc_collection_title": 3,
+                        "ndc_collection_abstract": 2
+                    }
+                },
+                {
+                    "name": "ndc_collection_id",
+                    "keys": [("ndc_collection_id", ASCENDING)]
+                },
+                {
+                    "name": "ndc_collection_owner",
+                    "keys": [("ndc_collection_owner", ASCENDING)]
+                }
+            ],
+            "ndc_files": [
+                {
+                    "name": "ndc_collection_id",
+                    "keys": [("ndc_collection_id", ASCENDING)]
+                },
+                {
+                    "name": "ndc_file_url",
+                    "keys": [("ndc_file_url", ASCENDING)]
+                }
+            ],
+            "ndc_items": [
+                {
+                    "name": "ndc_items_text",
+                    "keys": [
+                        ("title", TEXT),
+                        ("abstract", TEXT),
+                        ("supplementalinformation", TEXT),
+                        ("ndc_collection_abstract", TEXT)
+                    ],
+                    "weights": {
+                        "title": 3,
+                        "abstract": 2
+                    }
+                },
+                {
+                    "name": "ndc_collection_id_pagination",
+                    "keys": [("ndc_collection_id", ASCENDING), ("_id", ASCENDING)]
+                },
+                {
+                    "name": "ndc_location_2dsphere",
+                    "keys": [("ndc_location", GEOSPHERE)]
+                }
+            ],
+            "ndc_response_cache": [
+                {
+                    "name": "cached_expiration",
+                    "keys": [("cached", ASCENDING)],
+                    "expireAfterSeconds": 3600
+                }
+            ]
+        }
+
+    def ensure_indexes(self, collections=None):
+        results = list()
+
+        for collection_name, index_specs in self.required_indexes.items():
+            if collections is not None and collection_name not in collections:
+                continue
+
+            db_collection = self.serverful_infrastructure.connect_mongodb(collection=collection_name)
+            existing_indexes = db_collection.index_information()
+
+            for index_spec in index_specs:
+                result = {
+                    "collection": collection_name,
+                    "name": index_spec["name"]
+                }
+
+                existing_index = existing_indexes.get(index_spec["name"])
+                if existing_index is not None:
+                    if self.index_keys_match(index_spec, existing_index):
+                        result["status"] = "exists"
+                    else:
+                        # Same name, different index: creating ours would fail, and queries won't use what's there
+                        result["status"] = "conflict"
+                        result["error"] = f"Index {index_spec['name']} exists with keys {list(existing_index['key'])}"
+                else:
+                    options = {k: v for k, v in index_spec.items() if k != "keys"}
+                    try:
+                        db_collection.create_index(index_spec["keys"], **options)
+                        result["status"] = "created"
+                    except OperationFailure as e:
+                        # Usually an equivalent index already exists under another name
+                        result["status"] = "conflict"
+                        result["error"] = str(e)
+
+                results.append(result)
+
+        return results
+
+    def index_keys_match(self, index_spec, existing_index):
+        text_fields = [field for field, kind in index_spec["keys"] if kind == TEXT]
+        if len(text_fields) > 0:
+            # Text indexes are stored under _fts/_ftsx keys, with the indexed fields listed in weights
+            return sorted(existing_index.get("weights", {}).keys()) == sorted(text_fields)
+
+        return [tuple(k) for k in existing_index["key"]] == [tuple(k) for k in index_spec["keys"]]
+
+    def plan_stages(self, explain_document):
+        stages = list()
+
+        if isinstance(explain_document, dict):
+            for k, v in explain_document.items():
+                if k == "stage" and isinstance(v, str):
+                    stages.append(v)
+                elif k not in ["rejectedPlans", "allPlansExecution"]:
+                    stages.extend(self.plan_stages(v))
+        elif isinstance(explain_document, list):
+            for v in explain_document:
+                stages.extend(self.plan_stages(v))
+
+        return stages
+
+    def explain_query_shape(self, query_shape):
+        db = self.serverful_infrastructure.connect_mongodb()
+
+        if "pipeline" in query_shape:
+            return db.command(
+                "aggregate",
+                query_shape["collection"],
+                pipeline=query_shape["pipeline"],
+                explain=True
+            )
+        else:
+            cursor = db[query_shape["collection"]].find(query_shape["filter"])
+            if "sort" in query_shape:
+                cursor = cursor.sort(query_shape["sort"])
+            return cursor.limit(query_shape.get("limit", 10)).explain()
+
+    def check_query_plans(self, query_shapes):
+        report = list()
+
+        for query_shape in query_shapes:
+            plan_report = {
+                "name": query_shape["name"],
+                "collection": query_shape["collection"],
+                "full_scan_expected": query_shape.get("full_scan_expected", False)
+            }
+
+            try:
+                stages = self.plan_stages(self.explain_query_shape(query_shape))
+            except OperationFailure as e:
+                # $text queries fail outright without a text index
+                plan_report["error"] = str(e)
+                plan_report["ok"] = False
+                report.append(plan_report)
+                continue
+
+            plan_report["stages"] = stages
+            plan_report["collection_scan"] = "COLLSCAN" in stages
+            plan_report["in_memory_sort"] = "SORT" in stages
+            plan_report["ok"] = plan_report["full_scan_expected"] or not plan_report["collection_scan"]
+
+            report.append(plan_report)
+
+        return report
@@ -0,0 +1,158 @@
+from datetime import datetime, timezone
+from io import BytesIO
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+from .aws import Storage
+from .aws import Search as AwsSearch
+from .serverful import Infrastructure
+from .cache import CacheVersion
+from . import serialization
+
+
+class Snapshots:
+    def __init__(self, bucket_name="ndc-snapshots", prefix="snapshots"):
+        if pa is None:
+            raise ImportError("Parquet snapshots require pyarrow (pip install pynggdpp[parquet])")
+
+        self.storage = Storage()
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+
+        # Records vary by source file, so only the columns we filter or sort on are typed;
+        # the full record rides along as JSON
+        self.schema = pa.schema([
+            ("ndc_collection_id", pa.string()),
+            ("ndc_file_url", pa.string()),
+            ("ndc_lon", pa.float64()),
+            ("ndc_lat", pa.float64()),
+            ("date", pa.timestamp("us")),
+            ("ndc_date_file_indexed", pa.timestamp("us")),
+            ("ndc_record", pa.string())
+        ])
+
+    def snapshot_key(self, file_object):
+        ndc_collection_id = file_object.get("ndc_collection_id", "unassigned")
+        file_key = self.storage.url_to_s3_key(file_object["ndc_file_url"])
+        return f"{self.prefix}/ndc_collection_id={ndc_collection_id}/{file_key}.parquet"
+
+    def collection_prefix(self, ndc_collection_id=None):
+        if ndc_collection_id is None:
+            return f"{self.prefix}/"
+        else:
+            return f"{self.prefix}/ndc_collection_id={ndc_collection_id}/"
+
+    def typed_date(self, value):
+        if isinstance(value, str):
+            try:
+                value = datetime.fromisoformat(value)
+            except ValueError:
+                return None
+
+        if not isinstance(value, datetime):
+            return None
+
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+
+        return value
+
+    def typed_coordinate(self, record, axis):
+        if isinstance(record.get("ndc_geopoint"), dict):
+            try:
+                return float(record["ndc_geopoint"][axis])
+            except (KeyError, TypeError, ValueError):
+                return None
+        return None
+
+    def recordset_table(self, file_object, recordset):
+        columns = {name: list() for name in self.schema.names}
+
+        for record in recordset:
+            columns["ndc_collection_id"].append(record.get("ndc_collection_id", file_object.get("ndc_collection_id")))
+            columns["ndc_file_url"].append(file_object["ndc_file_url"])
+            columns["ndc_lon"].append(self.typed_coordinate(record, "lon"))
+            columns["ndc_lat"].append(self.typed_coordinate(record, "lat"))
+            columns["date"].append(self.typed_date(record.get("date")))
+            columns["ndc_date_file_indexed"].append(self.typed_date(record.get("ndc_date_file_indexed")))
+            columns["ndc_record"].append(serialization.dumps(record))
+
+        return pa.Table.from_pydict(columns, schema=self.schema)
+
+    def write_snapshot(self, file_object, recordset):
+        key_name = self.snapshot_key(file_object)
+
+        parquet_buffer = BytesIO()
+        pq.write_table(self.recordset_table(file_object, recordset), parquet_buffer)
+
+        self.storage.put_bytes_to_s3(
+            parquet_buffer.getvalue(),
+            key_name=key_name,
+            bucket_name=self.bucket_name,
+            content_type="application/vnd.apache.parquet"
+        )
+
+        return key_name
+
+    def list_snapshots(self, ndc_collection_id=None):
+        return [
+            k["Key"] for k in self.storage.list_s3_keys(
+                self.bucket_name,
+                prefix=self.collection_prefix(ndc_collection_id)
+            )
+            if k["Key"].endswith(".parquet")
+        ]
+
+    def read_snapshot(self, key_name):
+        snapshot_file = self.storage.get_s3_file(key_name, bucket_name=self.bucket_name)
+        if snapshot_file is None:
+            raise FileNotFoundError(f"No snapshot at s3://{self.bucket_name}/{key_name}")
+        elif isinstance(snapshot_file, str):
+            raise OSError(f"Could not read snapshot s3://{self.bucket_name}/{key_name}: {snapshot_file}")
+
+        parquet_file = pq.ParquetFile(snapshot_file)
+
+        # Row group at a time, so a large snapshot never has to be decoded in one piece
+        for batch in parquet_file.iter_batches(columns=["date", "ndc_record"]):
+            for date, ndc_record in zip(batch.column(0).to_pylist(), batch.column(1).to_pylist()):
+                record = serialization.loads(ndc_record)
+                if date is not None:
+                    record["date"] = date
+                yield record
+
+    def snapshot_records(self, ndc_collection_id=None):
+        for key_name in self.list_snapshots(ndc_collection_id=ndc_collection_id):
+            for record in self.read_snapshot(key_name):
+                yield record
+
+    def load_to_es(self, index_name, doc_type="ndc_collection_item", ndc_collection_id=None):
+        return AwsSearch().bulk_build_es_index(
+            index_name=index_name,
+            doc_type=doc_type,
+            bulk_data=self.snapshot_records(ndc_collection_id=ndc_collection_id)
+        )
+
+    def load_to_mongo(self, collection="ndc_items", ndc_collection_id=None, batch_size=1000):
+        serverful_infrastructure = Infrastructure()
+        target_db = serverful_infrastructure.connect_mongodb(collection=collection)
+
+        inserted = 0
+        batch = list()
+        for record in self.snapshot_records(ndc_collection_id=ndc_collection_id):
+            batch.append(record)
+            if len(batch) == batch_size:
+                inserted += len(target_db.insert_many(batch).inserted_ids)
+                batch = list()
+
+        if len(batch) > 0:
+            inserted += len(target_db.insert_many(batch).inserted_ids)
+
+        if inserted > 0:
+            CacheVersion(serverful_infrastructure=serverful_infrastructure).bump()
+
+        return inserted
@@ -0,0 +1,252 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+
+from .metrics import metrics, url_host
+
+
+throttled_status_codes = [429, 503]
+retryable_status_codes = [429, 500, 502, 503, 504]
+
+
+class TokenBucket:
+    def __init__(self, rate=5.0, burst=10):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency:
+    # Additive increase, multiplicative decrease: creep up while the host keeps up, halve when it pushes back
+    def __init__(self, initial=4, minimum=1, maximum=16):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+
+    def release(self, throttled=False):
+        with self.condition:
+            self.active -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit / 2)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class RetryBudget:
+    # Every request earns a fraction of a retry, so retries can never be more than that share of the traffic
+    def __init__(self, ratio=0.2, minimum=10):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.balance = float(minimum)
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.balance = min(self.balance + self.ratio, self.minimum + 100 * self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            if self.balance < 1:
+                return False
+            self.balance -= 1
+            return True
+
+
+class HostThrottle:
+    def __init__(self, host, rate=5.0, burst=10, concurrency=4, max_concurrency=16, retry_ratio=0.2):
+        self.host = host
+        self.bucket = TokenBucket(rate=rate, burst=burst)
+        self.concurrency = AdaptiveConcurrency(initial=concurrency, maximum=max_concurrency)
+        self.budget = RetryBudget(ratio=retry_ratio)
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def wait_turn(self):
+        # A Retry-After from the host holds every caller, not just the one that got it
+        while True:
+            with self.lock:
+                wait = self.paused_until - time.monotonic()
+            if wait <= 0:
+                break
+            time.sleep(wait)
+
+        self.bucket.acquire()
+        self.concurrency.acquire()
+
+    def stats(self):
+        return {
+            "host": self.host,
+            "rate": self.bucket.rate,
+            "concurrency_limit": round(self.concurrency.limit, 2),
+            "active": self.concurrency.active,
+            "retry_balance": round(self.budget.balance, 2),
+            "paused_seconds": round(max(0.0, self.paused_until - time.monotonic()), 3)
+        }
+
+
+def retry_after_seconds(response):
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is None:
+        return None
+
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class Throttle:
+    def __init__(self, rate=5.0, burst=10, concurrency=4, max_concurrency=16, max_attempts=4, backoff=0.5,
+                 max_backoff=60.0, retry_ratio=0.2, host_limits=None, timeout=(10.0, 60.0)):
+        self.defaults = {
+            "rate": rate,
+            "burst": burst,
+            "concurrency": concurrency,
+            "max_concurrency": max_concurrency,
+            "retry_ratio": retry_ratio
+        }
+        # Per host overrides of the defaults, e.g. {"www.sciencebase.gov": {"rate": 2}}
+        self.host_limits = host_limits or dict()
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # (connect, read) seconds for callers that don't pass their own, so a hung host can't hold its slot forever
+        self.timeout = timeout
+        self.hosts = dict()
+        self.lock = threading.Lock()
+
+    def host(self, host):
+        host_throttle = self.hosts.get(host)
+        if host_throttle is None:
+            with self.lock:
+                if host not in self.hosts:
+                    limits = dict(self.defaults)
+                    limits.update(self.host_limits.get(host, dict()))
+                    self.hosts[host] = HostThrottle(host, **limits)
+                host_throttle = self.hosts[host]
+        return host_throttle
+
+    def retry_delay(self, attempt, response=None):
+        delay = None
+        if response is not None:
+            delay = retry_after_seconds(response)
+        if delay is None:
+            # Full jitter so callers that failed together don't come back together
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+        return min(delay, self.max_backoff)
+
+    @contextmanager
+    def slot(self, host):
+        # For clients we can't route through request(), like the sciencebasepy session
+        host_throttle = self.host(host)
+        host_throttle.wait_turn()
+        throttled = False
+        try:
+            yield host_throttle
+        except requests.exceptions.RequestException:
+            throttled = True
+            raise
+        finally:
+            host_throttle.concurrency.release(throttled=throttled)
+            host_throttle.budget.deposit()
+
+    def request(self, method, url, operation="http.request", **kwargs):
+        host = url_host(url)
+        host_throttle = self.host(host)
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+
+        while True:
+            attempt += 1
+            host_throttle.wait_turn()
+
+            response = None
+            error = None
+            throttled = False
+            try:
+                with metrics.timed(operation, host) as measurement:
+                    response = requests.request(method, url, **kwargs)
+                    measurement.bytes_received = len(response.content)
+                    measurement.error = response.status_code >= 500
+                throttled = response.status_code in throttled_status_codes
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                throttled = True
+                error = e
+            except requests.exceptions.RequestException:
+                # Not worth retrying, but still a failure as far as the concurrency limit is concerned
+                throttled = True
+                raise
+            finally:
+                # Whatever happened, the slot goes back or every later request to this host waits forever
+                host_throttle.concurrency.release(throttled=throttled)
+                host_throttle.budget.deposit()
+
+            retryable = error is not None or response.status_code in retryable_status_codes
+            if not retryable:
+                return response
+
+            delay = self.retry_delay(attempt, response=response)
+            if response is not None and response.status_code in throttled_status_codes:
+                host_throttle.pause(delay)
+
+            if attempt >= self.max_attempts or not host_throttle.budget.withdraw():
+                if error is not None:
+                    raise error
+                return response
+
+            metrics.record_retry(operation, host)
+            time.sleep(delay)
+
+    def get(self, url, operation="http.get", **kwargs):
+        return self.request("GET", url, operation=operation, **kwargs)
+
+    def stats(self):
+        with self.lock:
+            return [h.stats() for h in self.hosts.values()]
+
+
+# Shared by every outbound HTTP call in the package, so limits hold across modules and threads
+throttle = Throttle()
+
+
+def http_get(url, operation="http.get", **kwargs):
+    return throttle.get(url, operation=operation, **kwargs)
@@ -0,0 +1,195 @@
+from datetime import datetime, timedelta
+
+from .serverful import Infrastructure
+from .cache import CacheVersion
+
+
+class Views:
+    def __init__(self, serverful_infrastructure=None, max_age=3600):
+        if serverful_infrastructure is None:
+            serverful_infrastructure = Infrastructure()
+        self.serverful_infrastructure = serverful_infrastructure
+        self.cache_version = CacheVersion(serverful_infrastructure=serverful_infrastructure)
+
+        # A view that hasn't been fully refreshed within max_age seconds is read live from its source instead
+        self.max_age = max_age
+
+    def view_output(self, view_collection, merge=True):
+        if merge:
+            return {"$merge":
+                {
+                    "into": view_collection,
+                    "on": "_id",
+                    "whenMatched": "replace",
+                    "whenNotMatched": "insert"
+                }
+            }
+        else:
+            # Read live, in the same order the view is read in
+            return {"$sort": {"_id": 1}}
+
+    def organizations_pipeline(self, ndc_collection_owners=None, merge=True):
+        pipeline = list()
+
+        if ndc_collection_owners is not None:
+            pipeline.append({"$match": {"ndc_collection_owner": {"$in": ndc_collection_owners}}})
+
+        pipeline.extend([
+            {"$project": {"_id": 0}},
+            {"$sort": {"ndc_collection_id": 1}},
+            {"$group":
+                {
+                    "_id": "$ndc_collection_owner",
+                    "ndc_collection_owner_link": {"$first": "$ndc_collection_owner_link"},
+                    "ndc_collection_owner_api": {"$first": "$ndc_collection_owner_api"},
+                    "ndc_collection_owner_location": {"$first": "$ndc_collection_owner_location"},
+                    "collections": {"$push": "$$ROOT"}
+                }
+            },
+            self.view_output("ndc_organizations", merge=merge)
+        ])
+
+        return pipeline
+
+    def file_summaries_pipeline(self, ndc_collection_ids=None, merge=True):
+        pipeline = list()
+
+        if ndc_collection_ids is not None:
+            pipeline.append({"$match": {"ndc_collection_id": {"$in": ndc_collection_ids}}})
+
+        pipeline.extend([
+            {"$group":
+                {
+                    "_id": "$ndc_collection_id",
+                    "ndc_collection_title":
+                    {
+                        "$first": "$ndc_collection_title"
+                    },
+                    "ndc_collection_owner":
+                    {
+                        "$first": "$ndc_collection_owner"
+                    },
+                    "record_number":
+                    {
+                        "$sum": "$processing_metadata.accepted_record_number"
+                    },
+                    "files_processed":
+                    {
+                        "$addToSet": "$ndc_file_name"
+                    },
+                    "latest_file_date":
+                    {
+                        "$max": "$ndc_file_date"
+                    }
+                }
+            },
+            self.view_output("ndc_file_summaries", merge=merge)
+        ])
+
+        return pipeline
+
+    def refresh_view(self, source_collection, view_collection, key_field, pipeline, keys=None):
+        source_db = self.serverful_infrastructure.connect_mongodb(collection=source_collection)
+        view_db = self.serverful_infrastructure.connect_mongodb(collection=view_collection)
+
+        source_db.aggregate(pipeline)
+        self.mark_refreshed(view_collection, full=keys is None)
+
+        # $merge never removes documents, so drop view entries whose source records are gone
+        if keys is None:
+            remaining_keys = source_db.distinct(key_field)
+            removed = view_db.delete_many({"_id": {"$nin": remaining_keys}})
+        else:
+            remaining_keys = source_db.distinct(key_field, {key_field: {"$in": keys}})
+            removed = view_db.delete_many({"_id": {"$in": [k for k in keys if k not in remaining_keys]}})
+
+        return {
+            "view": view_collection,
+            "refreshed": len(remaining_keys),
+            "removed": removed.deleted_count
+        }
+
+    def mark_refreshed(self, view_collection, full=True):
+        # Only a full rebuild can make a view current; a partial refresh just keeps a current one from aging out
+        status_db = self.serverful_infrastructure.connect_mongodb(collection="ndc_view_status")
+        status_db.update_one(
+            {"_id": view_collection},
+            {"$set": {"refreshed": datetime.utcnow()}},
+            upsert=full
+        )
+
+    def is_current(self, view_status):
+        if view_status is None or view_status.get("refreshed") is None:
+            return False
+        return datetime.utcnow() - view_status["refreshed"] <= timedelta(seconds=self.max_age)
+
+    def refresh_organizations(self, ndc_collection_owners=None):
+        return self.refresh_view(
+            source_collection="ndc_collections",
+            view_collection="ndc_organizations",
+            key_field="ndc_collection_owner",
+            pipeline=self.organizations_pipeline(ndc_collection_owners=ndc_collection_owners),
+            keys=ndc_collection_owners
+        )
+
+    def refresh_file_summaries(self, ndc_collection_ids=None):
+        return self.refresh_view(
+            source_collection="ndc_files",
+            view_collection="ndc_file_summaries",
+            key_field="ndc_collection_id",
+            pipeline=self.file_summaries_pipeline(ndc_collection_ids=ndc_collection_ids),
+            keys=ndc_collection_ids
+        )
+
+    def refresh_all(self):
+        refresh_results = [
+            self.refresh_organizations(),
+            self.refresh_file_summaries()
+        ]
+        self.cache_version.bump()
+
+        return refresh_results
+
+    def record_collection(self, collection_meta):
+        ndc_collections_db = self.serverful_infrastructure.connect_mongodb(collection="ndc_collections")
+
+        previous_record = ndc_collections_db.find_one(
+            {"ndc_collection_id": collection_meta["ndc_collection_id"]},
+            {"ndc_collection_owner": 1}
+        )
+
+        ndc_collections_db.replace_one(
+            {"ndc_collection_id": collection_meta["ndc_collection_id"]},
+            collection_meta,
+            upsert=True
+        )
+
+        # Refresh both sides when a collection changes hands
+        owners = [collection_meta.get("ndc_collection_owner")]
+        if previous_record is not None and previous_record.get("ndc_collection_owner") not in owners:
+            owners.append(previous_record.get("ndc_collection_owner"))
+
+        refresh_result = self.refresh_organizations(ndc_collection_owners=owners)
+        self.cache_version.bump()
+
+        return refresh_result
+
+    def record_files(self, file_reports):
+        if len(file_reports) == 0:
+            return None
+
+        ndc_files_db = self.serverful_infrastructure.connect_mongodb(collection="ndc_files")
+
+        for file_report in file_reports:
+            ndc_files_db.replace_one(
+                {"ndc_file_url": file_report["ndc_file_url"]},
+                file_report,
+                upsert=True
+            )
+
+        refresh_result = self.refresh_file_summaries(
+            ndc_collection_ids=list(set([f["ndc_collection_id"] for f in file_reports]))
+        )
+        self.cache_version.bump()
+
+        return refresh_result
@@ -8,6 +8,7 @@ setup(name='pynggdpp',
       author_email='sbristol@usgs.gov',
       license='unlicense',
       packages=['pynggdpp'],
+      python_requires='>=3.9',
       install_requires=[
             'beautifulsoup4',
             'boto3',
@@ -37,4 +38,11 @@ setup(name='pynggdpp',
             'validators',
             'xmltodict'
       ],
+      extras_require={
+            'parquet': ['pyarrow'],
+            'zstd': ['zstandard'],
+            'orjson': ['orjson'],
+            'async': ['motor', 'elasticsearch[async]'],
+            'test': ['pytest']
+      },
       zip_safe=False)
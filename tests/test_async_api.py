@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+async_api = pytest.importorskip("pynggdpp.async_api")
+
+
+index_scan = {
+    "queryPlanner": {
+        "winningPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}},
+        "rejectedPlans": []
+    }
+}
+
+
+class FakeCursor:
+    def sort(self, *args):
+        return self
+
+    def limit(self, number):
+        return self
+
+    def explain(self):
+        return index_scan
+
+
+class FakeDatabase:
+    def __getitem__(self, name):
+        return self
+
+    def find(self, query):
+        return FakeCursor()
+
+    def command(self, command, collection, pipeline=None, explain=False):
+        return index_scan
+
+
+class FakeClient:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeInfrastructure:
+    # Stands in for both the motor and the pymongo infrastructure; nothing here goes over the wire
+    instances = list()
+
+    def __init__(self):
+        self.mongo_client = FakeClient()
+        FakeInfrastructure.instances.append(self)
+
+    def connect_mongodb(self, collection=None):
+        return FakeDatabase()
+
+
+def test_check_query_plans_runs_through_pymongo(monkeypatch):
+    monkeypatch.setattr(async_api, "Infrastructure", FakeInfrastructure)
+    mongo = async_api.AsyncMongo(serverful_infrastructure=FakeInfrastructure())
+
+    report = asyncio.run(mongo.check_query_plans())
+
+    assert [r["name"] for r in report] == [s["name"] for s in mongo.query_shapes()]
+    assert all(r["ok"] for r in report)
+    # The pymongo client opened for the check is closed again
+    assert FakeInfrastructure.instances[-1].mongo_client.closed
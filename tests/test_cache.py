@@ -0,0 +1,144 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+cache = pytest.importorskip("pynggdpp.cache")
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "monotonic", clock)
+    return clock
+
+
+def test_lru_cache_evicts_least_recently_used():
+    lru = cache.LRUCache(max_entries=2)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    assert lru.get("a") == (True, 1)
+
+    lru.set("c", 3)
+    assert lru.get("b") == (False, None)
+    assert lru.get("a") == (True, 1)
+    assert lru.get("c") == (True, 3)
+
+
+def test_lru_cache_expires_entries(clock):
+    lru = cache.LRUCache(ttl=10)
+    lru.set("a", 1)
+
+    clock.now += 9
+    assert lru.get("a") == (True, 1)
+
+    clock.now += 2
+    assert lru.get("a") == (False, None)
+    assert "a" not in lru.entries
+
+
+def test_response_cache_needs_an_expiry():
+    with pytest.raises(ValueError):
+        cache.ResponseCache(local=cache.LRUCache())
+
+
+def test_single_flight_computes_once():
+    response_cache = cache.ResponseCache()
+    release = threading.Event()
+    calls = list()
+
+    def compute():
+        calls.append(1)
+        release.wait(5)
+        return {"value": 1}
+
+    results = list()
+    threads = [
+        threading.Thread(target=lambda: results.append(response_cache.get_or_compute("key", compute)))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert results == [{"value": 1}] * 8
+    assert response_cache.in_flight == {}
+
+
+def test_single_flight_shares_errors_and_retries():
+    response_cache = cache.ResponseCache()
+
+    def compute():
+        raise RuntimeError("backend down")
+
+    with pytest.raises(RuntimeError):
+        response_cache.get_or_compute("key", compute)
+
+    # A failure isn't cached, so the next caller computes again
+    assert response_cache.get_or_compute("key", lambda: 2) == 2
+
+
+def test_cached_response_hands_out_copies():
+    class Backend:
+        def __init__(self):
+            self.response_cache = cache.ResponseCache()
+
+        @cache.cached_response
+        def lookup(self, name):
+            return {"name": name, "tags": ["a"]}
+
+    backend = Backend()
+    first = backend.lookup("x")
+    first["tags"].append("b")
+
+    assert backend.lookup("x") == {"name": "x", "tags": ["a"]}
+
+
+def test_async_single_flight_computes_once():
+    response_cache = cache.ResponseCache()
+    calls = list()
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"value": 1}
+
+    async def main():
+        return await asyncio.gather(*[response_cache.get_or_compute_async("key", compute) for _ in range(8)])
+
+    assert asyncio.run(main()) == [{"value": 1}] * 8
+    assert len(calls) == 1
+    assert response_cache.async_in_flight == {}
+
+
+def test_async_single_flight_cancelled_leader_releases_followers():
+    response_cache = cache.ResponseCache()
+
+    async def compute():
+        await asyncio.sleep(10)
+
+    async def main():
+        leader = asyncio.ensure_future(response_cache.get_or_compute_async("key", compute))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(response_cache.get_or_compute_async("key", compute))
+        await asyncio.sleep(0)
+
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(follower, 1)
+
+    asyncio.run(main())
+    assert response_cache.async_in_flight == {}
@@ -0,0 +1,129 @@
+import base64
+
+import pytest
+
+rest_api = pytest.importorskip("pynggdpp.rest_api")
+bson = pytest.importorskip("bson")
+
+
+class FakeCursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def sort(self, key, direction):
+        return FakeCursor(sorted(self.documents, key=lambda d: d[key], reverse=direction == rest_api.DESCENDING))
+
+    def limit(self, number):
+        return FakeCursor(self.documents[:number])
+
+    def __iter__(self):
+        # Copies, the way the driver hands back fresh documents on every query
+        return iter([dict(d) for d in self.documents])
+
+
+class FakeCollection:
+    # Just enough of a pymongo collection for keyset paging over _id with no other filters
+    name = "ndc_items"
+
+    def __init__(self, documents=None):
+        self.documents = documents or list()
+
+    def matches(self, document, query):
+        for operator, value in query.get("_id", {}).items():
+            if operator == "$gt" and not document["_id"] > value:
+                return False
+            if operator == "$lt" and not document["_id"] < value:
+                return False
+        return True
+
+    def find(self, query, projection=None):
+        return FakeCursor([d for d in self.documents if self.matches(d, query)])
+
+    def count_documents(self, query, limit=None):
+        count = len([d for d in self.documents if self.matches(d, query)])
+        return count if limit is None else min(count, limit)
+
+    def estimated_document_count(self):
+        return len(self.documents)
+
+
+class FakeInfrastructure:
+    def __init__(self, collections):
+        self.collections = collections
+
+    def connect_mongodb(self, collection=None):
+        return self.collections.get(collection, FakeCollection())
+
+
+@pytest.fixture
+def mongo():
+    items = FakeCollection([{"_id": n, "n": n} for n in range(1, 26)])
+    return rest_api.Mongo(serverful_infrastructure=FakeInfrastructure({"ndc_items": items}))
+
+
+def page_numbers(page):
+    return [item["n"] for item in page["items"]]
+
+
+def test_cursor_round_trip():
+    position = {"_id": bson.ObjectId()}
+    assert rest_api.decode_cursor(rest_api.encode_cursor(position)) == position
+
+
+def test_search_cursor_needs_search_after():
+    token = rest_api.encode_cursor({"search_after": [1, "a"], "pit": None})
+    assert rest_api.decode_cursor(token, key="search_after")["search_after"] == [1, "a"]
+
+    with pytest.raises(ValueError):
+        rest_api.decode_cursor(token)
+
+
+@pytest.mark.parametrize("token", [
+    "not a cursor!",
+    None,
+    base64.urlsafe_b64encode(b"[1, 2]").decode("ascii"),
+    base64.urlsafe_b64encode(b'{"last": 1}').decode("ascii")
+])
+def test_invalid_cursors_raise_value_error(token):
+    with pytest.raises(ValueError):
+        rest_api.decode_cursor(token)
+
+
+def test_items_page_query_rejects_foreign_cursor(mongo):
+    with pytest.raises(ValueError):
+        mongo.items_page_query(after=base64.urlsafe_b64encode(b'{"last": 1}').decode("ascii"))
+
+
+def test_keyset_paging_forward(mongo):
+    first = mongo.query_items(limit=10)
+    assert page_numbers(first) == list(range(1, 11))
+    assert first["total"] == 25
+    assert first["prev_cursor"] is None
+
+    second = mongo.query_items(limit=10, after=first["next_cursor"])
+    assert page_numbers(second) == list(range(11, 21))
+
+    last = mongo.query_items(limit=10, after=second["next_cursor"])
+    assert page_numbers(last) == list(range(21, 26))
+    assert last["next_cursor"] is None
+    assert last["prev_cursor"] is not None
+
+
+def test_keyset_paging_backward(mongo):
+    first = mongo.query_items(limit=10)
+    second = mongo.query_items(limit=10, after=first["next_cursor"])
+    last = mongo.query_items(limit=10, after=second["next_cursor"])
+
+    previous = mongo.query_items(limit=10, before=last["prev_cursor"])
+    assert page_numbers(previous) == list(range(11, 21))
+
+    back_to_first = mongo.query_items(limit=10, before=previous["prev_cursor"])
+    assert page_numbers(back_to_first) == list(range(1, 11))
+    assert back_to_first["prev_cursor"] is None
+
+
+def test_package_items_drops_internal_ids(mongo):
+    page = mongo.package_items([{"_id": 1, "n": 1}], 10, rest_api.ASCENDING, None)
+    assert page["items"] == [{"n": 1}]
+    assert page["total"] == 1
+    assert page["next_cursor"] is None
@@ -0,0 +1,44 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+cache = pytest.importorskip("pynggdpp.cache")
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "time", clock)
+    return clock
+
+
+def fake_response(url, content):
+    return SimpleNamespace(url=url, content=content, headers={"ETag": f'"{url}"'})
+
+
+def test_download_cache_evicts_least_recently_used(tmp_path, clock):
+    download_cache = cache.DownloadCache(str(tmp_path), max_bytes=12)
+
+    download_cache.store("http://host/a", fake_response("http://host/a", b"aaaaaa"))
+    clock.now += 1
+    download_cache.store("http://host/b", fake_response("http://host/b", b"bbbbbb"))
+    clock.now += 1
+
+    # Reading a refreshes it, so b is now the oldest
+    download_cache.cached_response("http://host/a", download_cache.lookup("http://host/a"))
+    clock.now += 1
+    download_cache.store("http://host/c", fake_response("http://host/c", b"cccccc"))
+
+    assert download_cache.lookup("http://host/b") is None
+    assert not os.path.exists(download_cache.file_path("http://host/b"))
+    assert download_cache.lookup("http://host/a") is not None
+    assert download_cache.lookup("http://host/c") is not None
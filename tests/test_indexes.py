@@ -0,0 +1,179 @@
+import pytest
+
+serverful = pytest.importorskip("pynggdpp.serverful")
+
+
+class FakeCursor:
+    def __init__(self, explain_document):
+        self.explain_document = explain_document
+
+    def sort(self, *args):
+        return self
+
+    def limit(self, number):
+        return self
+
+    def explain(self):
+        return self.explain_document
+
+
+class FakeCollection:
+    def __init__(self, indexes=None, explain_document=None):
+        self.indexes = {"_id_": {"key": [("_id", 1)]}}
+        self.indexes.update(indexes or dict())
+        self.explain_document = explain_document
+        self.created = list()
+
+    def index_information(self):
+        return dict(self.indexes)
+
+    def create_index(self, keys, name=None, **options):
+        # Like mongod, refuse a second index over the same keys under another name
+        for existing_name, existing in self.indexes.items():
+            if [tuple(k) for k in existing["key"]] == [tuple(k) for k in keys]:
+                raise serverful.OperationFailure(f"Index already exists with a different name: {existing_name}")
+
+        self.indexes[name] = {"key": list(keys)}
+        if any(kind == serverful.TEXT for _, kind in keys):
+            self.indexes[name] = {
+                "key": [("_fts", "text"), ("_ftsx", 1)],
+                "weights": {field: 1 for field, kind in keys if kind == serverful.TEXT}
+            }
+        self.created.append(name)
+        return name
+
+    def find(self, query):
+        return FakeCursor(self.explain_document)
+
+
+class FakeDatabase:
+    def __init__(self, collections):
+        self.collections = collections
+
+    def __getitem__(self, name):
+        return self.collections[name]
+
+    def command(self, command, collection, pipeline=None, explain=False):
+        return self.collections[collection].explain_document
+
+
+class FakeInfrastructure:
+    def __init__(self, collections):
+        self.collections = collections
+
+    def connect_mongodb(self, collection=None):
+        if collection is None:
+            return FakeDatabase(self.collections)
+        return self.collections.setdefault(collection, FakeCollection())
+
+
+def statuses(results):
+    return {(r["collection"], r["name"]): r["status"] for r in results}
+
+
+def test_ensure_indexes_is_idempotent():
+    infrastructure = FakeInfrastructure(dict())
+    indexes = serverful.Indexes(serverful_infrastructure=infrastructure)
+
+    first = indexes.ensure_indexes()
+    assert set(statuses(first).values()) == {"created"}
+
+    second = indexes.ensure_indexes()
+    assert set(statuses(second).values()) == {"exists"}
+    assert len(infrastructure.collections["ndc_items"].created) == len(indexes.required_indexes["ndc_items"])
+
+
+def test_ensure_indexes_limits_to_collections():
+    indexes = serverful.Indexes(serverful_infrastructure=FakeInfrastructure(dict()))
+
+    results = indexes.ensure_indexes(collections=["ndc_files"])
+    assert {r["collection"] for r in results} == {"ndc_files"}
+
+
+def test_ensure_indexes_reports_name_conflicts():
+    # An index under our name, but over a different field
+    ndc_files = FakeCollection({"ndc_collection_id": {"key": [("ndc_file_url", 1)]}})
+    indexes = serverful.Indexes(serverful_infrastructure=FakeInfrastructure({"ndc_files": ndc_files}))
+
+    results = [r for r in indexes.ensure_indexes(collections=["ndc_files"]) if r["name"] == "ndc_collection_id"]
+    assert results[0]["status"] == "conflict"
+    assert "ndc_file_url" in results[0]["error"]
+
+
+def test_ensure_indexes_reports_key_conflicts():
+    # Our keys, but under somebody else's name
+    ndc_files = FakeCollection({"file_url_1": {"key": [("ndc_file_url", 1)]}})
+    indexes = serverful.Indexes(serverful_infrastructure=FakeInfrastructure({"ndc_files": ndc_files}))
+
+    results = statuses(indexes.ensure_indexes(collections=["ndc_files"]))
+    assert results[("ndc_files", "ndc_file_url")] == "conflict"
+    assert results[("ndc_files", "ndc_collection_id")] == "created"
+
+
+def test_ensure_indexes_matches_existing_text_index():
+    ndc_items = FakeCollection({
+        "ndc_items_text": {
+            "key": [("_fts", "text"), ("_ftsx", 1)],
+            "weights": {"title": 3, "abstract": 2, "supplementalinformation": 1, "ndc_collection_abstract": 1}
+        }
+    })
+    indexes = serverful.Indexes(serverful_infrastructure=FakeInfrastructure({"ndc_items": ndc_items}))
+
+    results = statuses(indexes.ensure_indexes(collections=["ndc_items"]))
+    assert results[("ndc_items", "ndc_items_text")] == "exists"
+
+
+collection_scan = {
+    "queryPlanner": {
+        "winningPlan": {"stage": "LIMIT", "inputStage": {"stage": "COLLSCAN"}},
+        "rejectedPlans": []
+    }
+}
+
+index_scan = {
+    "queryPlanner": {
+        "winningPlan": {"stage": "LIMIT", "inputStage": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}},
+        # Rejected plans don't run, so their scans don't count against the query
+        "rejectedPlans": [{"stage": "SORT", "inputStage": {"stage": "COLLSCAN"}}]
+    }
+}
+
+
+def test_plan_stages_ignores_rejected_plans():
+    indexes = serverful.Indexes(serverful_infrastructure=FakeInfrastructure(dict()))
+
+    assert indexes.plan_stages(collection_scan) == ["LIMIT", "COLLSCAN"]
+    assert indexes.plan_stages(index_scan) == ["LIMIT", "FETCH", "IXSCAN"]
+
+
+def test_check_query_plans_flags_collection_scans():
+    infrastructure = FakeInfrastructure({
+        "ndc_items": FakeCollection(explain_document=index_scan),
+        "ndc_files": FakeCollection(explain_document=collection_scan),
+        "ndc_collections": FakeCollection(explain_document=collection_scan)
+    })
+    indexes = serverful.Indexes(serverful_infrastructure=infrastructure)
+
+    report = indexes.check_query_plans([
+        {"name": "items", "collection": "ndc_items", "filter": {"ndc_collection_id": "x"}, "sort": [("_id", 1)]},
+        {"name": "files", "collection": "ndc_files", "filter": {"ndc_collection_id": "x"}},
+        {"name": "all", "collection": "ndc_collections", "pipeline": [], "full_scan_expected": True}
+    ])
+    by_name = {r["name"]: r for r in report}
+
+    assert by_name["items"]["ok"] and not by_name["items"]["collection_scan"]
+    assert by_name["files"]["collection_scan"] and not by_name["files"]["ok"]
+    assert by_name["all"]["collection_scan"] and by_name["all"]["ok"]
+
+
+def test_check_query_plans_reports_explain_failures(monkeypatch):
+    indexes = serverful.Indexes(serverful_infrastructure=FakeInfrastructure(dict()))
+
+    def explain_query_shape(query_shape):
+        raise serverful.OperationFailure("text index required for $text query")
+
+    monkeypatch.setattr(indexes, "explain_query_shape", explain_query_shape)
+
+    report = indexes.check_query_plans([{"name": "text", "collection": "ndc_items", "filter": {}}])
+    assert report[0]["ok"] is False
+    assert "text index required" in report[0]["error"]
@@ -0,0 +1,61 @@
+import pytest
+
+aws = pytest.importorskip("pynggdpp.aws")
+
+
+class FakeStorage:
+    compression = None
+
+    def __init__(self, objects=None, error=None):
+        self.objects = objects or dict()
+        self.error = error
+
+    def get_s3_file(self, key, bucket_name=None, return_type="bytes"):
+        if self.error is not None:
+            return self.error
+        return self.objects.get((bucket_name, key))
+
+
+@pytest.fixture
+def messaging(monkeypatch):
+    monkeypatch.setattr(aws.Connect, "aws_client", lambda self, service, type="client": None)
+    monkeypatch.setattr(aws, "Storage", FakeStorage)
+    return aws.Messaging()
+
+
+def claim_checked(key_name):
+    return {
+        "ReceiptHandle": "receipt",
+        "Body": '{"ndc_claim_check": {}}',
+        "MessageAttributes": {
+            "ndc_claim_check": {"StringValue": f"ndc-message-payloads/{key_name}"}
+        }
+    }
+
+
+def test_resolve_message_reads_claim_checked_body(messaging):
+    messaging.storage.objects[("ndc-message-payloads", "queue/1.json")] = {"ndc_file_url": "http://host/a.csv"}
+
+    message = messaging.resolve_message(claim_checked("queue/1.json"))
+    assert message["Body"] == {"ndc_file_url": "http://host/a.csv"}
+    assert messaging.claim_checks["receipt"]["key_name"] == "queue/1.json"
+
+
+def test_resolve_message_inline_body(messaging):
+    message = messaging.resolve_message({"ReceiptHandle": "receipt", "Body": '{"a": 1}'})
+    assert message["Body"] == {"a": 1}
+    assert "ClaimCheck" not in message
+
+
+def test_resolve_message_missing_payload_raises(messaging):
+    with pytest.raises(FileNotFoundError):
+        messaging.resolve_message(claim_checked("queue/missing.json"))
+    assert "receipt" not in messaging.claim_checks
+
+
+def test_resolve_message_unreadable_payload_raises(messaging):
+    messaging.storage.error = "An error occurred (AccessDenied)"
+
+    with pytest.raises(OSError):
+        messaging.resolve_message(claim_checked("queue/1.json"))
+    assert "receipt" not in messaging.claim_checks
@@ -0,0 +1,48 @@
+import pytest
+
+rest_api = pytest.importorskip("pynggdpp.rest_api")
+
+
+class FakeInfrastructure:
+    def connect_mongodb(self, collection=None):
+        return None
+
+
+@pytest.fixture
+def mongo():
+    return rest_api.Mongo(serverful_infrastructure=FakeInfrastructure())
+
+
+def box_rings(clause):
+    boxes = clause["$or"] if "$or" in clause else [clause]
+    return [box["ndc_location"]["$geoWithin"]["$geometry"]["coordinates"][0] for box in boxes]
+
+
+def test_bbox_edges_follow_parallels(mongo):
+    clauses = mongo.spatial_clauses(bbox=(-110.0, 35.0, -105.0, 41.0))
+    assert len(clauses) == 1
+
+    ring = box_rings(clauses[0])[0]
+    assert ring[0] == ring[-1]
+    # A vertex every degree keeps the geodesic edges on the north and south parallels
+    assert [lon for lon, lat in ring if lat == 35.0] == [-110.0, -109.0, -108.0, -107.0, -106.0, -105.0, -110.0]
+    assert [lon for lon, lat in ring if lat == 41.0] == [-105.0, -106.0, -107.0, -108.0, -109.0, -110.0]
+    assert {lat for lon, lat in ring} == {35.0, 41.0}
+
+
+def test_bbox_across_antimeridian_splits(mongo):
+    clauses = mongo.spatial_clauses(bbox=(170.0, -20.0, -170.0, -10.0))
+    assert len(clauses) == 1
+
+    rings = box_rings(clauses[0])
+    assert len(rings) == 2
+    assert [(min(lon for lon, lat in ring), max(lon for lon, lat in ring)) for ring in rings] == [
+        (170.0, 180.0),
+        (-180.0, -170.0)
+    ]
+
+
+def test_bbox_to_a_pole_has_one_pole_vertex(mongo):
+    ring = box_rings(mongo.spatial_clauses(bbox=(-180.0, 60.0, 180.0, 90.0))[0])[0]
+    assert [[lon, lat] for lon, lat in ring if lat == 90.0] == [[180.0, 90.0]]
+    assert len(ring) == len(set(map(tuple, ring))) + 1
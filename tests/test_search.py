@@ -0,0 +1,68 @@
+import pytest
+
+aws = pytest.importorskip("pynggdpp.aws")
+es_exceptions = pytest.importorskip("elasticsearch.exceptions")
+
+
+class FakeIndices:
+    def __init__(self):
+        self.names = set()
+        self.deleted = list()
+
+    def exists(self, index_name):
+        return index_name in self.names
+
+    def create(self, index, body=None):
+        if index in self.names:
+            raise es_exceptions.RequestError(400, "resource_already_exists_exception", {})
+        self.names.add(index)
+        return {"acknowledged": True}
+
+    def delete(self, index):
+        self.deleted.append(index)
+        self.names.discard(index)
+        return {"acknowledged": True}
+
+
+class FakeElasticsearch:
+    def __init__(self, version="7.10.2"):
+        self.version = version
+        self.indices = FakeIndices()
+
+    def info(self):
+        return {"version": {"number": self.version}}
+
+
+@pytest.fixture
+def search(monkeypatch):
+    monkeypatch.setattr(aws.Connect, "elastic_client", lambda self: FakeElasticsearch())
+    return aws.Search()
+
+
+def test_ensure_es_index_never_deletes(search):
+    assert search.ensure_es_index("ndc", doc_type="ndc_collection_item") == {"acknowledged": True}
+
+    # A second writer that lost the race gets on with it instead of recreating the index
+    assert search.ensure_es_index("ndc", doc_type="ndc_collection_item") is None
+    assert search.es.indices.deleted == []
+    assert "ndc" in search.es.indices.names
+
+
+def test_ensure_es_index_raises_other_request_errors(search, monkeypatch):
+    def create(index, body=None):
+        raise es_exceptions.RequestError(400, "mapper_parsing_exception", {})
+
+    monkeypatch.setattr(search.es.indices, "create", create)
+
+    with pytest.raises(es_exceptions.RequestError):
+        search.ensure_es_index("ndc", doc_type="ndc_collection_item")
+
+
+def test_bulk_items_get_a_tiebreaker_id(search):
+    actions = list(search.bulk_data_generator("ndc_x", "ndc_collection_item", [{"title": "a"}, {"title": "b"}]))
+
+    ids = [action["_source"]["ndc_item_id"] for action in actions]
+    assert len(set(ids)) == 2
+
+    kept = list(search.bulk_data_generator("ndc_x", "ndc_collection_item", [{"ndc_item_id": "x"}]))
+    assert kept[0]["_source"]["ndc_item_id"] == "x"
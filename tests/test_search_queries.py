@@ -0,0 +1,119 @@
+import pytest
+
+rest_api = pytest.importorskip("pynggdpp.rest_api")
+
+
+class FakeElasticsearch:
+    def __init__(self, version):
+        self.version = version
+        self.info_calls = 0
+
+    def info(self):
+        self.info_calls += 1
+        return {"version": {"number": self.version}}
+
+
+class PagingElasticsearch(FakeElasticsearch):
+    def __init__(self, version, pit=True):
+        super().__init__(version)
+        self.pit = pit
+        self.requests = list()
+        self.opened = list()
+        self.closed = list()
+
+    def open_point_in_time(self, index, keep_alive):
+        if not self.pit:
+            raise rest_api.TransportError(400, "parse_exception", {})
+        self.opened.append(keep_alive)
+        return {"id": f"pit-{len(self.opened)}"}
+
+    def close_point_in_time(self, body):
+        self.closed.append(body["id"])
+
+    def search(self, **request):
+        self.requests.append(request)
+        # One page short of full, so it is the last one
+        return {"hits": {"total": {"value": 1, "relation": "eq"}, "hits": [{"_source": {}, "sort": [1.0, 0]}]}}
+
+
+def search_for(version, monkeypatch):
+    # Search opens a (lazy) Mongo client for the serverful paths it shares with Mongo
+    for name in ["MONGODB_USERNAME", "MONGODB_PASSWORD", "MONGODB_SERVER", "MONGODB_DATABASE"]:
+        monkeypatch.setenv(name, "test")
+    return rest_api.Search(es=FakeElasticsearch(version), query_cache_ttl=0)
+
+
+def type_clauses(query):
+    clauses = list()
+    if isinstance(query, dict):
+        for key, value in query.items():
+            if key == "type":
+                clauses.append(value)
+            else:
+                clauses.extend(type_clauses(value))
+    elif isinstance(query, list):
+        for value in query:
+            clauses.extend(type_clauses(value))
+    return clauses
+
+
+def test_item_queries_filter_on_type_for_6x(monkeypatch):
+    search = search_for("6.8.23", monkeypatch)
+
+    assert search.items_query()["query"] == {"type": {"value": "ndc_collection_item"}}
+    assert type_clauses(search.items_query(q="granite", bbox=(-110, 35, -100, 45))) == [
+        {"value": "ndc_collection_item"}
+    ]
+
+
+def test_item_queries_are_typeless_for_7x(monkeypatch):
+    search = search_for("7.10.2", monkeypatch)
+
+    assert search.items_query()["query"] == {"match_all": {}}
+
+    query = search.items_query(q="granite", bbox=(-110, 35, -100, 45))
+    assert type_clauses(query) == []
+    assert query["query"]["bool"]["must"][0]["multi_match"]["query"] == "granite"
+    assert "geo_bounding_box" in query["query"]["bool"]["filter"][0]
+
+    facets = search.facets_request(q="granite", facets=["collection"])
+    assert type_clauses(facets["body"]["query"]) == []
+
+    clusters = search.geo_clusters_request(zoom=6)
+    assert type_clauses(clusters["body"]["query"]) == []
+
+
+def test_cluster_version_is_read_once(monkeypatch):
+    search = search_for("7.10.2", monkeypatch)
+    search.items_query()
+    search.items_query(q="granite")
+
+    assert search.es.info_calls == 1
+
+
+def test_query_items_pages_on_a_point_in_time(monkeypatch):
+    search = search_for("7.10.2", monkeypatch)
+    search.es = PagingElasticsearch("7.10.2")
+
+    search.query_items(q="granite", size=20)
+    request = search.es.requests[0]
+
+    assert search.es.opened == ["1m"]
+    assert request["index"] is None
+    assert request["body"]["pit"] == {"id": "pit-1", "keep_alive": "1m"}
+    assert request["body"]["sort"][-1] == {"_shard_doc": "asc"}
+    # The last page hands its point in time back
+    assert search.es.closed == ["pit-1"]
+
+
+def test_query_items_without_point_in_time_never_sorts_on_id(monkeypatch):
+    search = search_for("6.8.23", monkeypatch)
+    search.es = PagingElasticsearch("6.8.23", pit=False)
+
+    search.query_items(q="granite", size=20)
+    request = search.es.requests[0]
+
+    assert "pit" not in request["body"]
+    assert request["index"] == "_all"
+    assert list(request["body"]["sort"][-1]) == ["ndc_item_id"]
+    assert all("_id" not in clause for clause in request["body"]["sort"])
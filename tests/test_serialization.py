@@ -0,0 +1,68 @@
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+
+serialization = pytest.importorskip("pynggdpp.serialization")
+np = pytest.importorskip("numpy")
+
+
+record = {
+    "title": "Core sample",
+    "date": datetime(2019, 5, 4, 3, 2, 1, 123456),
+    "collected": date(2019, 5, 4),
+    "count": np.int64(7),
+    "depth": np.float64(12.5),
+    "verified": np.bool_(True),
+    "bounds": np.array([1.5, 2.5]),
+    "price": Decimal("3.25"),
+    "tags": {"core"},
+    "raw": b"bytes",
+    "nested": {"values": [1, 2, None]}
+}
+
+
+@pytest.fixture(params=["orjson", "json"])
+def backend(request, monkeypatch):
+    if request.param == "json":
+        monkeypatch.setattr(serialization, "orjson", None)
+    elif serialization.orjson is None:
+        pytest.skip("orjson is not installed")
+    return request.param
+
+
+def test_backends_write_the_same_json(monkeypatch):
+    if serialization.orjson is None:
+        pytest.skip("orjson is not installed")
+
+    with_orjson = serialization.dumps(record)
+    monkeypatch.setattr(serialization, "orjson", None)
+    with_json = serialization.dumps(record)
+
+    assert json.loads(with_orjson) == json.loads(with_json)
+
+
+def test_dumps_converts_types(backend):
+    assert json.loads(serialization.dumps(record)) == {
+        "title": "Core sample",
+        "date": "2019-05-04T03:02:01.123456",
+        "collected": "2019-05-04",
+        "count": 7,
+        "depth": 12.5,
+        "verified": True,
+        "bounds": [1.5, 2.5],
+        "price": 3.25,
+        "tags": ["core"],
+        "raw": "bytes",
+        "nested": {"values": [1, 2, None]}
+    }
+
+
+def test_dumpb_matches_dumps(backend):
+    assert serialization.dumpb(record) == serialization.dumps(record).encode("utf-8")
+    assert serialization.loads(serialization.dumpb({"a": 1})) == {"a": 1}
+
+
+def test_ndjson_lines(backend):
+    assert serialization.dumpb_ndjson([{"a": 1}, {"b": 2}]).splitlines() == [b'{"a":1}', b'{"b":2}']
@@ -0,0 +1,53 @@
+from datetime import date
+from types import SimpleNamespace
+
+import pytest
+
+item_process = pytest.importorskip("pynggdpp.item_process")
+
+
+class FakeMetadata:
+    # gis_metadata hands back a mix of strings, tuples, dates and dicts
+    title = "Core samples"
+    dates = {"type": "single", "values": (date(2019, 5, 4),)}
+    place_keywords = ("Colorado", "Utah")
+    bounding_box = {"east": "-105.0", "west": "-110.0", "south": "35.0", "north": "41.0"}
+
+
+@pytest.fixture
+def spatial(monkeypatch, tmp_path):
+    monkeypatch.setattr(item_process, "get_supported_props", lambda: ["title", "dates", "place_keywords", "bounding_box"])
+    monkeypatch.setattr(item_process, "get_metadata_parser", lambda meta_doc: FakeMetadata())
+    return item_process.Spatial(metadata_cache=str(tmp_path))
+
+
+def test_feature_from_metadata_is_plain_json(spatial):
+    feature = spatial.feature_from_metadata("<metadata/>")
+
+    assert feature["properties"]["dates"] == {"type": "single", "values": ["2019-05-04"]}
+    assert feature["properties"]["place_keywords"] == ["Colorado", "Utah"]
+    assert feature["properties"]["ndc_geopoint"] == {"lon": -105.0, "lat": 35.0}
+
+
+def test_feature_from_metadata_same_on_cache_hit(spatial, monkeypatch):
+    fresh = spatial.feature_from_metadata("<metadata/>")
+
+    def unreachable(meta_doc):
+        raise AssertionError("parsed again on a cache hit")
+
+    monkeypatch.setattr(item_process, "get_metadata_parser", unreachable)
+    assert spatial.feature_from_metadata("<metadata/>") == fresh
+
+
+def test_metadata_items_take_extra_properties(monkeypatch, tmp_path):
+    monkeypatch.setattr(item_process, "get_supported_props", lambda: ["title", "dates", "place_keywords", "bounding_box"])
+    monkeypatch.setattr(item_process, "get_metadata_parser", lambda meta_doc: FakeMetadata())
+    files = item_process.Files(metadata_cache=str(tmp_path))
+    monkeypatch.setattr(files, "fetch_source", lambda file_object: SimpleNamespace(text="<metadata/>"))
+
+    file_object = {"ndc_file_url": "http://host/waf/core.xml", "ndc_file_name": "core.xml", "ndc_harvest_source": "waf"}
+    result = files.process_file(file_object, extra_properties={"ndc_collection_title": "Cores"})
+
+    item = result["recordset"][0]
+    assert item["ndc_collection_title"] == "Cores"
+    assert item["title"] == "Core samples"
@@ -0,0 +1,101 @@
+from types import SimpleNamespace
+
+import pytest
+
+throttle = pytest.importorskip("pynggdpp.throttle")
+requests = pytest.importorskip("requests")
+
+
+def fake_response(status_code=200, headers=None):
+    return SimpleNamespace(status_code=status_code, content=b"", headers=headers or dict())
+
+
+@pytest.fixture
+def quick_throttle():
+    # No waiting on the token bucket or between retries
+    return throttle.Throttle(rate=1000, burst=1000, backoff=0, max_attempts=3)
+
+
+def test_adaptive_concurrency_increases_and_halves():
+    concurrency = throttle.AdaptiveConcurrency(initial=4, minimum=1, maximum=5)
+
+    concurrency.acquire()
+    assert concurrency.active == 1
+    concurrency.release()
+    assert concurrency.active == 0
+    assert concurrency.limit == pytest.approx(4.25)
+
+    concurrency.acquire()
+    concurrency.release(throttled=True)
+    assert concurrency.limit == pytest.approx(2.125)
+
+    for _ in range(3):
+        concurrency.acquire()
+        concurrency.release(throttled=True)
+    assert concurrency.limit == 1
+
+
+def test_retry_budget_limits_retries():
+    budget = throttle.RetryBudget(ratio=0.5, minimum=2)
+    assert budget.withdraw()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+
+    budget.deposit()
+    budget.deposit()
+    assert budget.withdraw()
+
+
+def test_request_releases_slot_and_sets_timeout(monkeypatch, quick_throttle):
+    seen = dict()
+
+    def request(method, url, **kwargs):
+        seen.update(kwargs)
+        return fake_response()
+
+    monkeypatch.setattr(throttle.requests, "request", request)
+
+    assert quick_throttle.get("http://host/file").status_code == 200
+    assert seen["timeout"] == quick_throttle.timeout
+    assert quick_throttle.host("host").concurrency.active == 0
+
+
+def test_request_releases_slot_after_connection_errors(monkeypatch, quick_throttle):
+    attempts = list()
+
+    def request(method, url, **kwargs):
+        attempts.append(1)
+        raise requests.exceptions.ConnectionError("refused")
+
+    monkeypatch.setattr(throttle.requests, "request", request)
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        quick_throttle.get("http://host/file")
+
+    host_throttle = quick_throttle.host("host")
+    assert len(attempts) == 3
+    assert host_throttle.concurrency.active == 0
+    assert host_throttle.concurrency.limit < 4
+
+
+def test_request_releases_slot_after_other_request_errors(monkeypatch, quick_throttle):
+    def request(method, url, **kwargs):
+        raise requests.exceptions.InvalidURL("bad url")
+
+    monkeypatch.setattr(throttle.requests, "request", request)
+
+    # More failures than the initial limit would deadlock if any slot leaked
+    for _ in range(6):
+        with pytest.raises(requests.exceptions.InvalidURL):
+            quick_throttle.get("http://host/file")
+
+    assert quick_throttle.host("host").concurrency.active == 0
+
+
+def test_request_retries_throttled_responses(monkeypatch, quick_throttle):
+    responses = [fake_response(429, {"Retry-After": "0"}), fake_response(200)]
+    monkeypatch.setattr(throttle.requests, "request", lambda method, url, **kwargs: responses.pop(0))
+
+    assert quick_throttle.get("http://host/file").status_code == 200
+    assert responses == []
+    assert quick_throttle.host("host").concurrency.active == 0